@@ -0,0 +1,118 @@
+import json
+import threading
+import time
+
+from metrics import REGISTRY
+from structured_log import get_logger
+
+log = get_logger('admission')
+
+CONNECTIONS_REJECTED = REGISTRY.counter('quiz_connections_rejected_total', 'Connections refused with a "busy" frame', ('reason',))
+MESSAGES_THROTTLED = REGISTRY.counter('quiz_messages_throttled_total', 'Messages dropped by the per-IP message rate limit')
+
+
+class TokenBucket:
+    ''' Rate limit of rate tokens per second with bursts of up to burst tokens '''
+    __slots__ = ('rate', 'burst', 'tokens', 'updated_at')
+
+    def __init__(self, rate, burst):
+        self.rate = rate # tokens added per second
+        self.burst = burst # most tokens the bucket holds
+        self.tokens = burst # tokens left
+        self.updated_at = time.monotonic() # time the tokens were last refilled
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def take(self, now=None) -> bool:
+        ''' The function takes one token, returns False if the bucket is empty '''
+        self.refill(time.monotonic() if now is None else now)
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def wait_time(self) -> float:
+        ''' Seconds until the next token '''
+        return max(0.0, (1 - self.tokens) / self.rate) if self.rate else 0.0
+
+
+class AdmissionControl:
+    ''' Admission of new connections and per-IP rate limits.
+
+    A connection is refused when max_connections are open, or when its IP opened
+    connections faster than connect_rate per second (bursts of connect_burst). Messages
+    of an IP beyond message_rate per second (bursts of message_burst) are dropped. A
+    refused connection gets a single "busy" json line and is closed before any thread,
+    task or player is created for it. Rates of 0 disable the per-IP limits, many
+    players may share the address of a NAT or a load generator. '''
+
+    def __init__(self, max_connections=10000, connect_rate=0.0, connect_burst=20,
+                 message_rate=0.0, message_burst=50, max_tracked_ips=65536):
+        self.max_connections = max_connections # open connections at most, 0 means no limit
+        self.connect_rate = connect_rate # new connections per second and IP
+        self.connect_burst = connect_burst
+        self.message_rate = message_rate # messages per second and IP
+        self.message_burst = message_burst
+        self.max_tracked_ips = max_tracked_ips # idle buckets are pruned beyond this many IPs
+        self.active = 0 # open connections that were admitted
+        self.connect_buckets = {} # ip -> TokenBucket of new connections
+        self.message_buckets = {} # ip -> TokenBucket of messages, shared by the connections of the ip
+        self.lock = threading.Lock()
+        REGISTRY.gauge('quiz_admitted_connections', 'Open connections counted by admission control',
+                       callback=lambda: self.active)
+
+    def admit(self, ip, rate_limited=True):
+        ''' The function counts a new connection and returns None, or returns the reason to refuse it '''
+        with self.lock:
+            if self.max_connections and self.active >= self.max_connections:
+                return 'capacity'
+            if rate_limited and self.connect_rate > 0:
+                bucket = self._bucket(self.connect_buckets, ip, self.connect_rate, self.connect_burst)
+                if not bucket.take():
+                    return 'rate'
+            self.active += 1
+            return None
+
+    def release(self):
+        ''' The admitted connection was closed or handed off '''
+        with self.lock:
+            self.active -= 1
+
+    def message_bucket(self, ip):
+        ''' The function returns the message bucket of the ip, or None if messages are not limited '''
+        if self.message_rate <= 0:
+            return None
+        with self.lock:
+            return self._bucket(self.message_buckets, ip, self.message_rate, self.message_burst)
+
+    def retry_after(self, reason, ip) -> float:
+        ''' Seconds a refused client should wait before it connects again '''
+        if reason == 'rate':
+            with self.lock:
+                bucket = self.connect_buckets.get(ip)
+                return round(bucket.wait_time(), 2) if bucket else 1.0
+        return 1.0
+
+    def _bucket(self, buckets, ip, rate, burst) -> TokenBucket:
+        bucket = buckets.get(ip)
+        if bucket is None:
+            if len(buckets) >= self.max_tracked_ips:
+                self._prune(buckets)
+            bucket = buckets[ip] = TokenBucket(rate, burst)
+        return bucket
+
+    def _prune(self, buckets):
+        # a full bucket behaves like a new one, so forgetting it changes nothing
+        now = time.monotonic()
+        for ip, bucket in list(buckets.items()):
+            bucket.refill(now)
+            if bucket.tokens >= bucket.burst:
+                del buckets[ip]
+        log.debug("rate limit buckets pruned", left=len(buckets))
+
+    def busy_frame(self, reason, ip) -> bytes:
+        ''' The function returns the json line sent to a refused connection '''
+        CONNECTIONS_REJECTED.inc(reason)
+        return (json.dumps({'type': 'busy', 'reason': reason, 'retry_after': self.retry_after(reason, ip)}) + '\n').encode()
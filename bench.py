@@ -0,0 +1,355 @@
+''' Microbenchmarks of the server hot paths and of full games over loopback sockets, compared against a saved baseline '''
+import argparse
+import asyncio
+import json
+import platform
+import random
+import re
+import selectors
+import socket
+import statistics
+import sys
+import threading
+import time
+
+from loadgen import raise_open_files_limit
+from server import Server, AsyncServer, Player
+from structured_log import configure as configure_logging, LEVELS
+from wire import JSON, BINARY
+
+BENCHMARKS = [] # (name, function) in the order they run, see benchmark()
+
+
+def benchmark(name):
+    ''' The decorator registers a benchmark. The function gets the options and returns {case name: [seconds per operation]} '''
+    def register(function):
+        BENCHMARKS.append((name, function))
+        return function
+    return register
+
+
+def sample(run, number, setup=None) -> list:
+    ''' The function times number calls of run, setup is called before each of them and is not timed '''
+    samples = []
+    for _ in range(number):
+        if setup:
+            setup()
+        started = time.perf_counter()
+        run()
+        samples.append(time.perf_counter() - started)
+    return samples
+
+
+class Drain:
+    ''' Reads and discards everything the server writes to the peer ends of socketpairs, on its own thread '''
+
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def add(self, sock: socket.socket):
+        sock.setblocking(False)
+        with self.lock:
+            self.selector.register(sock, selectors.EVENT_READ)
+
+    def _run(self):
+        while True:
+            with self.lock:
+                ready = self.selector.select(timeout=0) if self.selector.get_map() else []
+            if not ready:
+                time.sleep(0.0005)
+                continue
+            for key, _ in ready:
+                try:
+                    if not key.fileobj.recv(1 << 16):
+                        with self.lock:
+                            self.selector.unregister(key.fileobj)
+                except BlockingIOError:
+                    pass
+
+
+def bench_server(server_class=Server) -> Server:
+    ''' A server without heartbeats, the benchmarks drive its games '''
+    server = server_class()
+    server.heartbeat.interval = 0
+    return server
+
+
+def socket_players(server: Server, drain: Drain, count) -> list:
+    ''' The function connects count players over socketpairs, the drain reads what they are sent '''
+    players = []
+    for index in range(count):
+        ours, theirs = socket.socketpair()
+        drain.add(theirs)
+        players.append(server.new_player(ours, ('127.0.0.1', 30000 + index)))
+    return players
+
+
+def offline_players(server: Server, count) -> list:
+    ''' The function creates players without a connection, broadcasts skip them '''
+    players = []
+    for index in range(count):
+        with server.lock:
+            player_id = server.next_player_id
+            server.next_player_id += 1
+        players.append(Player(None, (f"10.0.{index >> 8 & 255}.{index & 255}", 30000 + index), player_id))
+    return players
+
+
+def room(server: Server, players: list):
+    ''' The function seats the players in a new game that is playing its first round '''
+    game_id, _ = server.createGame(players[0])
+    game = server.games[game_id]
+    for player in players[1:]:
+        game.add_player(player)
+    game.game_state = 'playing'
+    game.current_question = game.questions[0]
+    game.current_question_index = game.current_round = 1
+    game.number_of_rounds = sys.maxsize # the benchmarks close rounds but never end the game
+    return game
+
+
+def open_round(game):
+    if game.round_timer:
+        game.round_timer.cancel()
+    game.round_open = True
+    game.answers_received = 0
+    game.question_start_time = game.server.clock.time()
+
+
+def wait_drained(players):
+    while any(player.outbox.depth for player in players):
+        time.sleep(0.0002)
+
+
+@benchmark('broadcast')
+def bench_broadcast(options) -> dict:
+    ''' Game.broadcast of a question to rooms of connected players, each with its own socketpair '''
+    server, drain = bench_server(), Drain()
+    results = {}
+    for size in options.room_sizes:
+        players = socket_players(server, drain, size)
+        game = room(server, players)
+        message = {'type': 'question', 'round': 1, 'question': game.current_question.question,
+                   'options': game.current_question.options, 'sent_at': time.time()}
+        # every broadcast starts with empty outboxes, so the queues never overflow
+        results[f"broadcast/{size}"] = sample(lambda: game.broadcast(message), options.scale(2000 // size + 20),
+                                              setup=lambda: wait_drained(players))
+        game.close_connection_players(players)
+        server.remove_game(game.id)
+    return results
+
+
+@benchmark('process_answer')
+def bench_process_answer(options) -> dict:
+    ''' Game.process_answer of all but the last player of a room, so the round stays open '''
+    server = bench_server()
+    results = {}
+    for size in options.room_sizes:
+        if size < 2:
+            continue
+        players = offline_players(server, size)
+        game = room(server, players)
+        rng = random.Random(1)
+        samples = []
+        for _ in range(options.scale(max(1, 2000 // size))):
+            open_round(game)
+            for player in players[:-1]:
+                answer = rng.randrange(4)
+                started = time.perf_counter()
+                game.process_answer(player, 1, answer)
+                samples.append(time.perf_counter() - started)
+            game.board.tally(game.current_question.answer)
+        results[f"process_answer/{size}"] = samples
+        server.remove_game(game.id)
+    return results
+
+
+@benchmark('getMessage')
+def bench_get_message(options) -> dict:
+    ''' Server.getMessage of buffered answers, per message, for both wire encodings '''
+    server = bench_server()
+    results = {}
+    batch = 500
+    for codec in (JSON, BINARY):
+        ours, theirs = socket.socketpair()
+        player = server.new_player(ours, ('127.0.0.1', 30000))
+        player.use_codec(codec, server.max_frame_size)
+        data = b''.join(codec.encode({'type': 'answer', 'round': index % 5, 'answer': index % 4}) for index in range(batch))
+
+        def read_batch():
+            for _ in range(batch):
+                server.getMessage(player)
+        samples = sample(read_batch, options.scale(200), setup=lambda: theirs.sendall(data))
+        results[f"getMessage/{codec.name}"] = [seconds / batch for seconds in samples]
+        player.close(flush=False)
+        theirs.close()
+    return results
+
+
+@benchmark('create_room')
+def bench_create_room(options) -> dict:
+    ''' Game.get_questions alone, and Server.createGame, which draws the questions of the new room '''
+    server = bench_server()
+    creators = offline_players(server, options.scale(2000))
+    game = room(server, creators[:1])
+    results = {'get_questions': sample(game.get_questions, options.scale(2000))}
+    creators = iter(creators[1:])
+    results['create_room'] = sample(lambda: server.createGame(next(creators)), options.scale(1999))
+    for game_id in list(server.games):
+        server.remove_game(game_id)
+    return results
+
+
+@benchmark('handle_all_answered')
+def bench_handle_all_answered(options) -> dict:
+    ''' Game.handle_all_answered of a room where everyone answered: tally, score lists, round result delta '''
+    server = bench_server()
+    results = {}
+    for size in options.room_sizes:
+        players = offline_players(server, size)
+        game = room(server, players)
+        rng = random.Random(1)
+
+        def answered():
+            open_round(game)
+            for player in players:
+                game.board.record(player.seat, rng.randrange(4), rng.uniform(0, 10))
+            game.answers_received = size
+        results[f"handle_all_answered/{size}"] = sample(game.handle_all_answered, options.scale(2000 // size + 20), setup=answered)
+        if game.round_timer:
+            game.round_timer.cancel()
+        server.remove_game(game.id)
+    return results
+
+
+async def play_room(host, port, size) -> float:
+    ''' The function plays one game with size clients that answer at once and returns its seconds from connect to end game '''
+    started = time.perf_counter()
+    connections = [await asyncio.open_connection(host, port) for _ in range(size)]
+
+    def send(writer, message):
+        writer.write((json.dumps(message) + '\n').encode())
+
+    async def read(reader):
+        return json.loads(await reader.readline())
+
+    send(connections[0][1], {'type': 'create'})
+    game_id = (await read(connections[0][0]))['game_id']
+    for reader, writer in connections[1:]:
+        send(writer, {'type': 'connect', 'game_id': game_id})
+        await read(reader)
+
+    async def play(reader, writer):
+        send(writer, {'type': 'ready to start'})
+        while True:
+            message = await read(reader)
+            if message['type'] == 'question':
+                send(writer, {'type': 'answer', 'round': message['round'], 'answer': random.randrange(4)})
+            elif message['type'] == 'end game':
+                writer.close()
+                return
+    await asyncio.gather(*(play(reader, writer) for reader, writer in connections))
+    return time.perf_counter() - started
+
+
+def run_flow(server: Server, options) -> list:
+    ''' The function serves on an ephemeral loopback port and plays the flow rooms at the same time '''
+    server.delay_between_questions = 0
+    listen = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listen.bind(('127.0.0.1', 0))
+    listen.listen(1024)
+    server.listen_socket = listen
+    threading.Thread(target=server.serve, args=('127.0.0.1', listen.getsockname()[1], 1024), daemon=True).start()
+
+    async def rooms():
+        plays = [play_room('127.0.0.1', listen.getsockname()[1], options.flow_room_size) for _ in range(options.flow_rooms)]
+        return await asyncio.gather(*plays)
+    samples = []
+    for _ in range(options.scale(3)):
+        samples.extend(asyncio.run(rooms()))
+    return samples
+
+
+@benchmark('flow')
+def bench_flow(options) -> dict:
+    ''' Full games over loopback sockets: join, ready, five rounds, end, for both server modes '''
+    return {
+        'flow/threads': run_flow(bench_server(), options),
+        'flow/asyncio': run_flow(bench_server(AsyncServer), options)
+    }
+
+
+def summarize(samples) -> dict:
+    samples = sorted(samples)
+    return {
+        'ops': len(samples),
+        'median_us': round(statistics.median(samples) * 1e6, 3),
+        'p90_us': round(samples[min(len(samples) - 1, int(0.9 * len(samples)))] * 1e6, 3)
+    }
+
+
+def compare(results: dict, baseline: dict, threshold) -> list:
+    ''' The function returns the names of the cases whose median is more than threshold percent above the baseline '''
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        result['change_pct'] = None
+        if not base or not base['median_us']:
+            continue
+        result['change_pct'] = round((result['median_us'] / base['median_us'] - 1) * 100, 1)
+        if result['change_pct'] > threshold:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks of the quiz server hot paths')
+    parser.add_argument('--filter', default='', help='regular expression, only the benchmarks whose name matches run')
+    parser.add_argument('--room-sizes', type=lambda text: [int(size) for size in text.split(',')], default=[2, 10, 100, 1000],
+                        help='players per room of the per-room benchmarks, comma separated')
+    parser.add_argument('--flow-rooms', type=int, default=20, help='rooms that play a full game at the same time')
+    parser.add_argument('--flow-room-size', type=int, default=4, help='players per room of the full games')
+    parser.add_argument('--repeat', type=float, default=1.0, help='multiplies the number of timed operations')
+    parser.add_argument('--baseline', help='JSON file of an earlier run to compare with')
+    parser.add_argument('--threshold', type=float, default=25.0,
+                        help='percent a median may be slower than the baseline before the run fails')
+    parser.add_argument('--save', help='write the results to this JSON file, to be used as the next baseline')
+    parser.add_argument('--log-level', choices=list(LEVELS), default='warning')
+    parser.add_argument('--json', action='store_true', help='print the results as json')
+    options = parser.parse_args()
+    options.scale = lambda number: max(1, int(number * options.repeat))
+    configure_logging(options.log_level)
+    raise_open_files_limit()
+
+    results = {}
+    for name, function in BENCHMARKS:
+        if re.search(options.filter, name):
+            results.update({case: summarize(samples) for case, samples in function(options).items()})
+
+    regressions = []
+    if options.baseline:
+        with open(options.baseline) as f:
+            regressions = compare(results, json.load(f)['results'], options.threshold)
+    if options.save:
+        with open(options.save, 'w') as f:
+            json.dump({'python': platform.python_version(), 'machine': platform.machine(), 'created': time.time(),
+                       'results': results}, f, indent=2)
+
+    if options.json:
+        print(json.dumps({'results': results, 'regressions': regressions}, indent=2))
+    else:
+        for name, result in results.items():
+            change = result.get('change_pct')
+            change = '' if change is None else f"{change:+.1f}%" + (' REGRESSION' if name in regressions else '')
+            print(f"{name:>28}: {result['median_us']:>12.2f} us  p90 {result['p90_us']:>12.2f} us  "
+                  f"({result['ops']} ops) {change}")
+    if regressions:
+        print(f"{len(regressions)} regressions beyond {options.threshold}%: {', '.join(regressions)}", file=sys.stderr)
+        return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
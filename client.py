@@ -1,51 +1,524 @@
+import argparse
+import asyncio
+import base64
+import hashlib
 import json
-import socket
+import os
+import struct
 import sys
-import threading
 import time
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
 
-# Windows: "msvcrt", Linux/MacOS: "select" (this is for non-blocking input)
+# Windows: "msvcrt" (this is for non-blocking input)
 if sys.platform == "win32":
     import msvcrt
-else:
-    import select
-
-# Set the size of the terminal for a comfortable game
-import os
-if sys.platform == "win32":
-    os.system(f'mode con: cols=52 lines=35')
-else:
-    print("\x1b[8;35;52t")
 
 # Adress of the server
 SERVER_HOST = '127.0.0.1'
 SERVER_PORT = 20250
 
-class ClientEntity:
-    def __init__(self):
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+# Binary message type codes, the same as in wire.py of the server
+BINARY_TYPES = {"ready to start": 1, "answer": 2, "pong": 3, "new player": 16, "question": 17, "correct answer": 18,
+                "end game": 19, "ping": 20, "round result": 21, "prefetch": 22, "reveal": 23, "standings": 24}
+BINARY_NAMES = {code: name for name, code in BINARY_TYPES.items()}
+
+def open_sealed(payload, key):
+    '''Function for opening a question sent ahead of its round: the payload is xored with a SHA-256 keystream of the key'''
+    data, key = base64.b64decode(payload), base64.b64decode(key)
+    stream = b"".join(hashlib.sha256(key + block.to_bytes(4, 'big')).digest() for block in range((len(data) + 31) // 32))
+    return json.loads(bytes(a ^ b for a, b in zip(data, stream)))
+
+class WireCodec:
+    '''Class for encoding and decoding messages: json lines until the "status" of the game, then binary frames if the server accepted them'''
+    def __init__(self, ask_binary=False):
+        self.ask_binary = ask_binary
+        self.binary = False
+        self.buffer = b""
+
+    @staticmethod
+    def put_varint(out, value):
+        while value >= 0x80:
+            out.append((value & 0x7f) | 0x80)
+            value >>= 7
+        out.append(value)
+
+    @staticmethod
+    def get_varint(buf, pos, max_bytes=10):
+        result = shift = 0
+        end = min(len(buf), pos + max_bytes)
+        while pos < end:
+            byte = buf[pos]
+            pos += 1
+            result |= (byte & 0x7f) << shift
+            if not byte & 0x80:
+                return result, pos
+            shift += 7
+        if end < len(buf):
+            raise ValueError("Varint is too long")
+        return None, pos
+
+    def encode(self, message):
+        '''Function for encoding a message for the server'''
+        if message["type"] in ("create", "connect", "quick play", "join event", "resume", "spectate") and self.ask_binary:
+            message = dict(message, encoding="binary")
+        if not self.binary:
+            return (json.dumps(message) + '\n').encode()
+        body = bytearray()
+        if message["type"] == "ready to start":
+            body.append(BINARY_TYPES["ready to start"])
+        elif message["type"] == "answer":
+            body.append(BINARY_TYPES["answer"])
+            self.put_varint(body, message["round"])
+            # 0 means "no answer", the answers 0-3 are sent as 1-4
+            self.put_varint(body, 0 if message["answer"] is None else message["answer"] * 2 + 1)
+        elif message["type"] == "pong":
+            body.append(BINARY_TYPES["pong"])
+            self.put_varint(body, message["seq"])
+        else:
+            body.append(0)
+            body += json.dumps(message).encode()
+        frame = bytearray()
+        self.put_varint(frame, len(body))
+        return bytes(frame + body)
+
+    def decode_body(self, body):
+        '''Function for decoding the body of one binary frame'''
+        if body[0] == 0:
+            return json.loads(body[1:].decode())
+        message = {"type": BINARY_NAMES[body[0]]}
+        get, pos = self.get_varint, 1
+        def get_ints(pos):
+            count, pos = get(body, pos)
+            values = []
+            for _ in range(count):
+                value, pos = get(body, pos)
+                values.append(value)
+            return values, pos
+        def get_str(pos):
+            length, pos = get(body, pos)
+            return body[pos:pos + length].decode(), pos + length
+        if message["type"] == "ping":
+            message["seq"], pos = get(body, pos)
+        elif message["type"] == "new player":
+            message["player_id"], pos = get(body, pos)
+        elif message["type"] == "question":
+            message["round"], pos = get(body, pos)
+            message["question"], pos = get_str(pos)
+            count, pos = get(body, pos)
+            message["options"] = []
+            for _ in range(count):
+                option, pos = get_str(pos)
+                message["options"].append(option)
+            message["sent_at"] = struct.unpack_from('<d', body, pos)[0]
+        elif message["type"] == "correct answer":
+            message["correct_answ"], pos = get(body, pos)
+            message["curr_score"], pos = get_ints(pos)
+            count, pos = get(body, pos)
+            message["deleted_players"] = []
+            for _ in range(count):
+                player_id, pos = get(body, pos)
+                score, pos = get(body, pos)
+                message["deleted_players"].append({"id": player_id, "score": score})
+        elif message["type"] == "end game":
+            message["winner"], pos = get_str(pos)
+            message["curr_score"], pos = get_ints(pos)
+        elif message["type"] == "round result":
+            message["round"], pos = get(body, pos)
+            message["correct_answ"], pos = get(body, pos)
+            message["scored"], pos = get_ints(pos)
+            count, pos = get(body, pos)
+            message["left"] = []
+            for _ in range(count):
+                player_id, pos = get(body, pos)
+                score, pos = get(body, pos)
+                message["left"].append([player_id, score])
+        elif message["type"] in ("prefetch", "reveal"):
+            message["round"], pos = get(body, pos)
+            length, pos = get(body, pos)
+            message["payload" if message["type"] == "prefetch" else "key"] = base64.b64encode(body[pos:pos + length]).decode()
+            if message["type"] == "reveal":
+                message["sent_at"] = struct.unpack_from('<d', body, pos + length)[0]
+        elif message["type"] == "standings":
+            message["round"], pos = get(body, pos)
+            message["players"], pos = get(body, pos)
+            count, pos = get(body, pos)
+            message["top"] = []
+            for _ in range(count):
+                player_id, pos = get(body, pos)
+                score, pos = get(body, pos)
+                message["top"].append([player_id, score])
+            message["final"] = bool(body[pos])
+        return message
+
+    def feed(self, data):
+        '''Function for decoding all complete messages in the received data'''
+        self.buffer += data
+        messages = []
+        while True:
+            if self.binary:
+                # frame lengths fit 5 bytes, a longer prefix is garbage
+                length, start = self.get_varint(self.buffer, 0, 5)
+                if length is None or start + length > len(self.buffer):
+                    break
+                messages.append(self.decode_body(self.buffer[start:start + length]))
+                self.buffer = self.buffer[start + length:]
+            else:
+                if b'\n' not in self.buffer:
+                    break
+                message_part, self.buffer = self.buffer.split(b'\n', 1)
+                if not message_part:
+                    continue
+                message = json.loads(message_part.decode())
+                messages.append(message)
+                # The server switches to binary right after the "status" that accepts it
+                if message.get("type") == "status" and message.get("game_id") is not None and message.get("encoding") == "binary":
+                    self.binary = True
+        return messages
+
+# Events produced by QuizClient for its consumers (terminal UI, bots, tests)
+@dataclass
+class GameStatus:
+    '''Response to "create", "join" or "spectate", game_id is None if the room does not exist'''
+    player_id: int
+    game_id: Optional[int]
+    players: List[int]
+    encoding: str = "json"
+    spectator: bool = False
+    event: Optional[str] = None       # name of the event the room belongs to
+    starts_in: Optional[float] = None   # seconds until the event starts
+
+@dataclass
+class PlayerJoined:
+    player_id: int
+
+@dataclass
+class QuestionAsked:
+    round: int
+    question: str
+    options: List[str]
+    sent_at: Optional[float] = None   # server time of sending, for latency measurements
+
+@dataclass
+class RoundResult:
+    round: int
+    correct_answer: int               # number of the correct option, starting from 1
+    your_answer: Optional[int]        # index of the option this client sent, None if it did not answer
+    scores: Dict[int, int]            # player_id -> score of the players that are still in the game
+    deleted_players: Dict[int, int]   # player_id -> final score of the players that left
+    scored: List[int] = field(default_factory=list)     # ids of the players that answered this round correctly
+
+@dataclass
+class Standings:
+    '''Top players of all rooms of an event after a round'''
+    round: int
+    players: int                      # players in all rooms of the event
+    top: List[Tuple[int, int]]        # (player_id, score) of the best players
+    final: bool                       # whether this is the table of the last round
+
+@dataclass
+class GameOver:
+    winner: str
+    scores: Dict[int, int]
+
+@dataclass
+class ConnectionLost:
+    reason: str
+
+class ServerBusy(ConnectionError):
+    '''Raised when the server refuses the connection or drops requests because it is overloaded'''
+    def __init__(self, reason, retry_after):
+        super().__init__(f"server busy ({reason}), retry after {retry_after} s")
+        self.reason = reason
+        self.retry_after = retry_after
+
+class QuizClient:
+    '''Asyncio client of the quiz server without any terminal input or output.
+
+    create(), join(), ready() and answer() are awaitable and every message of the
+    server becomes a typed event in events(), so one event loop can run many clients.
+    A dropped connection is resumed within resume_window seconds, the server then
+    replays the messages that were missed and the events go on as if nothing happened.
+    The client keeps the scores by player id and asks the server for per-round score
+    deltas, servers that do not know them keep sending the full score lists. It also
+    asks for the questions ahead of their rounds: a sealed question arrives during the
+    pause and the start of the round only brings its key.'''
+    def __init__(self, binary=False, resume_window=10.0, name=None):
+        self.codec = WireCodec(binary)
+        self.name = name                # name on the leaderboards of the server, None plays anonymously
+        self.host = SERVER_HOST
+        self.port = SERVER_PORT
+        self.resume_window = resume_window  # seconds to try to resume a dropped connection, 0 disables it
+        self.resume_token: Optional[str] = None    # secret of the session, sent by the server with the status
+        self.seq = 0                    # number of game broadcasts received, tells the server what to replay
+        self.resuming = False
+        self.game_over = False
+        self.closed = False
+        self.reader: Optional[asyncio.StreamReader] = None
+        self.writer: Optional[asyncio.StreamWriter] = None
         self.player_id = None
         self.game_id = None
-        self.players = []
-        self.running = True
-        self.current_round = -1
+        self.players: List[int] = []    # ids of the players in the game, in the order of the server's score lists
+        self.scores: Dict[int, int] = {}    # player_id -> score of the players that are still in the game
+        self.deleted: Dict[int, int] = {}   # player_id -> final score of the players that left
+        self.sealed: Dict[int, str] = {}    # round -> sealed question received ahead of the round
+        self.current_round = -1         # round of the last question received
+        self.answers: Dict[int, Optional[int]] = {}    # round -> answer sent by this client
+        self.events_queue: Optional[asyncio.Queue] = None
+        self.pending_status: Optional[asyncio.Future] = None
+        self.read_task: Optional[asyncio.Task] = None
+        self.busy: Optional[ServerBusy] = None  # last "busy" notice of the server
+
+    async def connect(self, host=SERVER_HOST, port=SERVER_PORT):
+        '''Function for opening the connection and starting to read messages from the server'''
+        self.host, self.port = host, port
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        self.events_queue = asyncio.Queue()
+        self.read_task = asyncio.create_task(self.read_messages())
+
+    async def send(self, message):
+        '''Function for sending a message to the server in the negotiated encoding'''
+        self.writer.write(self.codec.encode(message))
+        await self.writer.drain()
+
+    async def request_status(self, message) -> GameStatus:
+        if self.busy and self.read_task.done():
+            raise self.busy     # the server refused the connection
+        self.pending_status = asyncio.get_running_loop().create_future()
+        message = dict(message, scores="delta", prefetch=True, heartbeat=True)
+        if self.name:
+            message["name"] = self.name
+        await self.send(message)
+        return await self.pending_status
+
+    async def create(self) -> GameStatus:
+        '''Function for creating a new game room'''
+        return await self.request_status({"type": "create"})
+
+    async def join(self, game_id) -> GameStatus:
+        '''Function for joining an existing game room, the returned game_id is None if the room does not exist'''
+        return await self.request_status({"type": "connect", "game_id": game_id})
+
+    async def quick_play(self) -> GameStatus:
+        '''Function for asking the server to seat the player in any room, returns when a room is found'''
+        return await self.request_status({"type": "quick play"})
+
+    async def join_event(self, name) -> GameStatus:
+        '''Function for joining a scheduled event, the server seats the player in one of the rooms of the event'''
+        return await self.request_status({"type": "join event", "event": name})
+
+    async def spectate(self, game_id) -> GameStatus:
+        '''Function for watching a game without playing, the events are the same as for the players'''
+        return await self.request_status({"type": "spectate", "game_id": game_id})
+
+    async def ready(self):
+        '''Function for telling the server that the player is ready to start'''
+        await self.send({"type": "ready to start"})
+
+    async def answer(self, answer, round=None):
+        '''Function for answering a question (the last one by default) with the option index 0-3, None means no answer'''
+        round = self.current_round if round is None else round
+        self.answers[round] = answer
+        await self.send({"type": "answer", "round": round, "answer": answer})
+
+    async def events(self):
+        '''Function for iterating over the events of the game until it ends or the connection is lost'''
+        while True:
+            event = await self.events_queue.get()
+            yield event
+            if isinstance(event, (GameOver, ConnectionLost)):
+                return
+
+    async def close(self):
+        self.closed = True
+        if self.read_task:
+            self.read_task.cancel()
+        if self.writer:
+            self.writer.close()
+
+    async def read_messages(self):
+        try:
+            while True:
+                data = await self.reader.read(8192)
+                if not data:
+                    raise ConnectionResetError("Connection closed by server")
+                for message in self.codec.feed(data):
+                    self.handle_message(message)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            if self.pending_status and not self.pending_status.done():
+                self.pending_status.set_exception(self.busy or ConnectionResetError(str(e)))
+            if self.resuming or await self.resume_session():
+                return
+            self.events_queue.put_nowait(ConnectionLost(str(e)))
+
+    async def resume_session(self) -> bool:
+        '''Function for reconnecting after a dropped connection and taking the seat back, returns True on success'''
+        if not self.resume_token or self.game_id is None or self.game_over or self.closed or self.resume_window <= 0:
+            return False
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.resume_window
+        delay = 0.2
+        self.writer.close()
+        self.resuming = True
+        try:
+            while loop.time() < deadline and not self.closed:
+                try:
+                    self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+                    self.codec = WireCodec(self.codec.ask_binary)
+                    self.read_task = asyncio.create_task(self.read_messages())
+                    status = await self.request_status({"type": "resume", "game_id": self.game_id,
+                                                        "token": self.resume_token, "last_seq": self.seq})
+                    # the session is gone if the status has no game
+                    return status.game_id is not None
+                except OSError:
+                    pass    # the server is not reachable yet or busy, ServerBusy is an OSError as well
+                self.busy = None
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 2.0)
+            return False
+        finally:
+            self.resuming = False
+
+    def handle_message(self, message):
+        '''Function for updating the state of the game with a message from the server and producing its event'''
+        if message["type"] == "status":
+            status = GameStatus(message["player_id"], message["game_id"], list(message["list_of_players"]),
+                                message.get("encoding", "json"), message.get("spectator", False),
+                                message.get("event"), message.get("starts_in"))
+            if status.game_id is not None:
+                self.player_id, self.game_id, self.players = status.player_id, status.game_id, list(status.players)
+                self.resume_token = message.get("resume_token", self.resume_token)
+                self.seq = message.get("seq", 0)
+                self.current_round = message.get("round", self.current_round)    # spectators may come in the middle of a game
+                snapshot = message.get("snapshot")
+                if snapshot is not None:
+                    # Full scores on joining, the deltas of the following rounds are applied to them
+                    self.players = [player_id for player_id, _ in snapshot["players"]]
+                    self.scores = dict(snapshot["players"])
+                    self.deleted = dict(snapshot["left"])
+                    self.current_round = snapshot["round"]
+                elif not message.get("resumed"):
+                    self.scores = {player_id: 0 for player_id in self.players}
+                    self.deleted = {}
+            if self.pending_status and not self.pending_status.done():
+                self.pending_status.set_result(status)
+        elif message["type"] == "new player":
+            self.seq += 1
+            if message["player_id"] not in self.players:
+                self.players.append(message["player_id"])
+                self.scores.setdefault(message["player_id"], 0)
+                self.events_queue.put_nowait(PlayerJoined(message["player_id"]))
+        elif message["type"] == "question":
+            self.seq += 1
+            self.current_round = message["round"]
+            self.events_queue.put_nowait(QuestionAsked(message["round"], message["question"], list(message["options"]),
+                                                       message.get("sent_at")))
+        elif message["type"] == "prefetch":
+            # The question of the next round, it can only be read once the round starts
+            self.sealed[message["round"]] = message["payload"]
+        elif message["type"] == "reveal":
+            self.seq += 1
+            self.current_round = message["round"]
+            opened = open_sealed(self.sealed.pop(message["round"]), message["key"])
+            self.sealed = {round: payload for round, payload in self.sealed.items() if round > message["round"]}
+            self.events_queue.put_nowait(QuestionAsked(message["round"], opened["question"], list(opened["options"]),
+                                                       message.get("sent_at")))
+        elif message["type"] == "correct answer":
+            self.seq += 1
+            # Scores are listed in the order of the players that are still in the game
+            deleted = {pair["id"]: pair["score"] for pair in message.get("deleted_players") or []}
+            self.players = [player_id for player_id in self.players if player_id not in deleted]
+            scores = dict(zip(self.players, message["curr_score"]))
+            scored = [player_id for player_id, score in scores.items() if score > self.scores.get(player_id, 0)]
+            self.scores, self.deleted = scores, deleted
+            self.events_queue.put_nowait(RoundResult(self.current_round, message["correct_answ"],
+                                                     self.answers.get(self.current_round), dict(scores), dict(deleted), scored))
+        elif message["type"] == "round result":
+            self.seq += 1
+            # Only the changes of the round: who scored a point and who left with which score
+            for player_id, score in message["left"]:
+                self.scores.pop(player_id, None)
+                self.deleted[player_id] = score
+            if message["left"]:
+                self.players = [player_id for player_id in self.players if player_id in self.scores]
+            for player_id in message["scored"]:
+                self.scores[player_id] = self.scores.get(player_id, 0) + 1
+            self.events_queue.put_nowait(RoundResult(message["round"], message["correct_answ"],
+                                                     self.answers.get(message["round"]), dict(self.scores),
+                                                     dict(self.deleted), list(message["scored"])))
+        elif message["type"] == "standings":
+            self.seq += 1
+            self.events_queue.put_nowait(Standings(message["round"], message["players"],
+                                                   [tuple(pair) for pair in message["top"]], message["final"]))
+        elif message["type"] == "busy":
+            # The server refused the connection or dropped the last request
+            self.busy = ServerBusy(message.get("reason"), message.get("retry_after"))
+            if self.pending_status and not self.pending_status.done():
+                self.pending_status.set_exception(self.busy)
+        elif message["type"] == "ping":
+            # Heartbeat of the server, the pong is written without waiting for the buffer to drain
+            self.writer.write(self.codec.encode({"type": "pong", "seq": message["seq"]}))
+        elif message["type"] == "end game":
+            self.seq += 1
+            self.game_over = True
+            # The delta variant lists the final scores by player id, the full one in the order of the players
+            scores = dict(message["scores"]) if "scores" in message else dict(zip(self.players, message["curr_score"]))
+            self.events_queue.put_nowait(GameOver(message["winner"], scores))
+
+class ClientEntity:
+    '''Terminal UI of the game, a consumer of the events of QuizClient'''
+    def __init__(self, host=SERVER_HOST, port=SERVER_PORT, binary=False, name=None):
+        self.client = QuizClient(binary, name=name)
+        self.host = host
+        self.port = port
         self.colours = ["RED", "BLUE", "GREEN", "YELLOW", "PINK", "WHITE", "BLACK", "ORANGE", "CYAN", "LIME", "GREY", "CORAL", "BROWN", "AMBER", "OLIVE", "AQUA", "LAVA", "INDIGO", "RUST", "IVORY"]
-        self.wait_ready = True
-        self.final_answer = None
-        self.last_answer = None
-        self.prev_results = {}
         self.all_marks = [None, None, None, None, None]
+        self.input_buffer = b""   # typed bytes that do not make a full line yet
+        self.spectating = False   # the user watches a game without playing
 
-    def start(self):
-        '''Function for printing the starting information to the user'''
+    async def run(self):
+        '''Function for playing one game in the terminal'''
         try:
             # Connect to the server
-            self.sock.connect((SERVER_HOST, SERVER_PORT))
-        except ConnectionError as e:
+            await self.client.connect(self.host, self.port)
+        except OSError as e:
             print(f"Error connecting to server: {e}")
-            self.running = False
             return
 
+        try:
+            self.print_welcome()
+            status = await self.choose_room()
+            self.print_status(status)
+
+            # Wait till the user will be ready while the events of the room keep coming
+            # the rooms of an event start with the event, nobody needs to get ready
+            lobby = asyncio.create_task(self.wait_for_ready()) if not self.spectating and status.event is None else None
+            async for event in self.client.events():
+                if isinstance(event, PlayerJoined):
+                    self.handle_new_player(event)           # To get message about new player, that join to the game room
+                elif isinstance(event, QuestionAsked):
+                    await self.handle_question(event)       # To get question information from the server
+                elif isinstance(event, RoundResult):
+                    self.handle_correct_answer(event)       # To get message about correct answer
+                elif isinstance(event, Standings):
+                    self.handle_standings(event)            # To get the best players of all rooms of an event
+                elif isinstance(event, GameOver):
+                    self.handle_end_game(event)             # To get message about end game
+                elif isinstance(event, ConnectionLost):
+                    print("Connection to server lost")
+            if lobby:
+                lobby.cancel()
+        except ServerBusy as e:
+            print(f"Server is busy, try again in {e.retry_after} seconds")
+        except ConnectionError:
+            print("Connection to server lost")
+        finally:
+            await self.client.close()
+
+    def print_welcome(self):
+        '''Function for printing the starting information to the user'''
         # Print rectangle that using for customize the size of the terminal
         print("┌─ - - - - - - - - - - - - - - - - - - - - - - - ─ ┐")
         for i in range (33):
@@ -63,395 +536,255 @@ class ClientEntity:
         print()
         print("Choose an option:")
         print("1. Create a new game room")
-        print("2. Join an existing room\n")
+        print("2. Join an existing room")
+        print("3. Quick play")
+        print("4. Watch a game")
+        print("5. Join an event\n")
 
+    async def choose_room(self) -> GameStatus:
+        '''Function for creating a new game room or joining an existing one'''
         while True:
-            choice = input("Your choose: ").strip()
+            choice = (await self.read_line("Your choose: ")).strip()
             if choice == "1":
                 # create game room
-                self.create_game()
-                break
+                return await self.client.create()
             elif choice == "2":
-                # join game to existing game
-                self.join_game()
-                break
+                # join game to existing game, try again in case of incorrect room ID
+                while True:
+                    game_id = (await self.read_line("Enter room ID: ")).strip()
+                    status = await self.client.join(game_id)
+                    if status.game_id is not None:
+                        return status
+                    print("\nSorry, room does not exist... Try again.")
+            elif choice == "3":
+                # wait till the server finds a room
+                print("🔎 Looking for a room...")
+                return await self.client.quick_play()
+            elif choice == "4":
+                # watch a game in any state, try again in case of incorrect room ID
+                while True:
+                    game_id = (await self.read_line("Enter room ID: ")).strip()
+                    status = await self.client.spectate(game_id)
+                    if status.game_id is not None:
+                        self.spectating = True
+                        print("👀 You are watching the game")
+                        return status
+                    print("\nSorry, room does not exist... Try again.")
+            elif choice == "5":
+                # join a scheduled event, try again in case of incorrect event name
+                while True:
+                    name = (await self.read_line("Enter event name: ")).strip()
+                    status = await self.client.join_event(name)
+                    if status.game_id is not None:
+                        print(f"🎪 The event starts in {status.starts_in:.0f} seconds")
+                        return status
+                    print("\nSorry, event does not exist or already started... Try again.")
             else:
-                print("❌ Invalid choice. Please enter '1' or '2'")
+                print("❌ Invalid choice. Please enter '1', '2', '3', '4' or '5'")
+
+    async def read_line(self, prompt="", timeout=None):
+        '''Function for reading the user's input without blocking the event loop, returns None on timeout.
+        It uses "msvcrt" on Windows and the "select"-based reader of the event loop on Unix'''
+        print(prompt, end="", flush=True)
+        loop = asyncio.get_running_loop()
+        if sys.platform == "win32":
+            return await loop.run_in_executor(None, self.read_line_windows, timeout)
+        line = loop.create_future()
+        def on_input():
+            # The descriptor is read directly, the buffer of sys.stdin would hide lines from the event loop
+            data = os.read(sys.stdin.fileno(), 1024)
+            self.input_buffer += data if data else b"\n"
+            if b"\n" in self.input_buffer and not line.done():
+                text, self.input_buffer = self.input_buffer.split(b"\n", 1)
+                line.set_result(text.decode(errors="replace"))
+        if b"\n" in self.input_buffer:
+            text, self.input_buffer = self.input_buffer.split(b"\n", 1)
+            return text.decode(errors="replace")
+        loop.add_reader(sys.stdin.fileno(), on_input)
+        try:
+            return await asyncio.wait_for(line, timeout)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            loop.remove_reader(sys.stdin.fileno())
+
+    def read_line_windows(self, timeout):
+        '''Function for reading a line, or with a timeout one key press, on Windows'''
+        if timeout is None:
+            return input()
+        start_time = time.time()
+        while time.time() - start_time < timeout:
+            # "msvcrt.kbhit()" returns True if there is any input in the buffer
+            if msvcrt.kbhit():
+                # "msvcrt.getch()" returns one character from the buffer
+                return msvcrt.getch().decode()
+            time.sleep(0.05)
+        return None
 
-        # Create a thread for receiving all messages from the server
-        receiver_thread = threading.Thread(target=self.receive_messages)
-        receiver_thread.daemon = True
-        receiver_thread.start()
-    
     def get_name(self, ip):
         '''Function for getting the uniquename for the player by it's ID'''
         return f"{self.colours[ip % len(self.colours)]}_{ip}"
 
-    def create_game(self):
-        '''Function for creating a new game room by sending a json message to the server'''
-        message = {"type": "create"}
-        self.sock.send(json.dumps(message).encode())
-
-    def join_game(self):
-        '''Function for joining an existing game room by sending a json message to the server'''
-        game_id = input("Enter room ID: ").strip()
-        message = {
-            "type": "connect",
-            "game_id": game_id
-        }
-        self.sock.send(json.dumps(message).encode())
-
-    def handle_status(self, data):
-        '''Function that recieve data from the server about assigned to player ID, about room ID, and list of IDs of all players'''
-        self.player_id = data["player_id"]
-        self.game_id = data["game_id"]
-        self.players = data["list_of_players"]
-        
-        if self.game_id is None:
-            print("\nSorry, room does not exist... Try again.")
-            # Try to join another room in case of incorrect room ID
-            self.join_game()
-        else:
-            names = [self.get_name(player_id) for player_id in self.players]
-            
-            # Print information about the player's ID, rooms's ID and list of players in the room
-            print()
-            print("┌─────────────┬───────┬─────────────┬──────────────┐")
-            print(f"│   Room ID   │{self.game_id:^7}│  Your Name  │{self.get_name(self.player_id):^14}│")
-            print("└─────────────┴───────┴─────────────┴──────────────┘")
-            print("👥 Current players: ", ", ".join(map(str, names)))
-            print()
+    def print_status(self, status: GameStatus):
+        '''Function that prints the assigned player ID, room ID, and the list of all players'''
+        names = [self.get_name(player_id) for player_id in status.players]
 
-            # Wait till the user will be ready to start the game
-            self.wait_for_ready()
-
-    def wait_for_ready(self):
-        '''Function for waiting till the user will be ready to start the game. And handle messages from the server about new players, that join to the game room'''
-        def receive_players():
-            try:
-                while self.wait_ready:
-                    # Receive messages from the server
-                    data = self.sock.recv(8192)
-                    if not data:
-                        break
-                    message = json.loads(data.decode())
-                    if message["type"] == "new player":
-                        self.handle_new_player(message)
-                    elif message["type"] == "question":
-                        self.handle_question(message)
-                    else:
-                        print("Вы попали...")
-            except Exception as e:
-                self.running = False
-
-        # Start thread for receiving new players
-        self.wait_ready = True
-        thread = threading.Thread(target=receive_players)
-        thread.start()
-
-        # Wait till the user will be ready
-        input("Press ENTER to get READY\n").strip()
-
-        # Stop receiving new players
-        self.wait_ready = False
+        # Print information about the player's ID, rooms's ID and list of players in the room
+        print()
+        print("┌─────────────┬───────┬─────────────┬──────────────┐")
+        print(f"│   Room ID   │{status.game_id:^7}│  Your Name  │{self.get_name(status.player_id):^14}│")
+        print("└─────────────┴───────┴─────────────┴──────────────┘")
+        print("👥 Current players: ", ", ".join(map(str, names)))
+        print()
 
+    async def wait_for_ready(self):
+        '''Function for waiting till the user will be ready to start the game'''
+        await self.read_line("Press ENTER to get READY\n")
         # Send message to the server about readiness
-        message = {"type": "ready to start"}
-        self.sock.send(json.dumps(message).encode())
+        await self.client.ready()
         print("⏳ Waiting for other players to be ready...\n")
 
-        thread.join()
-
-    def handle_new_player(self, data):
+    def handle_new_player(self, event: PlayerJoined):
         '''Function for handling messages from the server about new players, that join to the game room'''
-        self.players.append(data["player_id"])
-        print(f"\n▶︎ New player joined: {self.get_name(data['player_id'])}")
-
-    def handle_question(self, data):
-        '''Function for recieving questions from the server and sending user's answers to the server'''
-        self.current_round = data["round"]
+        print(f"\n▶︎ New player joined: {self.get_name(event.player_id)}")
 
+    async def handle_question(self, event: QuestionAsked):
+        '''Function for showing the question and sending user's answer to the server'''
         # Print the question and options
         print("\n"*23)
-        print(f"\n\n\n\n\n\n\n\n\n================= 🎯 ROUND {self.current_round + 1}/5 🎯 ==================")
-        print(data["question"])
+        print(f"\n\n\n\n\n\n\n\n\n================= 🎯 ROUND {event.round + 1}/5 🎯 ==================")
+        print(event.question)
         print("====================================================")
-        for i, option in enumerate(data["options"]):
+        for i, option in enumerate(event.options):
             print(f"{i+1}. {option}")
         print()
+        if self.spectating:
+            print("👀 The players are answering...")
+            return
 
-        self.final_answer = None
-
-        def input_thread():
-            '''Function for getting user's answer by non-blocking input. To achieve this function uses "select" and "msvcrt" modules for Windows and Unix respectively'''
-
-            # Windows: use "msvcrt" (this is for non-blocking input)
-            if sys.platform == "win32":
-                print("⌛ Press 1-4 within 30 seconds:")
-                start_time = time.time()
-                while True:
-                    # "msvcrt.kbhit()" returns True if there is any input in the buffer
-                    if msvcrt.kbhit():
-                        # "msvcrt.getch()" returns one character from the buffer
-                        answer = msvcrt.getch().decode()
-                        if answer in ["1", "2", "3", "4"]:
-                            self.final_answer = answer
-                            print("Your answer: " + answer)
-                            break
-                        else:
-                            print("❌ Invalid answer, not accepted")
-                            break
-                    
-                    # Check if the time has exceeded (basically there are 30 seconds to answer)
-                    if time.time() - start_time > 30:
-                        print("⏰ Time's up! Answer not accepted.")
-                        break
-
-            # Unix (Mac/Linux): use "select" (this is for non-blocking input)
-            else:
-                print("⌛ Enter your answer within 30 seconds (1-4):")
-                # "select" is used to check if there is any input in the buffer with timeout of 30 seconds
-                rlist, _, _ = select.select([sys.stdin], [], [], 30.0)
-                # If there is no input in the buffer for 30 seconds —> time's up
-                if not rlist:
-                    print("⏰ Time's up! Answer not accepted.")
-                    return
-                # If there is input in the buffer —> get it
-                answer = sys.stdin.readline().rstrip('\n')
-                if answer in ["1", "2", "3", "4"]:
-                    self.final_answer = answer
-                    print("Your answer: " + answer)
-                else:
-                    print("❌ Invalid answer, not accepted")
-
-        # Start thread for non-blocking input 
-        thread = threading.Thread(target=input_thread)
-        thread.daemon = True
-        thread.start()
-        thread.join()
-        print("====================================================")
-        
-        if self.final_answer is None:
-            # If the user didn't answer within 30 seconds —> send timeout answer
-            self.send_timeout_answer()
+        # There are 30 seconds to answer
+        if sys.platform == "win32":
+            answer = await self.read_line("⌛ Press 1-4 within 30 seconds:\n", timeout=30)
         else:
-            # If the user answered within 30 seconds —> send answer
-            self.send_answer(self.final_answer)
-
-    def send_timeout_answer(self):
-        '''Function for sending json message to tell about timeout to the server'''
-        message = {
-            "type": "answer",
-            "round": self.current_round,
-            "answer": None
-        }
-        self.sock.send(json.dumps(message).encode())
-        self.last_answer = None
-
-    def send_answer(self, answer):
-        '''Function for sending json message to tell about user's answer to the server'''
-        answer_num = int(answer) - 1 
-        self.last_answer = answer_num + 1
-        
-        message = {
-            "type": "answer",
-            "round": self.current_round,
-            "answer": answer_num
-        }
-        self.sock.send(json.dumps(message).encode())
-    
-    def handle_correct_answer(self, data):
-        '''Function for recieving correct answer from the server'''
-        correct_answ = data["correct_answ"]
-        curr_score = data["curr_score"]
-        deleted_players = data["deleted_players"]
-        
-        # Check that the answer is correct by comparing users answer with the correct answer from the server
-        if (self.last_answer != None):
-            your_res = self.last_answer == correct_answ
+            answer = await self.read_line("⌛ Enter your answer within 30 seconds (1-4):\n", timeout=30)
+        if answer is None:
+            print("⏰ Time's up! Answer not accepted.")
+        elif answer in ["1", "2", "3", "4"]:
+            print("Your answer: " + answer)
         else:
-            your_res = False
-        # Check that the answer was giver (not None)
-        if self.last_answer == None:
-            y_ans = "–"
-        else:
-            y_ans = self.last_answer
+            print("❌ Invalid answer, not accepted")
+            answer = None
+        print("====================================================")
+
+        # A missing answer is sent as None to tell about timeout to the server
+        try:
+            await self.client.answer(None if answer is None else int(answer) - 1, event.round)
+        except ConnectionError:
+            pass    # the game may be over already, the remaining events tell what happened
+
+    def handle_correct_answer(self, event: RoundResult):
+        '''Function for printing the correct answer and the current results'''
+        correct_answ = event.correct_answer
+        y_ans = "–" if event.your_answer is None else event.your_answer + 1
         # If the answer is correct —> print "✅", else "❌"
-        if your_res:
-            res = "✅"
-        else:
-            res = "❌"
-        # Print the result
+        res = "✅" if event.your_answer is not None and event.your_answer + 1 == correct_answ else "❌"
+        # Print the result, spectators only see the correct answer
         print()
-        print("┌─────────────┬───┬────────────────┬───┬────────┬──┐")
-        print(f"│ Your Answer │ {y_ans:^1} │ Correct Answer │ {correct_answ:^1} │ Result │{res}│")
-        print("└─────────────┴───┴────────────────┴───┴────────┴──┘")
+        if self.spectating:
+            print(f"✔️  Correct answer: {correct_answ}")
+        else:
+            print("┌─────────────┬───┬────────────────┬───┬────────┬──┐")
+            print(f"│ Your Answer │ {y_ans:^1} │ Correct Answer │ {correct_answ:^1} │ Result │{res}│")
+            print("└─────────────┴───┴────────────────┴───┴────────┴──┘")
         print()
-        # If some players were disconnected from the game room —> remove them from the list of players
-        if deleted_players != None:
-            for pair in deleted_players:
-                player_id = pair['id']
-                if player_id in self.players:
-                    self.players.remove(player_id)
-        
-        # save the results of the current round
-        mark_res = {}
-        if self.current_round == 0:                     # if it's the first round
-            for i, score in enumerate(curr_score):      # for each online player
-                if score == 0:
-                    mark_res[self.players[i]] = "❌"
-                else:
-                    mark_res[self.players[i]] = "✅"
-            if deleted_players:                         # for each disconnected player
-                for pair in deleted_players:
-                    if pair['score'] == 0:
-                        mark_res[pair['id']] = "❌"
-                    else:
-                        mark_res[pair['id']] = "✅"
-        else:                                           # if it's not the first round
-            for i, score in enumerate(curr_score):      # for each online player
-                if self.prev_results[self.players[i]] == score:     # score changed -> mark "❌", else "✅"
-                    mark_res[self.players[i]] = "❌"
-                else:
-                    mark_res[self.players[i]] = "✅"
-            if deleted_players:                         # for each disconnected player
-                for pair in deleted_players:
-                    if self.prev_results[pair['id']] == pair['score']:
-                        mark_res[pair['id']] = "❌"
-                    else:
-                        mark_res[pair['id']] = "✅"
-        # save the results of the round for the futher use
-        self.all_marks[self.current_round] = mark_res
-        
-        # update the list of scores with current data for using it in the next round to compare with the new scores and understand which players earned points
-        for i, score in enumerate(curr_score):
-            self.prev_results[self.players[i]] = score
-        if deleted_players:
-            for pair in deleted_players:
-                self.prev_results[pair['id']] = pair['score']
+
+        # save the results of the current round, the players that scored are listed by id
+        scored = set(event.scored)
+        self.all_marks[event.round] = {
+            player_id: "✅" if player_id in scored else "❌"
+            for player_id in {**event.scores, **event.deleted_players}
+        }
+
+        def row(player_id, score):
+            marks = ' │ '.join('--' if marks is None else marks.get(player_id, '--') for marks in self.all_marks)
+            return f"│{self.get_name(player_id):^14}│ {marks} │{score:^10}│"
 
         # print the current results
         print("┌──────────────────────────────────────────────────┐")
         print("│                 CURRENT RESULTS                  │")
         print("├──────────────┬────┬────┬────┬────┬────┬──────────┤")
-        for i, score in enumerate(curr_score):
-            print(
-                f"│{self.get_name(self.players[i]):^14}│ "
-                f"{'--' if self.all_marks[0] is None else self.all_marks[0][self.players[i]]} │ "
-                f"{'--' if self.all_marks[1] is None else self.all_marks[1][self.players[i]]} │ "
-                f"{'--' if self.all_marks[2] is None else self.all_marks[2][self.players[i]]} │ "
-                f"{'--' if self.all_marks[3] is None else self.all_marks[3][self.players[i]]} │ "
-                f"{'--' if self.all_marks[4] is None else self.all_marks[4][self.players[i]]} │"
-                f"{score:^10}│"
-            )
-            if i != len(curr_score) - 1:
+        scores = list(event.scores.items())
+        for i, (player_id, score) in enumerate(scores):
+            print(row(player_id, score))
+            if i != len(scores) - 1:
                 print("├──────────────┼────┼────┼────┼────┼────┼──────────┤")
-            elif i == len(curr_score) - 1 and not deleted_players:
+            elif not event.deleted_players:
                 print("└──────────────┴────┴────┴────┴────┴────┴──────────┘")
             else:
                 print("├──────────────┴────┴────┴────┴────┴────┴──────────┤") 
         # print the disconnected players in case if they are exist
-        if deleted_players:
+        if event.deleted_players:
             print("│              DISCONNECTED PLAYERS                │")
             print("├──────────────┬────┬────┬────┬────┬────┬──────────┤")
-            for pair in deleted_players:
-                print(
-                    f"│{self.get_name(pair['id']):^14}│ "
-                    f"{'--' if self.all_marks[0] is None else self.all_marks[0][pair['id']]} │ "
-                    f"{'--' if self.all_marks[1] is None else self.all_marks[1][pair['id']]} │ "
-                    f"{'--' if self.all_marks[2] is None else self.all_marks[2][pair['id']]} │ "
-                    f"{'--' if self.all_marks[3] is None else self.all_marks[3][pair['id']]} │ "
-                    f"{'--' if self.all_marks[4] is None else self.all_marks[4][pair['id']]} │"
-                    f"{pair['score']:^10}│"
-                )
-                if deleted_players.index(pair) != len(deleted_players) - 1:
+            deleted = list(event.deleted_players.items())
+            for i, (player_id, score) in enumerate(deleted):
+                print(row(player_id, score))
+                if i != len(deleted) - 1:
                     print("├──────────────┼────┼────┼────┼────┼────┼──────────┤")
-                elif deleted_players.index(pair) == len(deleted_players) - 1:
+                else:
                     print("└──────────────┴────┴────┴────┴────┴────┴──────────┘")
 
-    def handle_end_game(self, data):
-        '''Function for recieving the end game message with data about final scores of players'''
+    def handle_standings(self, event: Standings):
+        '''Function for printing the best players of all rooms of the event'''
+        title = "FINAL STANDINGS" if event.final else "EVENT STANDINGS"
+        print("┌──────────────────────────────────────────────────┐")
+        print(f"│{title + f' ({event.players} players)':^50}│")
+        print("├──────┬───────────────────────────────┬───────────┤")
+        for place, (player_id, score) in enumerate(event.top, 1):
+            print(f"│{place:^6}│{self.get_name(player_id):^31}│{score:^11}│")
+        print("└──────┴───────────────────────────────┴───────────┘")
+        print()
+
+    def handle_end_game(self, event: GameOver):
+        '''Function for printing the end game message with data about final scores of players'''
         # print the end game message
         print("\n\n\n")
         print("- - - - - - - - - - - - - - - - - - - - - - - - - - ")
         print("🏁                The Game Is Over!               🏁")
         print("- - - - - - - - - - - - - - - - - - - - - - - - - - ")
         print()
+        if not event.scores:
+            return
         # find the winner/winners
-        max_score = max(data["curr_score"])
-        winners = [i for i, score in enumerate(data["curr_score"]) if score == max_score]
-        
+        max_score = max(event.scores.values())
+        winners = [self.get_name(player_id) for player_id, score in event.scores.items() if score == max_score]
+
         # print the winner/winners
         if len(winners) == 1:
-            print(f"               🏆 Player {self.get_name(self.players[winners[0]])} WIN!\n\n")
+            print(f"               🏆 Player {winners[0]} WIN!\n\n")
         else:
-            for i in winners:
-                winners[i] = self.get_name(self.players[i])
-            print("🏆 Draw Between:", ", ".join(map(str, winners)))
+            print("🏆 Draw Between:", ", ".join(winners))
             print()
-        
-        self.running = False
-
-    def receive_messages(self):
-        '''Function for recieving ALL messages from the server'''
-        buffer = b""
-        while self.running:
-            try:
-                # Receive data from the server
-                data = self.sock.recv(8192)
-                if not data:
-                    break
-                
-                buffer += data
-                
-                # Process all complete messages in the buffer and split them by "\n"
-                while b'\n' in buffer:
-                    message_part, buffer = buffer.split(b'\n', 1)
-                    if not message_part:
-                        continue
-                        
-                    try:
-                        message = json.loads(message_part.decode())
-                        
-                        # Handle messages
-                        if message["type"] == "status":
-                            self.handle_status(message)             # To get response after creating new game room or joining to existing
-                        elif message["type"] == "new player":
-                            self.handle_new_player(message)         # To get message about new player, that join to the game room
-                        elif message["type"] == "question":
-                            self.handle_question(message)           # To get question information from the server
-                        elif message["type"] == "correct answer":
-                            self.handle_correct_answer(message)     # To get message about correct answer
-                        elif message["type"] == "end game":
-                            self.handle_end_game(message)           # To get message about end game
-                            
-                    except json.JSONDecodeError as e:
-                        print(f"Failed to decode server message: {e}")
-                        print(f"Raw message: {message_part}")
-                        self.running = False
-                        break
-                        
-            except ConnectionResetError:
-                print("Connection to server lost")
-                self.running = False
-            except Exception as e:
-                print(f"Unexpected error: {e}")
-                self.running = False
-
-    def cleanup(self):
-        '''Function for closing the socket'''
-        self.sock.close()
 
 def main():
-    client = ClientEntity()
+    parser = argparse.ArgumentParser(description='Terminal client of the TCP quiz game')
+    parser.add_argument('--host', default=SERVER_HOST)
+    parser.add_argument('--port', type=int, default=SERVER_PORT)
+    # Ask the server for the compact binary encoding, old servers keep json
+    parser.add_argument('--binary', action='store_true', help='use the compact binary encoding instead of json')
+    parser.add_argument('--name', help='name of the player on the leaderboards, without it the results are anonymous')
+    args = parser.parse_args()
+
+    # Set the size of the terminal for a comfortable game
+    if sys.platform == "win32":
+        os.system(f'mode con: cols=52 lines=35')
+    else:
+        print("\x1b[8;35;52t")
+
     try:
-        client.start()
-        while client.running:
-            time.sleep(0.1)
+        asyncio.run(ClientEntity(args.host, args.port, args.binary, args.name).run())
     except KeyboardInterrupt:
         print("\n🚫 Game interrupted by user")
-    finally:
-        client.cleanup()
 
 if __name__ == "__main__":
     main()
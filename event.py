@@ -0,0 +1,249 @@
+import heapq
+import threading
+import time
+
+from metrics import REGISTRY
+from prefetch import seal_question
+from structured_log import get_logger
+
+log = get_logger('event')
+
+EVENT_ROUND_OPEN_SECONDS = REGISTRY.histogram('quiz_event_round_open_seconds', 'Time to open a round in all rooms of an event')
+EVENT_STANDINGS_SECONDS = REGISTRY.histogram('quiz_event_standings_seconds', 'Time to roll up the standings of all rooms of an event')
+
+
+def parse_event(text: str):
+    ''' The function parses NAME@SECONDS of the --event option into (name, seconds until the start) '''
+    name, sep, delay = text.rpartition('@')
+    if not sep or not name:
+        raise ValueError(f"Event must be NAME@SECONDS, got {text!r}")
+    return name, float(delay)
+
+
+class Event:
+    ''' A scheduled game played in many rooms at once.
+
+    Players join the event instead of a room and are seated in rooms of room_size
+    players. The questions are drawn and sealed once for the whole event, and the
+    conductor opens every round in all rooms at the same time. The frames of the
+    question, its reveal and the standings are the same in every room, so they are
+    encoded once per wire encoding and the rooms queue the same bytes. A room closes
+    its round when its players answered, the round of the event closes when every
+    room closed it or the time is up. The scores of all rooms are then rolled up into
+    one standings table that every room gets. Each room still sends its own round
+    results and end game, and stores its results like any other game. '''
+
+    def __init__(self, conductor, name, starts_at, questions):
+        self.conductor = conductor
+        self.server = conductor.server
+        self.name = name # name the players join the event with
+        self.starts_at = starts_at # wall clock time of the first round
+        self.room_size = conductor.room_size # players per room
+        self.delay_between_questions = conductor.delay_between_questions
+        self.round_time_limit = conductor.round_time_limit
+        self.questions = questions # the questions of every room
+        # sealed up front, so every room prefetches and reveals with the same keys
+        self.sealed = [seal_question(index, q.question, q.options) for index, q in enumerate(questions)]
+        self.games = [] # rooms of the event
+        self.open_room = None # room that new players are seated in
+        self.state = 'waiting' # waiting, playing or finished
+        self.round = 0 # number of rounds opened so far
+        self.round_open = False # whether the current round is open in some room
+        self.round_started_at = 0 # wall clock time the current round was opened at, the same in every room
+        self.pending = set() # rooms whose current round is still open
+        self.frames = {} # (codec, variant) -> encoded frame of the current question, shared by all rooms
+        self.timer = None # handle of the start, the round deadline or the pause between rounds
+        self.lock = threading.Lock() # guards the fields of the event, taken before a game lock but never while one is held
+
+    def live_games(self):
+        return [game for game in self.games if self.server.games.get(game.id) is game]
+
+    def seat(self, player, request: dict):
+        ''' The function seats the player in the open room of the event or in a new one and sends the status,
+        returns the id of the room or None if the event already started '''
+        with self.lock:
+            if self.state != 'waiting':
+                return None
+            game = self.open_room
+            if game is None or self.server.games.get(game.id) is not game or len(game.players) >= self.room_size:
+                game_id, _ = self.server.createGame(player, event=self)
+                game = self.open_room = self.server.games[game_id]
+                self.games.append(game)
+                list_players = [player.id]
+            else:
+                game_id, _, list_players = self.server.connectGame(game.id, player, event=self)
+                if game_id is None:
+                    return None
+            answer = {
+                "type": "status",
+                "player_id": player.id,
+                "game_id": game.id,
+                "list_of_players": list_players,
+                "event": self.name,
+                "starts_in": round(max(0.0, self.starts_at - self.server.clock.time()), 1)
+            }
+            self.server.send_status(player, game.id, request, answer)
+            return game.id
+
+    def start(self):
+        with self.lock:
+            if self.state != 'waiting':
+                return
+            self.state = 'playing'
+            rooms = len(self.live_games())
+        log.info("event starting", event_name=self.name, rooms=rooms)
+        self.next_round()
+
+    def next_round(self):
+        ''' The function opens the next round in every room of the event '''
+        started = time.perf_counter()
+        with self.lock:
+            if self.state != 'playing':
+                return
+            self.games = games = self.live_games()
+            if not games:
+                self.finish()
+                return
+            self.round += 1
+            self.round_open = True
+            self.round_started_at = self.server.clock.time()
+            self.frames = {}
+            self.pending = set(games)
+            round_count = self.round
+            self.timer = self.server.call_later(self.round_time_limit, lambda: self.close_round(round_count))
+        for game in games:
+            # the first round starts the rooms, which only the conductor does
+            if game.game_state == 'waiting':
+                game.start_game()
+            else:
+                game.next_round()
+        EVENT_ROUND_OPEN_SECONDS.observe(time.perf_counter() - started)
+        log.info("event round opened", event_name=self.name, round=round_count - 1, rooms=len(games))
+
+    def room_closed(self, game):
+        ''' A room closed its round. Called under the lock of the room, so the rest runs later on the scheduler '''
+        round_count = game.current_round
+        self.server.call_later(0, lambda: self.room_done(game, round_count))
+
+    def room_done(self, game, round_count):
+        with self.lock:
+            if round_count != self.round or not self.round_open:
+                return
+            self.pending.discard(game)
+            # rooms whose players all left never close their round
+            done = not any(self.server.games.get(room.id) is room for room in self.pending)
+        if done:
+            self.close_round(round_count)
+
+    def close_round(self, round_count):
+        ''' The function closes the round in the rooms that are still open, sends the standings and
+        schedules the next round or ends the event '''
+        with self.lock:
+            if round_count != self.round or not self.round_open:
+                return
+            self.round_open = False
+            if self.timer:
+                self.timer.cancel()
+            games = self.live_games()
+        for game in games:
+            game.handle_all_answered() # the time is up in the rooms that did not close the round themselves
+        last = round_count >= len(self.questions)
+        self.broadcast(games, self.standings(games, last))
+        if last:
+            for game in games:
+                game.end_game()
+            with self.lock:
+                self.finish()
+            return
+        frames = {}
+        for game in games:
+            with game.lock:
+                game.send_prefetch(list(game.players) + list(game.spectators.values()), frames)
+        with self.lock:
+            if self.state == 'playing':
+                self.timer = self.server.call_later(self.delay_between_questions, self.next_round)
+
+    def standings(self, games, final) -> dict:
+        ''' The function ranks the players of all rooms like a single game ranks its players '''
+        started = time.perf_counter()
+        entries = []
+        for game in games:
+            with game.lock:
+                board = game.board
+                seats = [p.seat for p in game.players]
+                entries.extend(zip([-score for score in board.scores_of(seats)],
+                                   [board.correct_time_of(seat) for seat in seats],
+                                   [p.id for p in game.players]))
+        top = heapq.nsmallest(self.conductor.top, entries)
+        EVENT_STANDINGS_SECONDS.observe(time.perf_counter() - started)
+        return {
+            'type': 'standings',
+            'round': self.round - 1,
+            'players': len(entries),
+            'top': [[player_id, -score] for score, _, player_id in top],
+            'final': final
+        }
+
+    def broadcast(self, games, message):
+        ''' The function queues the same message in every room, it is encoded once per wire encoding '''
+        frames = {}
+        for game in games:
+            with game.lock:
+                game.broadcast(message, frames=frames)
+
+    def finish(self):
+        self.state = 'finished'
+        if self.timer:
+            self.timer.cancel()
+        self.conductor.events.pop(self.name, None)
+        log.info("event finished", event_name=self.name, rounds=self.round)
+
+
+class Conductor:
+    ''' Scheduled events of the server, see Event '''
+
+    def __init__(self, server, room_size=100, top=10, delay_between_questions=6, round_time_limit=40):
+        self.server = server # server that creates the rooms
+        self.room_size = room_size # players per room of an event
+        self.top = top # players listed in the standings
+        self.delay_between_questions = delay_between_questions
+        self.round_time_limit = round_time_limit
+        self.events = {} # name -> Event that did not finish yet
+        self.started = False # whether the server runs, events scheduled before wait for it
+        self.lock = threading.Lock()
+        REGISTRY.gauge('quiz_event_rooms', 'Rooms of the events that did not finish',
+                       callback=lambda: sum(len(event.games) for event in list(self.events.values())))
+
+    def start(self):
+        ''' The server runs, the events scheduled before are armed '''
+        with self.lock:
+            self.started = True
+            events = list(self.events.values())
+        for event in events:
+            self.arm(event)
+
+    def arm(self, event):
+        with event.lock:
+            if event.timer is None and event.state == 'waiting':
+                event.timer = self.server.call_later(max(0.0, event.starts_at - self.server.clock.time()), event.start)
+
+    def schedule(self, name, start_in, rounds=5) -> Event:
+        ''' The function draws the questions of a new event that starts after start_in seconds '''
+        with self.lock:
+            if name in self.events:
+                raise ValueError(f"Event {name!r} is already scheduled")
+            questions = self.server.question_bank.draw(rounds, rng=self.server.rng)
+            event = self.events[name] = Event(self, name, self.server.clock.time() + start_in, questions)
+            started = self.started
+        if started:
+            self.arm(event)
+        log.info("event scheduled", event_name=name, start_in=start_in, rounds=rounds)
+        return event
+
+    def join(self, player, request: dict):
+        ''' The function seats the player in a room of the requested event, returns the id of the room or None '''
+        with self.lock:
+            event = self.events.get(request.get('event'))
+        if event is None:
+            return None
+        return event.seat(player, request)
@@ -0,0 +1,107 @@
+import json
+from collections import deque
+
+DEFAULT_MAX_FRAME_SIZE = 64 * 1024 # largest accepted message in bytes
+
+_JSON = json.JSONDecoder()
+
+
+class FrameTooLarge(ValueError):
+    ''' Raised when a peer sends a message bigger than the configured limit '''
+
+
+class FrameDecoder:
+    ''' Incremental decoder for newline-delimited json messages of one connection.
+
+    Bytes from every read are appended to one reusable buffer. Complete frames are
+    parsed in place and the consumed prefix is dropped only once it makes up half of
+    the buffer, so a read never re-copies the whole pending data. '''
+
+    def __init__(self, max_frame_size=DEFAULT_MAX_FRAME_SIZE):
+        self.max_frame_size = max_frame_size
+        self.buffer = bytearray() # received bytes that are not parsed yet
+        self.start = 0 # offset of the first unconsumed byte in the buffer
+        self.scanned = 0 # offset up to which the buffer was already searched for a delimiter
+        self.messages = deque() # decoded messages waiting to be handled
+
+    def feed(self, data: bytes) -> int:
+        ''' The function adds received bytes and decodes every complete frame, returns the number of new messages '''
+        self.buffer += data
+        decoded = 0
+        while True:
+            end = self.buffer.find(b'\n', max(self.start, self.scanned))
+            if end == -1:
+                break
+            if end - self.start > self.max_frame_size:
+                raise FrameTooLarge(f"Frame of {end - self.start} bytes exceeds {self.max_frame_size}")
+            frame = self.buffer[self.start:end]
+            self.start = end + 1
+            if frame.strip():
+                self.messages.append(json.loads(frame))
+                decoded += 1
+        self.scanned = len(self.buffer)
+
+        pending = len(self.buffer) - self.start
+        if pending > self.max_frame_size:
+            raise FrameTooLarge(f"Unterminated frame of {pending} bytes exceeds {self.max_frame_size}")
+        # old clients send one json object per write without a delimiter
+        if pending and self.buffer.endswith(b'}'):
+            decoded += self.decode_undelimited()
+        self.compact()
+        return decoded
+
+    def decode_undelimited(self) -> int:
+        ''' The function decodes the json objects of old clients at the end of the buffer, several writes may arrive
+        together as {..}{..}, an incomplete last object stays in the buffer '''
+        try:
+            text = self.buffer[self.start:].decode()
+        except UnicodeDecodeError:
+            return 0 # a multi-byte character is split, the rest follows
+        pos = decoded = 0
+        while True:
+            while pos < len(text) and text[pos].isspace():
+                pos += 1
+            if pos == len(text):
+                break
+            try:
+                message, pos = _JSON.raw_decode(text, pos)
+            except json.JSONDecodeError as e:
+                if e.pos < len(text) and not e.msg.startswith('Unterminated string'):
+                    raise # not the start of an object that is still arriving
+                break
+            self.messages.append(message)
+            decoded += 1
+        self.start += len(text[:pos].encode())
+        return decoded
+
+    def compact(self):
+        ''' The function drops the consumed prefix once it takes at least half of the buffer '''
+        if self.start and self.start * 2 >= len(self.buffer):
+            del self.buffer[:self.start]
+            self.scanned -= self.start
+            self.start = 0
+
+    def take_pending(self):
+        ''' The function removes and returns the decoded messages and the unparsed bytes, so another decoder can continue '''
+        messages = list(self.messages)
+        data = bytes(self.buffer[self.start:])
+        self.messages.clear()
+        self.buffer = bytearray()
+        self.start = self.scanned = 0
+        return messages, data
+
+    def restore(self, messages, data: bytes):
+        ''' The function puts back input taken from another decoder '''
+        self.messages.extend(messages)
+        if data:
+            self.feed(data)
+
+    def unread(self, message):
+        ''' The function puts a message back so that it is returned next '''
+        self.messages.appendleft(message)
+
+    def next_message(self):
+        ''' The function returns the next decoded message or None if there is no complete one '''
+        if self.messages:
+            return self.messages.popleft()
+        return None
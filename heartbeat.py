@@ -0,0 +1,106 @@
+import threading
+
+from metrics import REGISTRY
+from structured_log import get_logger
+
+log = get_logger('heartbeat')
+
+HEARTBEAT_RTT_SECONDS = REGISTRY.histogram('quiz_heartbeat_rtt_seconds', 'Round trip time of ping/pong heartbeats',
+                                           buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0))
+CONNECTIONS_REAPED = REGISTRY.counter('quiz_connections_reaped_total', 'Connections closed by the idle reaper', ('reason',))
+
+
+class Heartbeat:
+    ''' Ping/pong heartbeats and the reaper of idle connections.
+
+    Every interval seconds one sweep pings the tracked connections whose client asked for
+    heartbeats with "heartbeat": true in its handshake and measures the round trip time of
+    the pongs. A connection that sent nothing, not even a pong, for
+    idle_timeout seconds is treated as half-open and disconnected, so its seat, its
+    answer of the open round and its reader are released at once instead of when the
+    round timer fires. A connection that has not joined a game lobby_timeout seconds
+    after its last request is disconnected too. Peers that did not ask for heartbeats, or
+    never answered a ping, are only reaped after lobby_timeout seconds of silence, and not
+    at all while they are seated in a room that waits for players, which older clients
+    may do for as long as it takes their friends to join. '''
+
+    def __init__(self, server, interval=5.0, idle_timeout=30.0, lobby_timeout=120.0):
+        self.server = server # server that disconnects the reaped players
+        self.interval = interval # seconds between two sweeps, 0 disables heartbeats
+        self.idle_timeout = idle_timeout # seconds of silence after which a connection is dead
+        self.lobby_timeout = lobby_timeout # seconds a connection may stay in the lobby without joining a game
+        self.players = {} # player id -> Player of the open connections
+        self.timer = None # handle of the next sweep
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.interval <= 0 or self.timer:
+                return
+            self.timer = self.server.call_later(self.interval, self.sweep)
+
+    def track(self, player):
+        now = self.server.clock.monotonic()
+        player.last_seen = player.last_request = now
+        with self.lock:
+            self.players[player.id] = player
+
+    def forget(self, player):
+        with self.lock:
+            # a resumed session reuses the id of the player it replaces
+            if self.players.get(player.id) is player:
+                del self.players[player.id]
+
+    def pong(self, player, message: dict):
+        ''' The function measures the round trip time of the last ping, late pongs of older pings are ignored '''
+        if message.get('seq') != player.ping_seq or not player.ping_sent_at:
+            return
+        rtt = self.server.clock.monotonic() - player.ping_sent_at
+        player.ping_sent_at = 0
+        # smoothed like the srtt of tcp
+        player.rtt = rtt if player.rtt is None else player.rtt + (rtt - player.rtt) / 8
+        HEARTBEAT_RTT_SECONDS.observe(rtt)
+
+    def sweep(self):
+        ''' The function pings every connection and reaps the idle ones, then schedules the next sweep '''
+        now = self.server.clock.monotonic()
+        with self.lock:
+            # the next sweep is scheduled first, so a failing sweep never stops the heartbeats
+            self.timer = self.server.call_later(self.interval, self.sweep)
+            players = list(self.players.values())
+        reaped = []
+        for player in players:
+            if not player.socket:
+                self.forget(player) # closed or handed off
+                continue
+            silence = self.idle_timeout if player.rtt is not None else self.lobby_timeout
+            if now - player.last_seen > silence and not self.waiting_without_heartbeats(player):
+                reaped.append((player, 'idle'))
+            elif player.game_id is None and now - player.last_request > self.lobby_timeout:
+                reaped.append((player, 'lobby'))
+            elif player.heartbeat:
+                self.ping(player, now)
+        for player, reason in reaped:
+            self.reap(player, reason, now)
+
+    def waiting_without_heartbeats(self, player) -> bool:
+        ''' The function returns True for a client without heartbeats that is seated in a room waiting for players '''
+        if player.rtt is not None or player.game_id is None:
+            return False
+        game = self.server.games.get(player.game_id)
+        return game is not None and game.game_state == 'waiting'
+
+    def ping(self, player, now):
+        player.ping_seq += 1
+        player.ping_sent_at = now
+        player.send_message({'type': 'ping', 'seq': player.ping_seq})
+
+    def reap(self, player, reason, now):
+        CONNECTIONS_REAPED.inc(reason)
+        log.info("connection reaped", game_id=player.game_id, player_id=player.id, reason=reason,
+                 idle=round(now - player.last_seen, 1))
+        self.forget(player)
+        try:
+            self.server.drop_connection(player)
+        except Exception as e:
+            log.warning("reaping connection failed", player_id=player.id, error=str(e))
@@ -0,0 +1,346 @@
+''' Append-only binary journal of the state transitions of every game, and the tools that read it back.
+
+A journal file starts with MAGIC and holds one record per transition. A record is
+varint(body length) + body, and the body is the record code, varint(game id), the
+time of the transition as a double and the fields of its layout in RECORDS. The
+records of one game are in the order the game made the transitions, since every
+record is encoded under the lock of its game. '''
+import argparse
+import atexit
+import json
+import os
+import struct
+import sys
+import threading
+import time
+
+from metrics import REGISTRY
+from structured_log import get_logger, configure as configure_logging, LEVELS
+from wire import write_varint, read_varint, write_str, read_str, write_ints, read_ints
+
+log = get_logger('journal')
+
+JOURNAL_RECORDS = REGISTRY.counter('quiz_journal_records_total', 'Game transitions appended to the journal', ('kind',))
+JOURNAL_DROPPED = REGISTRY.counter('quiz_journal_dropped_total', 'Journal records dropped because the write buffer was full')
+JOURNAL_PENDING_BYTES = REGISTRY.gauge('quiz_journal_pending_bytes', 'Journal bytes waiting to be written')
+JOURNAL_SYNC_SECONDS = REGISTRY.histogram('quiz_journal_sync_seconds', 'Time to write and fsync one batch of journal records')
+
+MAGIC = b'QJNL\x01' # file header, the last byte is the version of the format
+_DOUBLE = struct.Struct('<d')
+
+# record kind -> (record code, (field name, field type)); types are i: varint, z: optional signed int,
+# s: string, l: list of varints, d: double, x: hex string stored as bytes
+RECORDS = {
+    'create': (1, (('uid', 'x'), ('player_id', 'i'), ('address', 's'), ('questions', 'l'), ('rounds', 'i'),
+                   ('round_time_limit', 'd'), ('delay_between_questions', 'd'), ('event', 's'))),
+    'join': (2, (('player_id', 'i'), ('address', 's'))),
+    'ready': (3, (('player_id', 'i'),)),
+    'question': (4, (('round', 'i'), ('question', 'i'))),
+    'answer': (5, (('player_id', 'i'), ('round', 'i'), ('answer', 'z'))),
+    'round': (6, (('round', 'i'), ('correct', 'i'), ('timeout', 'i'), ('scored', 'l'))),
+    'leave': (7, (('player_id', 'i'),)),
+    'suspend': (8, (('player_id', 'i'),)),
+    'resume': (9, (('player_id', 'i'),)),
+    'end': (10, (('winner', 's'), ('scores', 'l'))),
+}
+KINDS = {code: (kind, fields) for kind, (code, fields) in RECORDS.items()}
+
+
+def encode_record(kind: str, game_id: int, at: float, values) -> bytes:
+    ''' The function returns the framed record of a transition, values are in the order of the layout '''
+    code, fields = RECORDS[kind]
+    body = bytearray([code])
+    write_varint(body, game_id)
+    body += _DOUBLE.pack(at)
+    for (_, field_type), value in zip(fields, values):
+        if field_type == 'i':
+            write_varint(body, value)
+        elif field_type == 'z':
+            # 0 is None, other values are zigzag encoded and shifted by one like the answers of the wire encoding
+            write_varint(body, 0 if value is None else (value << 1 if value >= 0 else (~value << 1) | 1) + 1)
+        elif field_type == 's':
+            write_str(body, value)
+        elif field_type == 'l':
+            write_ints(body, value)
+        elif field_type == 'd':
+            body += _DOUBLE.pack(value)
+        else:
+            data = bytes.fromhex(value)
+            write_varint(body, len(data))
+            body += data
+    frame = bytearray()
+    write_varint(frame, len(body))
+    return bytes(frame + body)
+
+
+def decode_record(body) -> dict:
+    kind, fields = KINDS[body[0]]
+    game_id, pos = read_varint(body, 1)
+    record = {'kind': kind, 'game_id': game_id, 'at': _DOUBLE.unpack_from(body, pos)[0]}
+    pos += _DOUBLE.size
+    for name, field_type in fields:
+        if field_type == 'i':
+            record[name], pos = read_varint(body, pos)
+        elif field_type == 'z':
+            value, pos = read_varint(body, pos)
+            value -= 1
+            record[name] = None if value < 0 else ~(value >> 1) if value & 1 else value >> 1
+        elif field_type == 's':
+            record[name], pos = read_str(body, pos)
+        elif field_type == 'l':
+            record[name], pos = read_ints(body, pos)
+        elif field_type == 'd':
+            record[name] = _DOUBLE.unpack_from(body, pos)[0]
+            pos += _DOUBLE.size
+        else:
+            length, pos = read_varint(body, pos)
+            record[name] = bytes(body[pos:pos + length]).hex()
+            pos += length
+    return record
+
+
+def read_journal(path, chunk_size=1 << 20):
+    ''' The function yields the records of a journal file in order. A record cut off by a crash ends the file '''
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a game journal")
+        buf = bytearray()
+        pos = 0
+        while True:
+            data = f.read(chunk_size)
+            buf = buf[pos:] + data
+            pos = 0
+            while True:
+                length, start = read_varint(buf, pos)
+                if length is None or start + length > len(buf):
+                    break
+                yield decode_record(memoryview(buf)[start:start + length])
+                pos = start + length
+            if not data:
+                if pos < len(buf):
+                    log.warning("journal ends with a partial record", path=path, bytes=len(buf) - pos)
+                return
+
+
+class Journal:
+    ''' Append-only journal of the game transitions in one file per process.
+
+    A game encodes the record of a transition and appends it to a memory buffer.
+    A background thread writes the buffer and fsyncs the file once per batch, so
+    a round never waits for the disk; at most flush_interval seconds of records
+    are lost with the machine. When more than max_pending bytes wait the new
+    records are dropped and counted, the journal then has a gap. '''
+
+    def __init__(self, path='journal.bin', flush_interval=0.2, batch_bytes=1 << 16, max_pending=1 << 26):
+        self.path = path # file the records are appended to
+        self.flush_interval = flush_interval # seconds between two batches
+        self.batch_bytes = batch_bytes # pending bytes that wake the writer before the interval ends
+        self.max_pending = max_pending # bytes that may wait for the writer
+        self.buffer = bytearray() # encoded records waiting to be written
+        self.file = None
+        self.lock = threading.Lock() # guards the buffer
+        self.write_lock = threading.Lock() # one batch is written at a time
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        JOURNAL_PENDING_BYTES.callback = lambda: len(self.buffer)
+
+    def start(self):
+        with self._start_lock:
+            if self._thread:
+                return
+            self.file = open(self.path, 'ab')
+            if self.file.tell() == 0:
+                self.file.write(MAGIC)
+            self._thread = threading.Thread(target=self._run, name='journal-writer', daemon=True)
+            self._thread.start()
+            atexit.register(self.flush)
+
+    def record(self, kind: str, game_id: int, at: float, *values):
+        ''' The function queues the record of a transition of a game, values are in the order of the layout in RECORDS '''
+        self.start()
+        frame = encode_record(kind, game_id, at, values)
+        with self.lock:
+            if len(self.buffer) + len(frame) > self.max_pending:
+                JOURNAL_DROPPED.inc()
+                return
+            self.buffer += frame
+            wake = len(self.buffer) >= self.batch_bytes
+        JOURNAL_RECORDS.inc(kind)
+        if wake:
+            self._wakeup.set()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except OSError as e:
+                log.error("writing journal failed", path=self.path, error=str(e))
+
+    def flush(self):
+        ''' The function writes the pending records and waits until they are on the disk '''
+        with self.write_lock:
+            with self.lock:
+                batch, self.buffer = self.buffer, bytearray()
+            if not batch or self.file is None:
+                return
+            started = time.perf_counter()
+            self.file.write(batch)
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            JOURNAL_SYNC_SECONDS.observe(time.perf_counter() - started)
+
+    def close(self):
+        self.flush()
+        if self.file:
+            self.file.close()
+
+
+def format_address(address) -> str:
+    return f"{address[0]}:{address[1]}"
+
+
+def parse_address(text: str):
+    host, _, port = text.rpartition(':')
+    return host, int(port)
+
+
+class NoTimer:
+    def cancel(self):
+        pass
+
+
+def replay(paths, game_ids=None) -> dict:
+    ''' The function plays the recorded transitions through the game logic as fast as it can and
+    compares the scores of every round and game with the journal '''
+    from scheduler import VirtualClock
+    from server import Server, Player
+
+    class ReplayServer(Server):
+        ''' The journal says when the rounds start and end, so the timers of the games never run '''
+        def call_later(self, delay, callback):
+            return NoTimer()
+
+    server = ReplayServer()
+    server.clock = VirtualClock()
+    server.heartbeat.interval = 0
+    server.prefetch = False
+    bank = server.question_bank
+    games = {} # (file, recorded game id) -> Game
+    players = {} # (file, recorded game id, player id) -> Player
+    event_rooms = set() # games of events, the conductor started them and not the ready players
+    counts = {'records': 0, 'games': 0, 'rounds': 0, 'answers': 0}
+    mismatches = []
+    first = last = None
+    started = time.perf_counter()
+
+    def mismatch(record, what, recorded, replayed):
+        mismatches.append({'game_id': record['game_id'], 'at': record['at'], 'what': what,
+                           'recorded': recorded, 'replayed': replayed})
+
+    for path in paths:
+        for record in read_journal(path):
+            if game_ids and record['game_id'] not in game_ids:
+                continue
+            counts['records'] += 1
+            server.clock.now = record['at']
+            first = record['at'] if first is None else min(first, record['at'])
+            last = record['at'] if last is None else max(last, record['at'])
+            kind, key = record['kind'], (path, record['game_id'])
+            if kind == 'create':
+                creator = players[key + (record['player_id'],)] = Player(None, parse_address(record['address']), record['player_id'])
+                game_id, _ = server.createGame(creator)
+                game = games[key] = server.games[game_id]
+                # the game gets the recorded questions and timings instead of new ones
+                game.questions = [bank.get(question_id) for question_id in record['questions']]
+                game.number_of_rounds = record['rounds']
+                game.round_time_limit = record['round_time_limit']
+                game.delay_between_questions = record['delay_between_questions']
+                if record['event']:
+                    event_rooms.add(game)
+                counts['games'] += 1
+                continue
+            game = games.get(key)
+            if game is None:
+                continue # the game was created before the journal starts
+            player = players.get(key + (record.get('player_id'),))
+            if kind == 'join':
+                player = players[key + (record['player_id'],)] = Player(None, parse_address(record['address']), record['player_id'])
+                game.handlePlayerConnect(player)
+            elif kind == 'ready':
+                if game not in event_rooms:
+                    game.handle_ready(player)
+            elif kind == 'question':
+                if game.game_state == 'waiting':
+                    game.start_game()
+                elif game.current_round <= record['round']:
+                    game.next_round()
+                with game.lock:
+                    # the answer times count from the recorded question, not from the ready that started the game
+                    if game.current_round == record['round'] + 1:
+                        game.question_start_time = record['at']
+                    if game.current_question is None or game.current_question.id != record['question']:
+                        mismatch(record, 'question', record['question'], game.current_question and game.current_question.id)
+            elif kind == 'answer':
+                counts['answers'] += 1
+                game.process_answer(player, record['round'], record['answer'])
+            elif kind == 'round':
+                counts['rounds'] += 1
+                if game.round_open:
+                    game.handle_all_answered() # the time was up or the conductor of the event closed the round
+                scored = [game.seats[seat].id for seat in game.board.round_hits]
+                if scored != record['scored']:
+                    mismatch(record, f"round {record['round']} scored", record['scored'], scored)
+            elif kind == 'leave':
+                if game.suspended.get(player.id) is player:
+                    game.expire(player) # the grace window ended
+                else:
+                    game.remove_player(player)
+            elif kind == 'suspend':
+                with game.lock:
+                    game.suspend(player)
+            elif kind == 'resume':
+                connection = players[key + (record['player_id'],)] = Player(None, player.address, player.id)
+                game.resume(player, connection, game.seq)
+            elif kind == 'end':
+                game.end_game()
+                result = game.history[-1][1] if game.history else {}
+                if result.get('curr_score') != record['scores'] or result.get('winner') != record['winner']:
+                    mismatch(record, 'end', [record['winner'], record['scores']], [result.get('winner'), result.get('curr_score')])
+    wall = time.perf_counter() - started
+    span = (last - first) if first is not None else 0.0
+    return {
+        **counts,
+        'journal_s': round(span, 1),
+        'wall_s': round(wall, 2),
+        'speedup': round(span / wall, 1) if wall else None,
+        'mismatches': mismatches
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Reads the game journal written by the quiz server')
+    parser.add_argument('command', choices=['dump', 'replay'],
+                        help='dump: print the records as json lines, replay: re-run them through the game logic and audit the scores')
+    parser.add_argument('paths', nargs='+', help='journal files, one per worker process')
+    parser.add_argument('--game', type=int, action='append', help='only the records of this game id')
+    parser.add_argument('--log-level', choices=list(LEVELS), default='warning')
+    options = parser.parse_args()
+    configure_logging(options.log_level)
+
+    if options.command == 'dump':
+        for path in options.paths:
+            for record in read_journal(path):
+                if not options.game or record['game_id'] in options.game:
+                    print(json.dumps(record))
+        return
+    report = replay(options.paths, set(options.game or ()))
+    print(json.dumps(report, indent=2))
+    if report['mismatches']:
+        return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,297 @@
+''' Headless load generator that drives many simulated players against server.py over real sockets '''
+import argparse
+import asyncio
+import json
+import random
+import sys
+import time
+from collections import Counter, deque
+
+from client import WireCodec
+
+SERVER_HOST = '127.0.0.1'
+SERVER_PORT = 20250
+
+
+def parse_range(text):
+    ''' "4" -> (4, 4), "2-8" -> (2, 8) '''
+    low, _, high = text.partition('-')
+    return int(low), int(high or low)
+
+
+def parse_distribution(text):
+    ''' The function turns "fixed:1", "uniform:0.5-5" or "exp:2" into a function that draws answer times '''
+    kind, _, params = text.partition(':')
+    if kind == 'fixed':
+        value = float(params)
+        return lambda rng: value
+    if kind == 'uniform':
+        low, _, high = params.partition('-')
+        return lambda rng: rng.uniform(float(low), float(high))
+    if kind == 'exp':
+        mean = float(params)
+        return lambda rng: rng.expovariate(1 / mean)
+    raise argparse.ArgumentTypeError(f"Unknown distribution {text}")
+
+
+class Stats:
+    ''' Latency samples and error counters collected by all simulated players '''
+
+    def __init__(self):
+        self.connect = [] # seconds from connect() to the status response
+        self.fanout = [] # seconds from the server sending a question to a player receiving it
+        self.answer_to_result = [] # seconds from the last answer of a room to the "correct answer" frame
+        self.errors = Counter()
+        self.games_finished = 0
+        self.players_finished = 0
+
+    @staticmethod
+    def percentiles(samples):
+        if not samples:
+            return None
+        samples = sorted(samples)
+        pick = lambda q: samples[min(len(samples) - 1, int(q * len(samples)))]
+        return {
+            'count': len(samples),
+            'p50_ms': round(pick(0.50) * 1000, 2),
+            'p90_ms': round(pick(0.90) * 1000, 2),
+            'p99_ms': round(pick(0.99) * 1000, 2),
+            'max_ms': round(samples[-1] * 1000, 2),
+        }
+
+    def report(self, elapsed) -> dict:
+        return {
+            'elapsed_s': round(elapsed, 2),
+            'players_finished': self.players_finished,
+            'games_finished': self.games_finished,
+            'connect_latency': self.percentiles(self.connect),
+            'question_fanout_latency': self.percentiles(self.fanout),
+            'answer_to_result_latency': self.percentiles(self.answer_to_result),
+            'errors': dict(self.errors),
+        }
+
+
+class Room:
+    ''' Shared state of the simulated players that play one game together '''
+
+    def __init__(self, size):
+        self.size = size # number of players that should join before everyone gets ready
+        self.game_id = None
+        self.created = asyncio.Event() # set when the creator knows the game id
+        self.joined = 0 # players that got their status response
+        self.full = asyncio.Event() # set when everyone joined, the players then get ready
+        self.expected_answers = {} # round -> players that are going to answer it
+        self.answers = {} # round -> answers sent so far
+        self.last_answer_at = {} # round -> time when the last expected answer was sent
+
+    def player_joined(self):
+        self.joined += 1
+        if self.joined >= self.size:
+            self.full.set()
+
+
+class SimulatedPlayer:
+    def __init__(self, index, room: Room, creator, options, stats: Stats):
+        self.index = index
+        self.room = room
+        self.creator = creator # whether this player creates the room or joins it
+        self.options = options
+        self.stats = stats
+        self.rng = random.Random(options.seed * 1000003 + index)
+        self.joined = False # whether the player got into the room
+        self.current_round = None
+        self.writer = None # stream of the connection, also used to answer heartbeats
+        self.codec = WireCodec(options.binary) # json lines, binary frames after the status if asked for
+        self.received = deque() # decoded messages not handed to the game logic yet
+
+    async def send(self, writer, message):
+        if self.options.score_deltas and message['type'] in ('create', 'connect', 'join event'):
+            message = dict(message, scores='delta')
+        if self.options.prefetch and message['type'] in ('create', 'connect', 'join event'):
+            message = dict(message, prefetch=True)
+        if message['type'] in ('create', 'connect', 'join event'):
+            message = dict(message, heartbeat=True) # the pings are answered in recv
+        writer.write(self.codec.encode(message))
+        await writer.drain()
+
+    async def recv(self, reader):
+        while True:
+            while not self.received:
+                data = await asyncio.wait_for(reader.read(65536), self.options.read_timeout)
+                if not data:
+                    raise ConnectionResetError("Server closed the connection")
+                self.received.extend(self.codec.feed(data))
+            message = self.received.popleft()
+            if message.get('type') != 'ping':
+                return message
+            # heartbeats of the server are answered at once and never reach the game logic
+            self.writer.write(self.codec.encode({'type': 'pong', 'seq': message['seq']}))
+
+    async def run(self):
+        writer = None
+        try:
+            started = time.perf_counter()
+            reader, writer = await asyncio.open_connection(self.options.host, self.options.port)
+            self.writer = writer
+            if self.options.event:
+                await self.send(writer, {'type': 'join event', 'event': self.options.event})
+            elif self.creator:
+                await self.send(writer, {'type': 'create'})
+            else:
+                await self.room.created.wait()
+                game_id = self.room.game_id
+                if self.rng.random() < self.options.invalid_join_rate:
+                    game_id = -1 - self.index # exercise the "room does not exist" path first
+                await self.send(writer, {'type': 'connect', 'game_id': game_id})
+            status = await self.recv(reader)
+            if status.get('type') == 'status' and status.get('game_id') is None and not self.creator:
+                self.stats.errors['room not found'] += 1
+                await self.send(writer, {'type': 'connect', 'game_id': self.room.game_id})
+                status = await self.recv(reader)
+            if status.get('type') == 'busy':
+                self.stats.errors['server busy'] += 1
+                return
+            if status.get('type') != 'status' or status.get('game_id') is None:
+                self.stats.errors['join rejected'] += 1
+                return
+            self.stats.connect.append(time.perf_counter() - started)
+            if self.creator:
+                self.room.game_id = status['game_id']
+                self.room.created.set()
+            self.joined = True
+            self.room.player_joined()
+            await self.play(reader, writer)
+        except asyncio.TimeoutError:
+            self.stats.errors['read timeout'] += 1
+        except (ConnectionError, OSError) as e:
+            self.stats.errors[type(e).__name__] += 1
+        except json.JSONDecodeError:
+            self.stats.errors['invalid json'] += 1
+        finally:
+            if self.creator and not self.room.created.is_set():
+                # joiners of a room that was never created give up
+                self.room.game_id = -1
+                self.room.created.set()
+            if not self.joined:
+                # the rest of the room does not wait for a player that failed to join
+                self.room.player_joined()
+            if writer:
+                writer.close()
+
+    async def play(self, reader, writer):
+        # get ready once the whole room joined, so the game starts with everyone
+        await asyncio.wait_for(self.room.full.wait(), self.options.read_timeout)
+        if not self.options.event: # the rooms of an event start with the event
+            await self.send(writer, {'type': 'ready to start'})
+        pending_answer = None
+        try:
+            while True:
+                message = await self.recv(reader)
+                received = time.time()
+                kind = message.get('type')
+                if kind in ('question', 'reveal'):
+                    if 'sent_at' in message:
+                        self.stats.fanout.append(received - message['sent_at'])
+                    if self.rng.random() < self.options.disconnect_rate:
+                        self.stats.errors['simulated disconnect'] += 1
+                        return
+                    self.current_round = message['round']
+                    self.room.expected_answers[self.current_round] = self.room.expected_answers.get(self.current_round, 0) + 1
+                    pending_answer = asyncio.ensure_future(self.answer(writer, self.current_round))
+                elif kind in ('correct answer', 'round result'):
+                    # rounds that timed out have no last answer and are not measured
+                    last_answer_at = self.room.last_answer_at.get(self.current_round)
+                    if last_answer_at is not None:
+                        self.stats.answer_to_result.append(received - last_answer_at)
+                elif kind == 'end game':
+                    self.stats.players_finished += 1
+                    if self.creator:
+                        self.stats.games_finished += 1
+                    return
+                elif kind not in ('new player', 'status', 'prefetch', 'standings'):
+                    self.stats.errors[f'unexpected {kind}'] += 1
+        finally:
+            if pending_answer:
+                pending_answer.cancel()
+
+    async def answer(self, writer, round_number):
+        if self.rng.random() < self.options.silent_rate:
+            return # let the round time out for this player
+        await asyncio.sleep(self.options.answer_time(self.rng))
+        await self.send(writer, {'type': 'answer', 'round': round_number, 'answer': self.rng.randrange(4)})
+        self.room.answers[round_number] = self.room.answers.get(round_number, 0) + 1
+        if self.room.answers[round_number] >= self.room.expected_answers.get(round_number, 0):
+            self.room.last_answer_at[round_number] = time.time()
+
+
+async def run_load(options) -> dict:
+    rng = random.Random(options.seed)
+    stats = Stats()
+    tasks = []
+    started = time.perf_counter()
+    index = 0
+    while index < options.players:
+        low, high = options.room_size
+        # the server seats the players of an event, every simulated player is a room of its own here
+        size = 1 if options.event else min(rng.randint(low, high), options.players - index)
+        room = Room(size)
+        for seat in range(size):
+            # the first player of a room creates it, the others join it
+            player = SimulatedPlayer(index, room, seat == 0, options, stats)
+            tasks.append(asyncio.ensure_future(player.run()))
+            index += 1
+            if options.rate:
+                await asyncio.sleep(1 / options.rate)
+    await asyncio.gather(*tasks)
+    return stats.report(time.perf_counter() - started)
+
+
+def raise_open_files_limit():
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load generator for the quiz server')
+    parser.add_argument('--host', default=SERVER_HOST)
+    parser.add_argument('--port', type=int, default=SERVER_PORT)
+    parser.add_argument('--players', type=int, default=100, help='number of simulated players')
+    parser.add_argument('--room-size', type=parse_range, default=(4, 4),
+                        help='players per room, e.g. 4 or 2-8; one player of every room creates it, the rest join')
+    parser.add_argument('--invalid-join-rate', type=float, default=0.0,
+                        help='probability that a joining player first asks for a room that does not exist')
+    parser.add_argument('--rate', type=float, default=200, help='new connections per second, 0 for no limit')
+    parser.add_argument('--answer-time', type=parse_distribution, default=parse_distribution('uniform:0.5-3'),
+                        help='answer time distribution: fixed:S, uniform:A-B or exp:MEAN')
+    parser.add_argument('--silent-rate', type=float, default=0.0, help='probability that a player skips a question')
+    parser.add_argument('--disconnect-rate', type=float, default=0.0, help='probability per round that a player leaves')
+    parser.add_argument('--event', help='join the scheduled event with this name instead of creating and joining rooms')
+    parser.add_argument('--score-deltas', action='store_true',
+                        help='ask for per-round score deltas instead of the full score lists')
+    parser.add_argument('--prefetch', action='store_true',
+                        help='ask for the sealed questions ahead of their rounds, the rounds start with a small "reveal"')
+    parser.add_argument('--binary', action='store_true',
+                        help='ask for the compact binary encoding like client.py --binary, servers that refuse it keep json')
+    parser.add_argument('--read-timeout', type=float, default=120, help='seconds to wait for a server message')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', action='store_true', help='print the report as json')
+    options = parser.parse_args()
+
+    raise_open_files_limit()
+    report = asyncio.run(run_load(options))
+    if options.json:
+        print(json.dumps(report, indent=2))
+        return
+    print(f"Players finished: {report['players_finished']}/{options.players}, "
+          f"games finished: {report['games_finished']}, elapsed: {report['elapsed_s']} s")
+    for name in ('connect_latency', 'question_fanout_latency', 'answer_to_result_latency'):
+        print(f"{name:>26}: {report[name]}")
+    print(f"{'errors':>26}: {report['errors'] or 'none'}")
+
+
+if __name__ == '__main__':
+    sys.exit(main())
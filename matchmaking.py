@@ -0,0 +1,96 @@
+import threading
+
+from metrics import REGISTRY
+from structured_log import get_logger
+
+log = get_logger('matchmaking')
+
+MATCH_WAIT_SECONDS = REGISTRY.histogram('quiz_quick_play_wait_seconds', 'Time from a quick play request to a seat in a room',
+                                        buckets=(0.01, 0.05, 0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0))
+
+
+class Matchmaker:
+    ''' Queue of "quick play" players that are batched into rooms.
+
+    A player is seated at once in an open quick play room that still waits for
+    players and has a free seat. Otherwise the player is queued, and a room is
+    created as soon as room_size players are queued or the first of them has
+    waited max_wait seconds. A room that starts with fewer players stays open,
+    so the next quick players fill it. Open rooms are kept in insertion order, so
+    finding a seat is O(1). '''
+
+    def __init__(self, server, room_size=4, max_wait=10.0):
+        self.server = server # server that creates the rooms and sends the status responses
+        self.room_size = room_size # players in a full room
+        self.max_wait = max_wait # seconds the first queued player waits before a smaller room is created
+        self.queue = {} # player -> (request, time of the request), dict is used as an ordered set
+        self.open_rooms = {} # game_id -> Game of the quick play rooms with free seats
+        self.timer = None # handle of the max wait deadline of the queue
+        self.lock = threading.RLock()
+
+    def request(self, player, request: dict):
+        ''' The function seats the player in an open room or queues the player, returns the id of the room or None '''
+        with self.lock:
+            if player in self.queue:
+                return None
+            game_id = self.seat_in_open_room(player, request)
+            if game_id is not None:
+                MATCH_WAIT_SECONDS.observe(0.0)
+                return game_id
+            self.queue[player] = (request, self.server.clock.monotonic())
+            log.debug("player queued", player_id=player.id, queued=len(self.queue))
+            if len(self.queue) >= self.room_size:
+                self.create_room()
+            elif self.timer is None:
+                self.timer = self.server.call_later(self.max_wait, self.on_max_wait)
+            return player.game_id
+
+    def cancel(self, player):
+        ''' The function removes a player that left before being seated '''
+        with self.lock:
+            if self.queue.pop(player, None) and not self.queue and self.timer:
+                self.timer.cancel()
+                self.timer = None
+
+    def discard_room(self, game_id):
+        ''' The room started or was removed. A single dict operation, so no lock is taken while the game lock may be held '''
+        self.open_rooms.pop(game_id, None)
+
+    def seat_in_open_room(self, player, request: dict):
+        while self.open_rooms:
+            game_id, game = next(iter(self.open_rooms.items()))
+            with game.lock:
+                if game.game_state == 'waiting' and game.players and len(game.players) < self.room_size:
+                    self.server.join_room(game, player, request)
+                    if len(game.players) >= self.room_size:
+                        self.discard_room(game_id)
+                    return game_id
+            self.discard_room(game_id)
+        return None
+
+    def on_max_wait(self):
+        with self.lock:
+            self.timer = None
+            if self.queue:
+                self.create_room()
+
+    def create_room(self):
+        ''' The function seats the longest waiting players, up to room_size of them, in a new room '''
+        seated = []
+        while self.queue and len(seated) < self.room_size:
+            player = next(iter(self.queue))
+            seated.append((player,) + self.queue.pop(player))
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        now = self.server.clock.monotonic()
+        for _, _, requested_at in seated:
+            MATCH_WAIT_SECONDS.observe(now - requested_at)
+
+        game = self.server.create_room([(player, request) for player, request, _ in seated])
+        log.info("quick play room created", game_id=game.id, players=len(seated), queued=len(self.queue))
+        if len(game.players) < self.room_size:
+            self.open_rooms[game.id] = game
+        # players that queued meanwhile start a new deadline
+        if self.queue:
+            self.timer = self.server.call_later(self.max_wait, self.on_max_wait)
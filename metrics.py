@@ -0,0 +1,232 @@
+import bisect
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from structured_log import get_logger
+
+log = get_logger('metrics')
+
+# upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+def format_labels(names, values) -> str:
+    if not names:
+        return ''
+    pairs = ','.join(f'{n}="{str(v)}"' for n, v in zip(names, values))
+    return '{' + pairs + '}'
+
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels) # names of the label values passed to inc/set/observe
+        self.lock = threading.Lock()
+
+    def render(self):
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} {self.kind}'
+        for suffix, labels, value in self.samples():
+            yield f'{self.name}{suffix}{format_labels(*labels)} {value}'
+
+    def samples(self):
+        return ()
+
+
+class Counter(Metric):
+    ''' Value that only grows, e.g. number of received messages by type '''
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        super().__init__(name, help, labels)
+        self.values = {} # tuple of label values -> value
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def get(self, *labels):
+        return self.values.get(labels, 0)
+
+    def samples(self):
+        with self.lock:
+            items = list(self.values.items())
+        for labels, value in items:
+            yield '', (self.label_names, labels), value
+
+
+class Gauge(Counter):
+    ''' Value that goes up and down, or is computed by a callback when the metrics are collected.
+    The callback returns a number, or a dict of label values -> number for labelled gauges. '''
+    kind = 'gauge'
+
+    def __init__(self, name, help, labels=(), callback=None):
+        super().__init__(name, help, labels)
+        self.callback = callback
+
+    def set(self, value, *labels):
+        with self.lock:
+            self.values[labels] = value
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+    def samples(self):
+        if self.callback is None:
+            yield from super().samples()
+            return
+        try:
+            value = self.callback()
+        except Exception as e:
+            log.error("collecting metric failed", metric=self.name, error=str(e))
+            return
+        if isinstance(value, dict):
+            for labels, v in value.items():
+                yield '', (self.label_names, labels if isinstance(labels, tuple) else (labels,)), v
+        else:
+            yield '', ((), ()), value
+
+
+class Histogram(Metric):
+    ''' Distribution of observed values in cumulative buckets, e.g. latency in seconds '''
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        super().__init__(name, help)
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1) # the last bucket is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def time(self):
+        ''' Context manager that observes the duration of its block '''
+        return _Timer(self)
+
+    def quantile(self, q):
+        ''' The function estimates a quantile as the upper bound of the bucket that holds it '''
+        with self.lock:
+            target = q * self.count
+            seen = 0
+            for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+                seen += count
+                if seen >= target and count:
+                    return bound
+        return None
+
+    def samples(self):
+        with self.lock:
+            counts = list(self.counts)
+            total, count = self.sum, self.count
+        cumulative = 0
+        for bound, c in zip(self.buckets + ('+Inf',), counts):
+            cumulative += c
+            yield '_bucket', (('le',), (bound,)), cumulative
+        yield '_sum', ((), ()), total
+        yield '_count', ((), ()), count
+
+
+class _Timer:
+    __slots__ = ('histogram', 'started')
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started)
+
+
+class TimedLock:
+    ''' Reentrant lock that records how long every acquisition waited '''
+
+    def __init__(self, histogram: Histogram):
+        self._lock = threading.RLock()
+        self.histogram = histogram
+
+    def acquire(self, blocking=True, timeout=-1):
+        if self._lock.acquire(False):
+            self.histogram.observe(0.0)
+            return True
+        if not blocking:
+            return False
+        started = time.perf_counter()
+        acquired = self._lock.acquire(True, timeout)
+        self.histogram.observe(time.perf_counter() - started)
+        return acquired
+
+    def release(self):
+        self._lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class Registry:
+    ''' Collection of metrics of the process, metrics with the same name replace each other '''
+
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric: Metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labels=()) -> Counter:
+        return self.register(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=(), callback=None) -> Gauge:
+        return self.register(Gauge(name, help, labels, callback))
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help, buckets))
+
+    def render(self) -> str:
+        ''' The function returns all metrics in the Prometheus text format '''
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry() # metrics of this process
+
+
+def serve_metrics(host, port, registry: Registry = REGISTRY):
+    ''' The function starts a thread that serves the metrics as text on http://host:port/metrics '''
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            body = registry.render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass # scrapes are not worth a line of output each
+
+    httpd = ThreadingHTTPServer((host, port), Handler)
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, name='metrics-http', daemon=True).start()
+    log.info("metrics endpoint started", url=f"http://{host}:{port}/metrics")
+    return httpd
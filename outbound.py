@@ -0,0 +1,296 @@
+import asyncio
+import selectors
+import socket
+import threading
+import time
+from collections import deque
+
+SLOW_CONSUMER_POLICIES = ('drop', 'coalesce')
+# kinds of frames that replace the queued frames of the same kind: a newer ping, and the full score list
+# of a round. Deltas, announcements of players and questions only make sense with every frame before them
+COALESCED_KINDS = frozenset(('ping', 'correct answer'))
+
+
+class Outbox:
+    ''' Bounded queue of encoded frames waiting to be written to one player.
+
+    Frames are bytes objects shared between all recipients of a broadcast. When the
+    queue is full the slow consumer policy decides what happens: "drop" refuses the
+    frame so the caller disconnects the player, "coalesce" first removes older queued
+    frames of the same kind if the new frame supersedes them, see COALESCED_KINDS. '''
+
+    def __init__(self, max_frames=256, max_bytes=1 << 20, policy='drop'):
+        self.frames = deque() # (kind, frame) pairs in the order they are sent
+        self.queued_bytes = 0 # size of the queued frames
+        self.max_frames = max_frames
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.closing = False # no frames are accepted after close()
+        self.lock = threading.Lock()
+        # counters for metrics
+        self.max_depth = 0
+        self.sent_frames = 0
+        self.coalesced_frames = 0
+        self.overflows = 0
+
+    @property
+    def depth(self):
+        return len(self.frames)
+
+    def push(self, frame: bytes, kind=None) -> bool:
+        ''' The function queues a frame for the player, returns False if the player can not keep up or is closed '''
+        with self.lock:
+            if self.closing:
+                return False
+            if not self.frames and self._send_now(frame):
+                return True
+            if len(self.frames) >= self.max_frames or self.queued_bytes + len(frame) > self.max_bytes:
+                if self.policy == 'coalesce' and kind in COALESCED_KINDS:
+                    self._coalesce(kind)
+                if len(self.frames) >= self.max_frames or self.queued_bytes + len(frame) > self.max_bytes:
+                    self.overflows += 1
+                    return False
+            self.frames.append((kind, frame))
+            self.queued_bytes += len(frame)
+            self.max_depth = max(self.max_depth, len(self.frames))
+        self._schedule()
+        return True
+
+    def _coalesce(self, kind):
+        # the head frame may be partially written, so it is always kept
+        head = self.frames.popleft()
+        kept = deque([head])
+        for item in self.frames:
+            if item[0] == kind:
+                self.queued_bytes -= len(item[1])
+                self.coalesced_frames += 1
+            else:
+                kept.append(item)
+        self.frames = kept
+
+    def _send_now(self, frame) -> bool:
+        ''' Backends may write the frame right away when nothing is queued, returns True if it was fully sent '''
+        return False
+
+    def _schedule(self):
+        ''' Backends wake their writer here '''
+
+    def close(self, flush=True):
+        ''' The function closes the connection, after the queued frames are written if flush is True '''
+        raise NotImplementedError
+
+
+class SocketWriter:
+    ''' One thread that drains the outboxes of all non-blocking player sockets with a selector '''
+
+    def __init__(self, linger=5.0):
+        self.linger = linger # how long a closing connection may take to flush its frames
+        self.selector = selectors.DefaultSelector()
+        self.requests = deque() # outboxes that need the attention of the writer thread
+        self.closing = {} # outbox -> time after which it is closed even with unsent frames
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._wake_w.setblocking(False)
+        self.selector.register(self._wake_r, selectors.EVENT_READ)
+        self._thread = None
+        self._start_lock = threading.Lock()
+
+    def start(self):
+        with self._start_lock:
+            if self._thread:
+                return
+            self._thread = threading.Thread(target=self._run, name='socket-writer', daemon=True)
+        self._thread.start()
+
+    def wake(self, outbox):
+        self.requests.append(outbox)
+        try:
+            self._wake_w.send(b'\0')
+        except (BlockingIOError, InterruptedError):
+            pass # the writer is already woken up
+
+    def _run(self):
+        while True:
+            timeout = None
+            if self.closing:
+                timeout = max(0, min(self.closing.values()) - time.monotonic())
+            for key, _ in self.selector.select(timeout):
+                if key.fileobj is self._wake_r:
+                    try:
+                        while self._wake_r.recv(4096):
+                            pass
+                    except (BlockingIOError, InterruptedError):
+                        pass
+                else:
+                    self._flush(key.data)
+            while self.requests:
+                self._flush(self.requests.popleft())
+            now = time.monotonic()
+            for outbox, deadline in list(self.closing.items()):
+                if deadline <= now:
+                    with outbox.lock:
+                        outbox.frames.clear()
+                        outbox.queued_bytes = 0
+                    self._flush(outbox)
+
+    def _flush(self, outbox):
+        with outbox.lock:
+            if outbox.sock is None:
+                return
+            try:
+                while outbox.frames:
+                    kind, frame = outbox.frames[0]
+                    sent = outbox.sock.send(frame)
+                    outbox.queued_bytes -= sent
+                    if sent < len(frame):
+                        outbox.frames[0] = (kind, memoryview(frame)[sent:])
+                        break
+                    outbox.frames.popleft()
+                    outbox.sent_frames += 1
+            except (BlockingIOError, InterruptedError):
+                pass
+            except OSError:
+                # the reader of the player sees the shut down socket and handles the disconnect
+                outbox.frames.clear()
+                outbox.queued_bytes = 0
+                outbox.closing = True
+
+            if outbox.frames:
+                if not outbox.registered:
+                    self.selector.register(outbox.sock, selectors.EVENT_WRITE, outbox)
+                    outbox.registered = True
+                if outbox.closing and outbox not in self.closing:
+                    self.closing[outbox] = time.monotonic() + self.linger
+                return
+            if outbox.registered:
+                self.selector.unregister(outbox.sock)
+                outbox.registered = False
+            if outbox.closing:
+                self.closing.pop(outbox, None)
+                outbox.shutdown()
+
+
+class SocketOutbox(Outbox):
+    ''' Outbox of a non-blocking socket in the threaded server '''
+
+    def __init__(self, sock: socket.socket, writer: SocketWriter, **limits):
+        super().__init__(**limits)
+        self.sock = sock
+        self.writer = writer
+        self.registered = False # whether the writer thread waits for the socket to become writable
+        self.detached = False # the socket was passed to another process and must not be shut down
+
+    def _send_now(self, frame) -> bool:
+        # write in the calling thread while nothing is queued, the writer thread only handles the rest
+        if self.registered:
+            return False
+        try:
+            sent = self.sock.send(frame)
+        except (BlockingIOError, InterruptedError):
+            return False
+        except OSError:
+            self.closing = True
+            self.shutdown()
+            return True # the reader of the player handles the disconnect
+        if sent == len(frame):
+            self.sent_frames += 1
+            return True
+        self.frames.append((None, memoryview(frame)[sent:]))
+        self.queued_bytes += len(frame) - sent
+        self.writer.wake(self)
+        return True
+
+    def _schedule(self):
+        self.writer.wake(self)
+
+    def shutdown(self):
+        ''' The function closes the socket and wakes up the thread that reads from it '''
+        if self.sock is None:
+            return
+        if not self.detached:
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        self.sock.close()
+        self.sock = None
+
+    def close(self, flush=True):
+        with self.lock:
+            self.closing = True
+            if not flush:
+                self.frames.clear()
+                self.queued_bytes = 0
+            if not self.frames and not self.registered:
+                self.shutdown()
+                return
+        self.writer.wake(self)
+
+    def detach(self):
+        ''' The function drops the queued frames and closes this process's copy of the socket '''
+        with self.lock:
+            self.detached = self.closing = True
+            self.frames.clear()
+            self.queued_bytes = 0
+            if not self.registered:
+                self.shutdown()
+                return
+        self.writer.wake(self)
+
+
+class StreamOutbox(Outbox):
+    ''' Outbox of an asyncio stream, drained by one task per connection '''
+
+    def __init__(self, writer: asyncio.StreamWriter, linger=5.0, **limits):
+        super().__init__(**limits)
+        self.writer = writer
+        self.linger = linger # how long a closing connection may take to flush its frames
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.get_running_loop().create_task(self._drain())
+
+    def _schedule(self):
+        self._wakeup.set()
+
+    async def _drain(self):
+        try:
+            while True:
+                await self._wakeup.wait()
+                self._wakeup.clear()
+                while True:
+                    with self.lock:
+                        if not self.frames:
+                            break
+                        _, frame = self.frames.popleft()
+                        self.queued_bytes -= len(frame)
+                    self.writer.write(frame)
+                    self.sent_frames += 1
+                    # wait while the transport buffer is above its high-water mark
+                    await self.writer.drain()
+                if self.closing:
+                    break
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            self.writer.close()
+
+    def close(self, flush=True):
+        with self.lock:
+            self.closing = True
+            if not flush:
+                self.frames.clear()
+                self.queued_bytes = 0
+        self._wakeup.set()
+        if flush:
+            # a peer that stopped reading can not hold the connection open forever
+            asyncio.get_running_loop().call_later(self.linger, self.writer.transport.abort)
+        else:
+            self.writer.transport.abort()
+
+    def detach(self):
+        ''' The function drops the queued frames and closes this process's copy of the socket '''
+        with self.lock:
+            self.closing = True
+            self.frames.clear()
+            self.queued_bytes = 0
+        # abort closes the descriptor without shutting the connection down
+        self.writer.transport.abort()
@@ -0,0 +1,38 @@
+import base64
+import hashlib
+import json
+import secrets
+
+from metrics import REGISTRY
+
+QUESTIONS_PREFETCHED = REGISTRY.counter('quiz_questions_prefetched_total', 'Sealed questions queued to clients before their round')
+
+KEY_SIZE = 16 # bytes of the per-round key
+
+
+def keystream_xor(key: bytes, data: bytes) -> bytes:
+    ''' The function xors the data with a SHA-256 keystream of the key, the same call seals and opens '''
+    stream = bytearray()
+    for block in range((len(data) + 31) // 32):
+        stream += hashlib.sha256(key + block.to_bytes(4, 'big')).digest()
+    return (int.from_bytes(data, 'big') ^ int.from_bytes(stream[:len(data)], 'big')).to_bytes(len(data), 'big')
+
+
+def seal_question(round_number, question, options):
+    ''' The function returns the "prefetch" message with the sealed question of a round and the "reveal" key of it.
+
+    The payload is useless without the key, which is only broadcast when the round
+    starts. Every round gets a fresh random key, so a key never opens another round. '''
+    key = secrets.token_bytes(KEY_SIZE)
+    plain = json.dumps({'question': question, 'options': options}).encode()
+    message = {
+        'type': 'prefetch',
+        'round': round_number,
+        'payload': base64.b64encode(keystream_xor(key, plain)).decode()
+    }
+    return message, base64.b64encode(key).decode()
+
+
+def open_question(payload: str, key: str) -> dict:
+    ''' The function returns the question and options of a sealed payload '''
+    return json.loads(keystream_xor(base64.b64decode(key), base64.b64decode(payload)))
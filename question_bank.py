@@ -0,0 +1,129 @@
+import json
+import os
+import random
+import threading
+from collections import OrderedDict, deque
+from typing import Dict, Iterable, List, NamedTuple, Tuple
+
+from structured_log import get_logger
+
+log = get_logger('question_bank')
+
+QUESTIONS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'questions.json')
+
+
+class Question(NamedTuple):
+    id: int # position of the question in the bank
+    question: str
+    options: Tuple[str, ...]
+    answer: int # index of the correct option
+    category: str
+    difficulty: str
+
+
+class QuestionBank:
+    ''' Immutable in-memory question bank that is loaded once per process.
+
+    Questions are stored as tuples and indexed by id, category and difficulty, so
+    creating a game only samples from memory. The bank also remembers the questions
+    recently shown to the last max_recent players to avoid repeats in their next games. '''
+
+    def __init__(self, questions: Iterable[Question], recent_window=20, max_recent=10000):
+        self.questions: Tuple[Question, ...] = tuple(questions)
+        self.by_id: Dict[int, Question] = {q.id: q for q in self.questions}
+        self.by_category = self._index(lambda q: q.category)
+        self.by_difficulty = self._index(lambda q: q.difficulty)
+        self.by_category_difficulty = self._index(lambda q: (q.category, q.difficulty))
+        self.recent_window = recent_window # how many recent questions of a player are excluded from draws
+        self.max_recent = max_recent # players whose history is kept, the least recently seen are forgotten beyond this
+        self.recent: Dict[object, deque] = OrderedDict() # player key -> ids of the questions the player saw recently
+        self.lock = threading.Lock() # protects the recent history
+
+    def _index(self, key) -> Dict[object, Tuple[Question, ...]]:
+        index = {}
+        for q in self.questions:
+            index.setdefault(key(q), []).append(q)
+        return {k: tuple(v) for k, v in index.items()}
+
+    @classmethod
+    def load(cls, path=QUESTIONS_FILE, **kwargs):
+        ''' The function reads and parses the json file with questions once '''
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                raw = json.load(f)
+        except Exception as e:
+            log.error("loading questions failed", path=path, error=str(e))
+            raw = []
+        return cls((
+            Question(
+                id=item.get('id', i),
+                question=item['question'],
+                options=tuple(item['options']),
+                answer=item['answer'],
+                category=item.get('category', 'general'),
+                difficulty=item.get('difficulty', 'medium'),
+            )
+            for i, item in enumerate(raw)
+        ), **kwargs)
+
+    def __len__(self):
+        return len(self.questions)
+
+    def get(self, question_id: int) -> Question:
+        return self.by_id[question_id]
+
+    def pool(self, category=None, difficulty=None) -> Tuple[Question, ...]:
+        ''' The function returns the questions that match the filters '''
+        if category is not None and difficulty is not None:
+            return self.by_category_difficulty.get((category, difficulty), ())
+        if category is not None:
+            return self.by_category.get(category, ())
+        if difficulty is not None:
+            return self.by_difficulty.get(difficulty, ())
+        return self.questions
+
+    def draw(self, k, category=None, difficulty=None, exclude=frozenset(), rng=random) -> List[Question]:
+        ''' The function returns k random distinct questions, avoiding the excluded ids while the pool allows it '''
+        pool = self.pool(category, difficulty)
+        k = min(k, len(pool))
+        if not exclude:
+            return rng.sample(pool, k)
+
+        # rejection sampling is O(k) while the draw and the excluded ids are a small part of the pool
+        if (k + len(exclude)) * 2 <= len(pool):
+            chosen, seen = [], set()
+            while len(chosen) < k:
+                q = pool[rng.randrange(len(pool))]
+                if q.id not in seen and q.id not in exclude:
+                    seen.add(q.id)
+                    chosen.append(q)
+            return chosen
+
+        # otherwise take fresh questions first and fill the rest with recently seen ones
+        fresh = [q for q in pool if q.id not in exclude]
+        if len(fresh) >= k:
+            return rng.sample(fresh, k)
+        stale = [q for q in pool if q.id in exclude]
+        return fresh + rng.sample(stale, k - len(fresh))
+
+    def recent_ids(self, player_keys: Iterable) -> frozenset:
+        ''' The function returns the ids of the questions recently shown to any of the players '''
+        with self.lock:
+            ids = set()
+            for key in player_keys:
+                ids.update(self.recent.get(key, ()))
+        return frozenset(ids)
+
+    def remember(self, player_keys: Iterable, questions: Iterable[Question]):
+        ''' The function records the questions of a game in the recent history of its players '''
+        question_ids = [q.id for q in questions]
+        with self.lock:
+            for key in player_keys:
+                history = self.recent.get(key)
+                if history is None:
+                    history = self.recent[key] = deque(maxlen=self.recent_window)
+                else:
+                    self.recent.move_to_end(key)
+                history.extend(question_ids)
+            while len(self.recent) > self.max_recent:
+                self.recent.popitem(last=False)
@@ -0,0 +1,229 @@
+import argparse
+import atexit
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, deque
+
+from metrics import REGISTRY
+from structured_log import get_logger
+
+log = get_logger('results')
+
+RESULTS_QUEUED = REGISTRY.gauge('quiz_results_queued', 'Result records waiting to be written')
+RESULTS_DROPPED = REGISTRY.counter('quiz_results_dropped_total', 'Result records dropped because the write queue was full')
+RESULTS_BATCH_SECONDS = REGISTRY.histogram('quiz_results_batch_seconds', 'Time to write one batch of result records')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS games (
+    uid TEXT PRIMARY KEY,
+    game_id INTEGER,
+    shard INTEGER,
+    started_at REAL,
+    finished_at REAL,
+    rounds INTEGER,
+    players INTEGER,
+    winner TEXT
+);
+CREATE INDEX IF NOT EXISTS games_finished_at ON games (finished_at);
+
+CREATE TABLE IF NOT EXISTS answers (
+    game_uid TEXT,
+    round INTEGER,
+    player_id INTEGER,
+    choice INTEGER,
+    correct INTEGER,
+    response_time REAL
+);
+CREATE INDEX IF NOT EXISTS answers_game_round ON answers (game_uid, round);
+
+CREATE TABLE IF NOT EXISTS results (
+    game_uid TEXT,
+    player_id INTEGER,
+    player_key TEXT,
+    score INTEGER,
+    correct_time REAL,
+    rank INTEGER,
+    left_early INTEGER,
+    finished_at REAL,
+    PRIMARY KEY (game_uid, player_id)
+);
+CREATE INDEX IF NOT EXISTS results_window ON results (finished_at, player_key, score, rank);
+
+CREATE TABLE IF NOT EXISTS player_totals (
+    player_key TEXT PRIMARY KEY,
+    score INTEGER,
+    games INTEGER,
+    wins INTEGER,
+    last_played REAL
+);
+CREATE INDEX IF NOT EXISTS player_totals_score ON player_totals (score DESC, wins DESC);
+'''
+
+
+class TopCache:
+    ''' Bounded cache of leaderboard queries. Entries expire after ttl seconds and
+    are dropped whenever a batch of new results is written. '''
+
+    def __init__(self, max_entries=64, ttl=5.0):
+        self.max_entries = max_entries # least recently used entries are evicted beyond this
+        self.ttl = ttl # seconds an entry is served without asking the database
+        self.entries = OrderedDict() # (window, limit) -> (expires at, rows)
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                return None
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key, rows):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, rows)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class ResultsStore:
+    ''' Write-behind store of finished games, per-round answers and per-player totals in SQLite.
+
+    The game only appends a record to a bounded queue. A background thread writes
+    the queued records in one transaction per batch, so a round never waits for the
+    disk. When the queue is full the oldest records are dropped and counted. '''
+
+    def __init__(self, path='results.db', batch_size=500, flush_interval=0.5, max_pending=100000):
+        self.path = path # SQLite database file
+        self.batch_size = batch_size # records written in one transaction at most
+        self.flush_interval = flush_interval # seconds between two batches
+        self.records = deque(maxlen=max_pending) # ('round' | 'game', fields) tuples waiting to be written
+        self.cache = TopCache()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db_lock = threading.Lock() # the connection is shared by the writer thread and leaderboard queries
+        with self.db_lock:
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('PRAGMA synchronous=NORMAL')
+            self.db.execute('PRAGMA busy_timeout=5000') # worker processes share the file
+            self.db.executescript(SCHEMA)
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        RESULTS_QUEUED.callback = lambda: len(self.records)
+
+    def start(self):
+        with self._start_lock:
+            if self._thread:
+                return
+            self._thread = threading.Thread(target=self._run, name='results-writer', daemon=True)
+            self._thread.start()
+            atexit.register(self.flush)
+
+    def _append(self, record):
+        self.start()
+        if len(self.records) == self.records.maxlen:
+            RESULTS_DROPPED.inc()
+        self.records.append(record)
+        if len(self.records) >= self.batch_size:
+            self._wakeup.set()
+
+    def record_round(self, game_uid, round_number, correct, seat_ids, answered, choice, answer_time):
+        ''' The function queues the answers of a closed round, the columns are copies taken before the tally '''
+        self._append(('round', (game_uid, round_number, correct, seat_ids, answered, choice, answer_time)))
+
+    def record_game(self, game_uid, game_id, shard, started_at, finished_at, rounds, winner, entries):
+        ''' The function queues a finished game, entries are (player_id, player_key, score, correct_time, rank, left_early) tuples,
+        player_key is the name of the player or None for an anonymous player, who is not totalled '''
+        self._append(('game', (game_uid, game_id, shard, started_at, finished_at, rounds, winner, entries)))
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except sqlite3.Error as e:
+                log.error("writing results failed", error=str(e))
+
+    def flush(self):
+        ''' The function writes all queued records, one transaction per batch '''
+        while self.records:
+            batch = []
+            while self.records and len(batch) < self.batch_size:
+                batch.append(self.records.popleft())
+            started = time.perf_counter()
+            with self.db_lock, self.db:
+                for kind, fields in batch:
+                    if kind == 'round':
+                        self._write_round(*fields)
+                    else:
+                        self._write_game(*fields)
+            RESULTS_BATCH_SECONDS.observe(time.perf_counter() - started)
+            self.cache.clear()
+
+    def _write_round(self, game_uid, round_number, correct, seat_ids, answered, choice, answer_time):
+        rows = []
+        for seat, player_id in enumerate(seat_ids):
+            if answered[seat]:
+                option = int(choice[seat])
+                rows.append((game_uid, round_number, player_id, option if option >= 0 else None,
+                             int(option == correct), float(answer_time[seat])))
+        self.db.executemany('INSERT INTO answers VALUES (?, ?, ?, ?, ?, ?)', rows)
+
+    def _write_game(self, game_uid, game_id, shard, started_at, finished_at, rounds, winner, entries):
+        self.db.execute('INSERT OR REPLACE INTO games VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                        (game_uid, game_id, shard, started_at, finished_at, rounds, len(entries), winner))
+        self.db.executemany('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                            [(game_uid, player_id, key, score, correct_time, rank, int(left), finished_at)
+                             for player_id, key, score, correct_time, rank, left in entries])
+        self.db.executemany('''
+            INSERT INTO player_totals VALUES (?, ?, 1, ?, ?)
+            ON CONFLICT (player_key) DO UPDATE SET
+                score = score + excluded.score,
+                games = games + 1,
+                wins = wins + excluded.wins,
+                last_played = excluded.last_played
+        ''', [(key, score, int(rank == 1 and score > 0), finished_at)
+              for _, key, score, _, rank, _ in entries if key is not None])
+
+    def leaderboard(self, window=None, limit=10) -> list:
+        ''' The function returns the best players of all time, or of the last window seconds '''
+        key = (window, limit)
+        rows = self.cache.get(key)
+        if rows is not None:
+            return rows
+        with self.db_lock:
+            if window is None:
+                cursor = self.db.execute(
+                    'SELECT player_key, score, games, wins FROM player_totals ORDER BY score DESC, wins DESC LIMIT ?',
+                    (limit,))
+            else:
+                cursor = self.db.execute('''
+                    SELECT player_key, SUM(score) AS total, COUNT(*), SUM(rank = 1 AND score > 0) AS won
+                    FROM results WHERE finished_at >= ? AND player_key IS NOT NULL
+                    GROUP BY player_key ORDER BY total DESC, won DESC LIMIT ?
+                ''', (time.time() - window, limit))
+            rows = [{'player': player, 'score': score, 'games': games, 'wins': wins}
+                    for player, score, games, wins in cursor.fetchall()]
+        self.cache.put(key, rows)
+        return rows
+
+    def close(self):
+        self.flush()
+        with self.db_lock:
+            self.db.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Show the leaderboard stored by the quiz server')
+    parser.add_argument('--db', default='results.db')
+    parser.add_argument('--window', type=float, help='only count games finished in the last WINDOW seconds')
+    parser.add_argument('--limit', type=int, default=10)
+    args = parser.parse_args()
+    print(json.dumps(ResultsStore(args.db).leaderboard(args.window, args.limit), indent=2))
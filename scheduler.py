@@ -0,0 +1,193 @@
+import heapq
+import math
+import threading
+import time
+
+from structured_log import get_logger
+
+log = get_logger('scheduler')
+
+
+class TimerHandle:
+    ''' Handle of a scheduled callback, cancel() removes it from the wheel in O(1) '''
+    __slots__ = ('wheel', 'callback', 'slot', 'rounds', 'cancelled')
+
+    def __init__(self, wheel, callback, slot, rounds):
+        self.wheel = wheel # wheel that owns the timer
+        self.callback = callback # function to call when the timer expires
+        self.slot = slot # index of the wheel slot that holds the timer
+        self.rounds = rounds # full turns of the wheel left before the timer expires
+        self.cancelled = False
+
+    def cancel(self):
+        self.wheel.cancel(self)
+
+
+class TimerWheel:
+    ''' Hashed timer wheel that owns the deadlines of all games and runs them on one thread.
+
+    Time is split into ticks, every slot of the wheel holds the timers that expire on
+    that tick of some turn. Scheduling and cancelling only touch one slot, and every
+    tick looks at one slot, so thousands of games cost a single thread. Timers never
+    fire early and fire at most one tick late. Callbacks run on the wheel thread
+    without any wheel lock held, so they must not block for long. '''
+
+    def __init__(self, tick=0.05, wheel_size=512):
+        self.tick = tick # resolution of the wheel in seconds
+        self.slots = [dict() for _ in range(wheel_size)] # slot -> timers of the slot (dict is used as an ordered set)
+        self.current = 0 # index of the slot that is processed on the next tick
+        self.next_tick_at = time.monotonic() + tick # monotonic time of the next tick
+        self.pending = 0 # number of scheduled timers
+        self.lock = threading.Lock() # protects slots and counters
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        with self.lock:
+            if self._thread:
+                return
+            self.next_tick_at = time.monotonic() + self.tick
+            self._thread = threading.Thread(target=self._run, name='timer-wheel', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def call_later(self, delay, callback) -> TimerHandle:
+        ''' The function schedules the callback to run after delay seconds '''
+        with self.lock:
+            due = time.monotonic() + delay
+            ticks = max(1, math.ceil((due - self.next_tick_at) / self.tick) + 1)
+            size = len(self.slots)
+            handle = TimerHandle(self, callback, (self.current + ticks - 1) % size, (ticks - 1) // size)
+            self.slots[handle.slot][handle] = None
+            self.pending += 1
+        return handle
+
+    def cancel(self, handle: TimerHandle):
+        with self.lock:
+            if handle.cancelled:
+                return
+            handle.cancelled = True
+            if self.slots[handle.slot].pop(handle, False) is None:
+                self.pending -= 1
+
+    def _run(self):
+        while not self._stopped.is_set():
+            delay = self.next_tick_at - time.monotonic()
+            if delay > 0:
+                self._stopped.wait(delay)
+                continue
+
+            # collect the expired timers of the current slot under the lock
+            expired = []
+            with self.lock:
+                slot = self.slots[self.current]
+                for handle in list(slot):
+                    if handle.rounds:
+                        handle.rounds -= 1
+                    else:
+                        del slot[handle]
+                        handle.cancelled = True # an expired timer can not be cancelled anymore
+                        expired.append(handle)
+                self.pending -= len(expired)
+                self.current = (self.current + 1) % len(self.slots)
+                self.next_tick_at += self.tick
+
+            # run the callbacks without holding the lock
+            for handle in expired:
+                try:
+                    handle.callback()
+                except Exception as e:
+                    log.error("scheduled callback failed", callback=repr(handle.callback), error=str(e))
+
+
+class WallClock:
+    ''' Real time, the clock of a server that plays with real clients '''
+
+    def time(self) -> float:
+        return time.time()
+
+    def monotonic(self) -> float:
+        return time.monotonic()
+
+
+class VirtualTimer:
+    ''' Handle of a callback scheduled on a VirtualClock '''
+    __slots__ = ('clock', 'callback', 'due', 'cancelled')
+
+    def __init__(self, clock, callback, due):
+        self.clock = clock
+        self.callback = callback
+        self.due = due # virtual time the callback runs at
+        self.cancelled = False
+
+    def cancel(self):
+        self.clock.cancel(self)
+
+
+class VirtualClock:
+    ''' Simulated time that is also the scheduler of the server.
+
+    Time only moves when run() takes the next timer, so a round that waits 40 seconds
+    costs nothing but its callbacks. Timers that are due at the same time run in the
+    order they were scheduled, and everything runs on the thread that calls run(), so
+    a simulation with seeded randomness plays the same way every time. '''
+
+    def __init__(self, start=1_000_000_000.0):
+        self.now = start # current virtual time in seconds, also used as the wall clock time
+        self.queue = [] # heap of (due, sequence number, timer)
+        self.sequence = 0 # breaks the ties of timers that are due at the same time
+        self.pending = 0 # number of scheduled timers
+        self.lock = threading.Lock()
+
+    def time(self) -> float:
+        return self.now
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def start(self):
+        pass # nothing runs until run() is called
+
+    def stop(self):
+        with self.lock:
+            self.queue.clear()
+            self.pending = 0
+
+    def call_later(self, delay, callback) -> VirtualTimer:
+        ''' The function schedules the callback to run after delay seconds of virtual time '''
+        with self.lock:
+            timer = VirtualTimer(self, callback, self.now + max(0.0, delay))
+            self.sequence += 1
+            heapq.heappush(self.queue, (timer.due, self.sequence, timer))
+            self.pending += 1
+        return timer
+
+    def cancel(self, timer: VirtualTimer):
+        with self.lock:
+            if not timer.cancelled:
+                timer.cancelled = True # stays in the heap and is skipped when it comes up
+                self.pending -= 1
+
+    def run(self, until=None) -> int:
+        ''' The function runs the timers in order of their due time, moving the clock to each of them,
+        until no timer is left or the next one is due after until. Returns the number of callbacks run '''
+        count = 0
+        while True:
+            with self.lock:
+                while self.queue and self.queue[0][2].cancelled:
+                    heapq.heappop(self.queue)
+                if not self.queue or (until is not None and self.queue[0][0] > until):
+                    if until is not None:
+                        self.now = max(self.now, until)
+                    return count
+                due, _, timer = heapq.heappop(self.queue)
+                timer.cancelled = True # a timer that ran can not be cancelled anymore
+                self.pending -= 1
+                self.now = max(self.now, due)
+            try:
+                timer.callback()
+            except Exception as e:
+                log.error("scheduled callback failed", callback=repr(timer.callback), error=str(e))
+            count += 1
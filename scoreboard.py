@@ -0,0 +1,142 @@
+from array import array
+
+try:
+    import numpy as np
+except ImportError: # numpy is optional, the array columns give the same results
+    np = None
+
+LARGE_ROOM_SIZE = 256 # rooms with at least this many players are scored with numpy when it is installed
+NO_CHOICE = -1 # value of the choice column for players without a valid answer in the current round
+COLUMNS = ('answered', 'choice', 'answer_time', 'score', 'correct_time') # names of the columns, in snapshots too
+
+
+class Scoreboard:
+    ''' Per-player state of one game kept in columns indexed by the seat of the player.
+
+    Every player gets a seat when joining and keeps it after leaving. The columns hold
+    whether the player answered the current round, the chosen option, the response
+    time, the score and the total response time of correct answers, which breaks ties.
+    Recording an answer touches one seat, closing a round tallies all seats in one
+    pass. A big room is switched to numpy columns when the game starts, so the pass
+    runs in vectorized code. '''
+
+    def __init__(self):
+        self.size = 0 # number of seats
+        self.vectorized = False # whether the columns are numpy arrays
+        self.answered = array('b') # 1 if the seat answered the current round
+        self.choice = array('h') # option chosen in the current round or NO_CHOICE
+        self.answer_time = array('d') # seconds from the question to the answer in the current round
+        self.score = array('l') # correct answers so far
+        self.correct_time = array('d') # sum of the response times of the correct answers
+        self.round_hits = [] # seats that answered the last tallied round correctly
+
+    def add(self) -> int:
+        ''' The function adds a seat for a new player and returns its index '''
+        if self.vectorized:
+            raise RuntimeError("Seats can not be added once the game started")
+        self.answered.append(0)
+        self.choice.append(NO_CHOICE)
+        self.answer_time.append(0.0)
+        self.score.append(0)
+        self.correct_time.append(0.0)
+        self.size += 1
+        return self.size - 1
+
+    def vectorize(self, min_size=LARGE_ROOM_SIZE) -> bool:
+        ''' The function moves the columns to numpy arrays if the room is big enough and numpy is installed '''
+        if np is None or self.vectorized or self.size < min_size:
+            return self.vectorized
+        self.answered = np.frombuffer(self.answered, dtype=np.int8).copy()
+        self.choice = np.frombuffer(self.choice, dtype=np.int16).copy()
+        self.answer_time = np.frombuffer(self.answer_time, dtype=np.float64).copy()
+        self.score = np.array(self.score, dtype=np.int64)
+        self.correct_time = np.frombuffer(self.correct_time, dtype=np.float64).copy()
+        self.vectorized = True
+        return True
+
+    def has_answered(self, seat) -> bool:
+        return bool(self.answered[seat])
+
+    def record(self, seat, choice, elapsed, options=4) -> bool:
+        ''' The function stores the answer of a seat for the current round, returns False if the seat already answered '''
+        if self.answered[seat]:
+            return False
+        self.answered[seat] = 1
+        # answers that are not an option index can never be correct
+        valid = isinstance(choice, int) and not isinstance(choice, bool) and 0 <= choice < options
+        self.choice[seat] = choice if valid else NO_CHOICE
+        self.answer_time[seat] = elapsed
+        return True
+
+    def withdraw(self, seat):
+        ''' The function forgets the answer of a seat whose player left during the round '''
+        self.choice[seat] = NO_CHOICE
+
+    def columns(self) -> dict:
+        ''' The function returns copies of all columns by name '''
+        if self.vectorized:
+            return {name: getattr(self, name).copy() for name in COLUMNS}
+        return {name: array(getattr(self, name).typecode, getattr(self, name)) for name in COLUMNS}
+
+    def load(self, columns: dict):
+        ''' The function replaces the columns of a board without seats with the lists of a snapshot '''
+        if self.size or self.vectorized:
+            raise RuntimeError("Columns can only be loaded into an empty board")
+        for name in COLUMNS:
+            setattr(self, name, array(getattr(self, name).typecode, columns[name]))
+        self.size = len(self.score)
+
+    def round_columns(self):
+        ''' The function returns copies of the answered, choice and response time columns of the current round '''
+        if self.vectorized:
+            return self.answered.copy(), self.choice.copy(), self.answer_time.copy()
+        return array('b', self.answered), array('h', self.choice), array('d', self.answer_time)
+
+    def tally(self, correct) -> int:
+        ''' The function scores the current round in one pass, clears the round columns and returns the number of correct answers '''
+        if self.vectorized:
+            hits = self.choice == correct
+            self.score += hits
+            self.correct_time += np.where(hits, self.answer_time, 0.0)
+            self.round_hits = np.flatnonzero(hits).tolist()
+            self.answered.fill(0)
+            self.choice.fill(NO_CHOICE)
+            self.answer_time.fill(0.0)
+            return int(np.count_nonzero(hits))
+
+        round_hits = []
+        choice, score, correct_time, answer_time = self.choice, self.score, self.correct_time, self.answer_time
+        for seat in range(self.size):
+            if choice[seat] == correct:
+                score[seat] += 1
+                correct_time[seat] += answer_time[seat]
+                round_hits.append(seat)
+        self.round_hits = round_hits
+        self.answered = array('b', bytes(self.size))
+        self.choice = array('h', [NO_CHOICE]) * self.size
+        self.answer_time = array('d', [0.0]) * self.size
+        return len(round_hits)
+
+    def score_of(self, seat) -> int:
+        return int(self.score[seat])
+
+    def correct_time_of(self, seat) -> float:
+        return float(self.correct_time[seat])
+
+    def scores_of(self, seats) -> list:
+        ''' The function returns the scores of the seats in the given order '''
+        if self.vectorized:
+            return self.score[np.asarray(seats, dtype=np.intp)].tolist()
+        score = self.score
+        return [score[seat] for seat in seats]
+
+    def ranking(self, seats) -> list:
+        ''' The function orders the seats by score, ties go to the lower total response time of the correct answers, then to the earlier seat '''
+        if not seats:
+            return []
+        if self.vectorized:
+            seats = np.asarray(seats, dtype=np.intp)
+            order = np.lexsort((seats, self.correct_time[seats], -self.score[seats]))
+            return seats[order].tolist()
+        score, correct_time = self.score, self.correct_time
+        return sorted(seats, key=lambda seat: (-score[seat], correct_time[seat], seat))
@@ -1,14 +1,53 @@
 import socket
+import selectors
 import threading
+import asyncio
+import argparse
 import json
 import time
+import uuid
 import random
-from collections import defaultdict
+import secrets
+from collections import deque
 from typing import List
 from typing import Dict
+from framing import FrameDecoder, DEFAULT_MAX_FRAME_SIZE
+from wire import JSON, CODECS
+from scheduler import TimerWheel, WallClock
+from matchmaking import Matchmaker
+from heartbeat import Heartbeat
+from admission import AdmissionControl, MESSAGES_THROTTLED
+from question_bank import QuestionBank
+from scoreboard import Scoreboard
+from results_store import ResultsStore
+from journal import Journal, format_address
+from snapshots import SnapshotStore, GAMES_RESTORED
+from prefetch import seal_question, QUESTIONS_PREFETCHED
+from event import Conductor, parse_event
+from outbound import SocketWriter, SocketOutbox, StreamOutbox, SLOW_CONSUMER_POLICIES
+from sharding import HandoffListener, send_connection, shard_of, run_supervisor, EVENT_SHARD
+from metrics import REGISTRY, TimedLock, serve_metrics
+from structured_log import get_logger, configure as configure_logging, parse_sample_rates, LEVELS
+
+HANDED_OFF = object() # the connection was passed to the worker process that owns the game
+
+log = get_logger('server')
+game_log = get_logger('game')
+
+# metrics of the game server
+CLIENT_MESSAGE_TYPES = ('create', 'connect', 'quick play', 'join event', 'resume', 'spectate', 'ready to start', 'answer', 'pong')
+ACTIVE_CONNECTIONS = REGISTRY.gauge('quiz_active_connections', 'Open client connections')
+MESSAGES_RECEIVED = REGISTRY.counter('quiz_messages_received_total', 'Messages received from clients', ('type',))
+FRAMES_BROADCAST = REGISTRY.counter('quiz_frames_broadcast_total', 'Frames broadcast to the players of a game', ('type',))
+BROADCAST_SECONDS = REGISTRY.histogram('quiz_broadcast_seconds', 'Time to queue one broadcast frame for all players of a game')
+ROUND_CLOSE_SECONDS = REGISTRY.histogram('quiz_last_answer_to_round_close_seconds',
+                                         'Time from the last answer of a round to the correct answer being broadcast')
+LOCK_WAIT_SECONDS = REGISTRY.histogram('quiz_game_lock_wait_seconds', 'Time spent waiting to acquire Game.lock')
+CONNECTIONS_BY_ENCODING = REGISTRY.counter('quiz_connections_by_encoding_total', 'Players that joined a game by wire encoding', ('encoding',))
 
 HOST = '0.0.0.0'
 PORT = 20250
+MAX_NAME_LENGTH = 32 # longest player name kept for the leaderboards
 
 
 class Player:
@@ -16,17 +55,96 @@ class Player:
         self.socket: socket.socket = client_socket  # player's socket for communication
         self.address = client_addr  # player's IP and port
         self.id = player_id # player's uID
-        self.answered = False  # whether the player has answered the current question
-        self.score = 0  # player's score
+        self.seat = None  # index of the player's columns in the scoreboard of the game
+        self.decoder = FrameDecoder() # incremental decoder of the messages received from the player
+        self.outbox = None # queue of encoded frames waiting to be sent to the player
+        self.codec = JSON # wire encoding of the connection, json until the handshake asks for another one
+        self.game_id = None # game the player is seated in, also set by the matchmaker while the player waits in the lobby
+        self.send_lock = threading.Lock() # keeps a message from being encoded with the codec that is being replaced
+        self.last_seen = 0 # monotonic time of the last data received from the player
+        self.last_request = 0 # monotonic time of the last lobby request of the player
+        self.ping_seq = 0 # sequence number of the last ping sent to the player
+        self.ping_sent_at = 0 # monotonic time of the last ping that is not answered yet, 0 if none
+        self.rtt = None # smoothed round trip time of the heartbeats, None until the first pong
+        self.message_bucket = None # rate limit of the messages of the player's IP, None if messages are not limited
+        self.throttled = False # whether the player was told that its messages are dropped
+        self.on_close = None # called once when the connection is closed or handed off
+        self.resume_token = None # secret of the session, a new connection can take over the seat with it
+        self.resume_timer = None # handle of the end of the grace window while the player is suspended
+        self.spectator = False # whether the connection only watches a game
+        self.name = None # name the client sent, the key of the player's results on the leaderboards, None if anonymous
+        self.score_deltas = False # whether the client gets per-round score deltas instead of full score lists
+        self.prefetch = False # whether the client gets the sealed next question before its round starts
+        self.heartbeat = False # whether the client answers pings, only those connections are pinged
+        self.prefetched = None # round whose sealed question was queued for the player
+
+    def send(self, frame: bytes, kind=None) -> bool:
+        ''' The function queues an encoded frame for the player, returns False if the player is gone or too slow '''
+        if not self.socket or not self.outbox:
+            return False
+        return self.outbox.push(frame, kind)
+
+    def history_key(self) -> str:
+        ''' The function returns the key of the player's recent questions: its name, or its IP if it has none '''
+        return f"name:{self.name}" if self.name else self.address[0]
+
+    def send_message(self, message: dict) -> bool:
+        ''' The function encodes a message with the encoding of the player and queues it '''
+        with self.send_lock:
+            return self.send(self.codec.encode(message), message.get('type'))
+
+    def use_codec(self, codec, max_frame_size):
+        ''' The function switches the connection to another encoding, input that is already buffered is kept '''
+        if codec is self.codec:
+            return
+        pending = self.decoder.take_pending()
+        self.codec = codec
+        self.decoder = codec.new_decoder(max_frame_size)
+        self.decoder.restore(*pending)
+
+    def close(self, flush=True):
+        ''' The function closes the connection, after the queued frames are sent if flush is True '''
+        if self.socket:
+            ACTIVE_CONNECTIONS.dec()
+            if self.on_close:
+                self.on_close()
+        if self.outbox:
+            self.outbox.close(flush)
+        elif self.socket:
+            self.socket.close()
+        self.socket = None
+
+    def detach(self):
+        ''' The function releases the connection after it was passed to another process '''
+        if self.socket:
+            ACTIVE_CONNECTIONS.dec()
+            if self.on_close:
+                self.on_close()
+        if self.outbox:
+            self.outbox.detach()
+        self.socket = None
 
 class Game:
-    def __init__(self, game_id, player: Player, server):
+    def __init__(self, game_id, player: Player, server, event=None):
         self.server: Server = server # reference to the server instance
+        self.event = event # Event whose conductor drives the rounds of the game, None for a game of its own
         self._running = True # indicates whether the game is running at the thread and timer levels
         self._thread = None # Thread for the game
         self.deleted_players = {} # Dictionary to store disconnected players and their scores
+        self.left_since_round = [] # [id, score] of the players that left since the last round result
+        self.suspended: Dict[int, Player] = {} # player id -> players that lost the connection and may resume it
+        self.recovering = set() # ids of the players of a restored game that did not resume since the restart
+        self.seq = 0 # number of broadcast frames so far, clients count them to tell which ones they missed
+        self.history = deque(maxlen=server.resume_buffer) # (seq, message, delta) of the last broadcasts, replayed on resume
+        self.ready_ids = set() # ids of the players that are ready to start
         self.id = game_id  # Unique game ID
-        self.players: List[Player] = [player] # List of players in the game
+        self.uid = uuid.uuid4().hex # id of the game in the results store, unique across restarts and workers
+        self.started_at = None # wall clock time of the start of the game
+        self.players: List[Player] = [] # List of players in the game
+        self.board = Scoreboard() # answers and scores of all players that ever joined, by seat
+        self.seats: List[Player] = [] # every player that ever joined, by seat
+        self.spectators: Dict[int, Player] = {} # id -> connections that watch the game, they are never in players
+        self.add_player(player)
         self.game_state = 'waiting'  # states of game: waiting, playing, finished
         self.current_question = None # Current question being asked
         self.current_question_index = 0 # Index of the current question
@@ -34,66 +152,105 @@ class Game:
         self.ready_players = 0  # Number of players ready to start the game
         self.answers_received = 0 # Number of players who have answered the current question
         self.question_start_time = 0 # Time when the current question was asked
-        self.scores = defaultdict(int) # player_id -> score
-        self.questions = self.get_questions()
-        self.lock = threading.RLock() # Lock for thread safety
+        self.round_open = False # whether answers are accepted for the current round
+        self.round_timer = None # handle of the pending round deadline or inter-round delay
+        self.questions = event.questions if event else self.get_questions()
+        self.sealed = None # (question index, "prefetch" message, key) of the next question, sealed once for all clients
+        self.lock = TimedLock(LOCK_WAIT_SECONDS) # Lock for thread safety, waits are measured
+        self.last_answer_at = 0 # perf_counter time of the last answer in the current round
+        self.deadline = None # wall clock time the round timer fires at, kept by snapshots
+        self.version = 0 # number of transitions so far, snapshots are only written for games that changed
         self.number_of_rounds = 5 # Number of rounds in the game
-        self.delay_between_questions = 6 # Delay between questions
-        self.round_time_limit = 40  # Time limit for each question in seconds
+        self.delay_between_questions = server.delay_between_questions # Delay between questions
+        self.round_time_limit = server.round_time_limit  # Time limit for each question in seconds
+        if event:
+            self.number_of_rounds = len(event.questions)
+            self.delay_between_questions = event.delay_between_questions
+            self.round_time_limit = event.round_time_limit
 
     
-    # function to load questions from a json file and randomly selects 5 questions
+    # function randomly selects 5 questions from the shared question bank, avoiding the ones the creator saw recently
     def get_questions(self, num_questions=5):
-        try:
-            with open('questions.json', 'r', encoding='utf-8') as f:
-                all_questions = json.load(f)
-                return random.sample(all_questions, k=num_questions)
-        except Exception as e:
-            print(f"Error loading questions from file: {e}")
-            return []
+        bank = self.server.question_bank
+        player_keys = [p.history_key() for p in self.players]
+        return bank.draw(num_questions, exclude=bank.recent_ids(player_keys), rng=self.server.rng)
+
+    def transition(self, kind, *values, at=None):
+        ''' The function appends a state transition of the game to the journal of the server, see RECORDS in journal.py '''
+        self.version += 1
+        if self.server.journal:
+            self.server.journal.record(kind, self.id, self.server.clock.time() if at is None else at, *values)
+
+    def add_player(self, player: Player):
+        ''' The function gives the player a seat in the scoreboard '''
+        player.seat = self.board.add()
+        self.seats.append(player)
+        self.players.append(player)
 
     # function for adding a player to the game
     def handlePlayerConnect(self, player: Player):
         with self.lock:
-            self.players.append(player)
-            print(f"Player {player.address[0]}:{player.address[1]} joined game {self.id}.")
+            self.add_player(player)
+            self.transition('join', player.id, format_address(player.address))
+            game_log.info("player joined", game_id=self.id, player_id=player.id, address=player.address[0])
 
             # notify all players about the new player
             new_player_message = {
                 "type": "new player",
                 "player_id": player.id
             }
-            for p in self.players:
-                if p != player:  
-                    try:
-                        p.socket.send((json.dumps(new_player_message) + '\n').encode())
-                    except Exception as e:
-                        print(f"Error sending 'new player' message to {p.address}: {e}")
-                        self.handle_disconnect(p)
+            self.broadcast(new_player_message, exclude=player)
 
             return player.id, [p.id for p in self.players]
+
+    def add_spectator(self, player: Player) -> bool:
+        ''' The function lets the connection watch the game, returns False if the game is over '''
+        with self.lock:
+            if not self._running:
+                return False
+            player.spectator = True
+            self.spectators[player.id] = player
+            game_log.info("spectator joined", game_id=self.id, player_id=player.id, spectators=len(self.spectators))
+            return True
+
+    def remove_spectator(self, player: Player):
+        with self.lock:
+            if self.spectators.pop(player.id, None) is not None:
+                game_log.info("spectator left", game_id=self.id, player_id=player.id)
+            player.close(flush=False)
     
     # function to check if the player is already in the game
     def handle_ready(self, player: Player):
         with self.lock:
-            print(f"Player {player.address[0]}:{player.address[1]} is ready.")
+            game_log.debug("player ready", game_id=self.id, player_id=player.id)
+            # a resumed player may repeat the message
+            if self.game_state != 'waiting' or player.id in self.ready_ids:
+                return
+            self.ready_ids.add(player.id)
             self.ready_players += 1
-            print(f"Ready players: {self.ready_players}/{len(self.players)}")  
+            self.transition('ready', player.id)
+            game_log.info("ready players", game_id=self.id, ready=self.ready_players, players=len(self.players))
 
-            # check if all players are ready
-            if self.ready_players == len(self.players):
-                print(f"All players are ready.")
+            # check if all players are ready, the rooms of an event start when the event does
+            if self.ready_players == len(self.players) and self.event is None:
+                game_log.info("all players ready", game_id=self.id)
                 self.start_game()
     
     # starts the game 
     def start_game(self):
-        print(f"Starting game {self.id}...")
+        game_log.info("game starting", game_id=self.id, players=len(self.players))
         with self.lock:
             try:
                 self.game_state = 'playing'
+                self.started_at = self.server.clock.time()
+                self.server.game_started(self.id)
+                # nobody joins a running game, so the columns of a big room can move to numpy
+                if self.board.vectorize():
+                    game_log.info("large room scored with numpy", game_id=self.id, players=len(self.players))
+                self.server.question_bank.remember([p.history_key() for p in self.players], self.questions)
                 self.next_round()
             except Exception as e:
-                print(f"Error in start_game: {e}")
+                game_log.error("start game failed", game_id=self.id, error=str(e))
     
     # function for starting the next round
     def next_round(self):
@@ -102,7 +259,7 @@ class Game:
                 return
             # check if there are players in the game
             if len(self.players) == 0:
-                print(f"No players left in game {self.id}. Ending game.")
+                game_log.info("no players left", game_id=self.id)
                 self.end_game()
                 return
             
@@ -116,108 +273,182 @@ class Game:
                 self.current_question = self.questions[self.current_question_index]
                 self.current_question_index += 1  # increment the question index for the next round
             else:
-                print("No more questions available.")
+                game_log.warning("no more questions", game_id=self.id)
                 self.end_game()
                 return
             
             # check how many answer s have been received
             self.answers_received = 0
-            # set the start time for the question
-            self.question_start_time = time.time()
-            
-            # Reset the answered flag for all players
-            for player in self.players:
-                player.answered = False
+            # set the start time for the question, the answers of the last round were cleared by the tally
+            self.question_start_time = self.server.clock.time()
+            self.transition('question', self.current_round, self.current_question.id, at=self.question_start_time)
                 
-            print(f"Starting round {self.current_round} in game {self.id}.")
+            game_log.info("round started", game_id=self.id, round=self.current_round)
+            self.round_open = True
             self.broadcast_question()
             
-            # start the timer for the current round
-            self.round_timer = threading.Timer(self.round_time_limit, self.check_time_up)
-            self.round_timer.start()
+            # start the timer for the current round, the conductor keeps the time of the rounds of an event
+            if self.event is None:
+                self.deadline = self.question_start_time + self.round_time_limit
+                self.round_timer = self.server.call_later(self.round_time_limit, self.check_time_up)
             self.current_round += 1
     
     
     # check if the time is up for the current round       
     def check_time_up(self):
         with self.lock:
-            if not self._running:
+            # The timer is cancelled when the round closes, so an open round means the time is up
+            if not self._running or not self.round_open:
                 return
-            # Check if the game is still running and if the round time limit has been reached
-            elapsed_time = time.time() - self.question_start_time
-            if elapsed_time >= self.round_time_limit and self.answers_received < len(self.players):
-                print(f"Time is up for round {self.current_round} in game {self.id}.")
-                self.handle_all_answered()
+            game_log.info("round timed out", game_id=self.id, round=self.current_round, answers=self.answers_received, players=len(self.players))
+            self.handle_all_answered()
     
     # function for broadcasting the question to all players
     def broadcast_question(self): 
         question_data = {
             'type': 'question',
             'round': self.current_round,
-            'question': self.current_question['question'],
-            'options': self.current_question['options']
+            'question': self.current_question.question,
+            'options': self.current_question.options,
+            'sent_at': self.event.round_started_at if self.event else self.server.clock.time() # lets clients measure the fan-out latency
         }
-        self.broadcast(json.dumps(question_data) + '\n')
+        # the clients that hold the sealed question only need its key
+        reveal = None
+        if self.sealed and self.sealed[0] == self.current_question_index - 1:
+            reveal = {'type': 'reveal', 'round': self.current_round, 'key': self.sealed[2], 'sent_at': question_data['sent_at']}
+        # the rooms of an event send the same frames, they are encoded by the first room
+        self.broadcast(question_data, reveal=reveal, frames=self.event.frames if self.event else None)
+
+    def sealed_question(self):
+        ''' The function returns the "prefetch" message of the next question, or None while a round is open or after the last one '''
+        index = self.current_question_index
+        if not self.server.prefetch or self.round_open or index >= len(self.questions) or self.current_round >= self.number_of_rounds:
+            return None
+        if self.sealed is None or self.sealed[0] != index:
+            question = self.questions[index]
+            if self.event:
+                message, key = self.event.sealed[index]
+            else:
+                message, key = seal_question(self.current_round, question.question, question.options)
+            self.sealed = (index, message, key)
+        return self.sealed[1]
+
+    def send_prefetch(self, players, frames: dict = None):
+        ''' The function queues the sealed next question for the players that asked for it,
+        so the network carries the question during the pause and the round starts with a small frame '''
+        message = self.sealed_question()
+        if message is None:
+            return
+        frames = {} if frames is None else frames # codec -> encoded frame, shared by the rooms of an event
+        for player in players:
+            if not player.prefetch or not player.socket or player.prefetched == message['round']:
+                continue
+            frame = frames.get(player.codec)
+            if frame is None:
+                frame = frames[player.codec] = player.codec.encode(message)
+            # a player whose frame is not queued gets the full question, a failed send is noticed by the next broadcast
+            if player.send(frame, 'prefetch'):
+                player.prefetched = message['round']
+                QUESTIONS_PREFETCHED.inc()
 
 
     # function for processing the player's answer
     def process_answer(self, player: Player, round_number, answer_index):
         with self.lock:
+            # Ignore answers that arrive between rounds
+            if not self.round_open:
+                return
              # Check if time has expired
-            elapsed_time = time.time() - self.question_start_time 
+            now = self.server.clock.time()
+            elapsed_time = now - self.question_start_time 
             if elapsed_time >= self.round_time_limit:
-                print(f"Time is up for round {self.current_round} in game {self.id}.")
+                game_log.info("round timed out", game_id=self.id, round=self.current_round, answers=self.answers_received, players=len(self.players))
                 self.handle_all_answered()
                 return
             
-            # Ensure a player can only answer once per round
-            if player.answered:
+            # Store the answer, a player can only answer once per round. It is scored when the round closes
+            if not self.board.record(player.seat, answer_index, elapsed_time, len(self.current_question.options)):
                 return
-            player.answered = True  # Mark the player as having answered
+            # the journal keeps the time the answer was taken, a replay gets the same response time from it
+            valid = isinstance(answer_index, int) and not isinstance(answer_index, bool)
+            self.transition('answer', player.id, self.current_round - 1, answer_index if valid else None, at=now)
+            self.last_answer_at = time.perf_counter()
             
             self.answers_received += 1
-            print(f"Player {player.id} answered. Total answers received: {self.answers_received}/{len(self.players)}")
-            # Check if the answer is correct
-            correct = answer_index == self.current_question['answer']
-            if correct:
-                self.scores[player] += 1  # add points to player for a correct answer
+            game_log.debug("answer received", game_id=self.id, player_id=player.id, answers=self.answers_received, players=len(self.players))
             
-            # Check if all players have answered
-            active_players = [p for p in self.players if p.socket]
-            if self.answers_received >= len(active_players):
+            # Check if all players have answered, players that left are not in the list anymore
+            if self.round_complete():
                 self.handle_all_answered()
+
+    def round_complete(self) -> bool:
+        ''' The function returns True if every player answered, suspended players are not waited for unless they
+        are still reconnecting to a restored game '''
+        missing = len(self.players) - self.answers_received
+        if missing <= 0:
+            return True
+        return missing <= sum(1 for p in self.suspended.values()
+                              if p.id not in self.recovering and not self.board.has_answered(p.seat))
     
     # function for handling when all players have answered 
     def handle_all_answered(self):
         with self.lock:
+            # the round may already be closed by the timer or another listener
+            if not self.round_open:
+                return
+            self.round_open = False
             # stop the round timer if it is still running
-            if hasattr(self, 'round_timer') and self.round_timer.is_alive():
+            if self.round_timer:
                 self.round_timer.cancel()
+            closed_by_answers = self.round_complete()
             
-            print(f"All players have answered for round {self.current_round} in game {self.id}.")
+            # the answers of the round are queued for the results store before the tally clears them
+            if self.server.results:
+                self.server.results.record_round(self.uid, self.current_round - 1, self.current_question.answer,
+                                                 [p.id for p in self.seats], *self.board.round_columns())
+            # score all answers of the round in one pass
+            correct = self.board.tally(self.current_question.answer)
+            game_log.info("round closed", game_id=self.id, round=self.current_round, answers=self.answers_received, correct=correct, players=len(self.players))
             
             response = {
                 'type': 'correct answer',
-                'correct_answ': self.current_question['answer'] + 1, 
-                'curr_score': [self.scores[p] for p in self.players],  
+                'correct_answ': self.current_question.answer + 1, 
+                'curr_score': self.board.scores_of([p.seat for p in self.players]),  
                 'deleted_players': [{'id': player_id, 'score': score} for player_id, score in self.deleted_players.items()] 
             }
+            # clients that keep the scores themselves only get what changed in the round
+            seats = self.seats
+            delta = {
+                'type': 'round result',
+                'round': self.current_round - 1,
+                'correct_answ': self.current_question.answer + 1,
+                'scored': [seats[seat].id for seat in self.board.round_hits],
+                'left': self.left_since_round
+            }
+            self.left_since_round = []
+            self.transition('round', self.current_round - 1, self.current_question.answer, int(not closed_by_answers), delta['scored'])
             
-            self.broadcast(json.dumps(response) + '\n')
+            self.broadcast(response, delta=delta)
+            if closed_by_answers and self.last_answer_at:
+                ROUND_CLOSE_SECONDS.observe(time.perf_counter() - self.last_answer_at)
             
             # transition to the next round or end the game
-            if self.current_round >= self.number_of_rounds:
+            if self.event:
+                self.event.room_closed(self)
+            elif self.current_round >= self.number_of_rounds:
                 self.end_game()
             else:
-                time.sleep(self.delay_between_questions)
-                print("Next round starting...")
-                self.next_round()
+                # schedule the next round instead of sleeping under the lock
+                game_log.debug("next round scheduled", game_id=self.id, delay=self.delay_between_questions)
+                self.deadline = self.server.clock.time() + self.delay_between_questions
+                self.round_timer = self.server.call_later(self.delay_between_questions, self.next_round)
+                self.send_prefetch(list(self.players) + list(self.spectators.values()))
                 
     def get_result(self):
         """  The function returns a json response with the list of player's records  """
         results = {
             'type': 'game_results',
-            'scores': {p.id: self.scores[p] for p in self.players}
+            'scores': dict(zip([p.id for p in self.players], self.board.scores_of([p.seat for p in self.players])))
         }
         return results
 
@@ -228,28 +459,33 @@ class Game:
             if not self._running:
                 return
             self._running = False 
-            print(f"Game {self.id} is ending.")
+            game_log.info("game ending", game_id=self.id)
             self.game_state = 'finished'
 
             # If the game was completed earlier, disable the timer 
-            if hasattr(self, 'round_timer') and self.round_timer.is_alive():
+            self.round_open = False
+            if self.round_timer:
                 self.round_timer.cancel()
 
-            # Determine the winner (player with the highest score)
-            winner = None
-            if self.scores:
-                winner = max(self.scores, key=self.scores.get)
+            # Determine the winner (player with the highest score, the faster correct answers break ties)
+            seats = [p.seat for p in self.players]
+            ranking = self.board.ranking(seats)
+            winner_player = None
+            if ranking and self.board.score_of(ranking[0]) > 0:
+                winner_player = self.players[seats.index(ranking[0])]
 
             # Generate json response about game finish
-            winner_player = next((p for p in self.players if p.id == winner), None)
             results = {
                 'type': 'end game',
                 'winner': f"{winner_player.address[0]}:{winner_player.address[1]}" if winner_player else "No winner",
-                'curr_score': [self.scores[player] for player in self.players]
+                'curr_score': self.board.scores_of(seats)
             }
 
-            # Broadcast the results to all players
-            self.broadcast(json.dumps(results) + '\n')
+            self.transition('end', results['winner'], results['curr_score'])
+
+            # Broadcast the results to all players, clients with score deltas get the scores by player id
+            self.broadcast(results, delta=dict(results, scores=[[p.id, score] for p, score in zip(self.players, results['curr_score'])]))
+            self.save_results(results['winner'])
             
             # Close all player connections
             self.close_connection_players(self.players)
@@ -258,177 +494,858 @@ class Game:
             self.server.remove_game(self.id)
     
  
+    def save_results(self, winner: str):
+        ''' The function queues the final scores and ranks of everyone who played for the results store '''
+        if not self.server.results or self.started_at is None:
+            return
+        # players that left rank below everyone who finished the game, like the winner of the broadcast
+        remaining = set(p.seat for p in self.players)
+        ranking = self.board.ranking(sorted(remaining)) + \
+            self.board.ranking([seat for seat in range(len(self.seats)) if seat not in remaining])
+        entries = [
+            (self.seats[seat].id, self.seats[seat].name, self.board.score_of(seat),
+             self.board.correct_time_of(seat), rank, seat not in remaining)
+            for rank, seat in enumerate(ranking, 1)
+        ]
+        self.server.results.record_game(self.uid, self.id, self.server.shard, self.started_at, self.server.clock.time(),
+                                        self.current_round, winner, entries)
+
     def close_connection_players(self, players: List[Player]):
         """ The function completes the connection to all players that are passed as an argument """
         for player in players:
             if player.socket:  
-                print(f"Close connection: {player.address[0]}: {player.address[1]}")
+                game_log.debug("closing connection", game_id=self.id, player_id=player.id)
                 try:
-                    player.socket.close()
-                    player.socket = None 
+                    player.close()
                 except Exception as e:
-                    print(f"Error closing socket for player {player.id}: {e}")
+                    game_log.warning("closing connection failed", game_id=self.id, player_id=player.id, error=str(e))
             else:
-                print(f"Socket for player {player.id} is already closed.")
+                game_log.debug("connection already closed", game_id=self.id, player_id=player.id)
 
-    def broadcast(self, message):
-        """ The function sends a message to all players """ 
-        if not isinstance(message, str):    # Convert dict to JSON string if needed
-            message = json.dumps(message) + '\n'
+    def broadcast(self, message, exclude: Player = None, delta: dict = None, reveal: dict = None, frames: dict = None):
+        """ The function encodes a message once per wire encoding and queues the same frame for all players,
+        players that asked for score deltas get the delta variant of the message if there is one, and
+        players that hold the sealed question of the round get the reveal variant. The rooms of an event
+        pass the same frames dict for a message that is the same in all of them """ 
+        started = time.perf_counter()
+        if isinstance(message, str):    # Convert JSON string to dict if needed
+            message = json.loads(message)
+        kind = message.get('type')
+        frames = {} if frames is None else frames # (codec, variant) -> encoded frame, most rooms need only one
+        FRAMES_BROADCAST.inc(kind or 'other')
+        self.seq += 1
+        # a reveal is never replayed, a resumed client gets the full question
+        self.history.append((self.seq, message, delta))
 
-        for player in self.players:
-            try:
-                if player.socket:  
-                    player.socket.send(message.encode()) 
-                    print(f"Send message to {player.address[0]}: {player.address[1]}")
-            except (ConnectionResetError, BrokenPipeError, OSError):
-                print(f"Player {player.address[0]}:{player.address[1]} disconnected during broadcast.")
-                self.handle_disconnect(player)
-            except Exception as e:
-                print(f"Error sending message to {player.address[0]}:{player.address[1]}: {e}")
+        def variant_of(player):
+            if reveal is not None and player.prefetched == reveal['round']:
+                return 'reveal', reveal
+            if delta is not None and player.score_deltas:
+                return 'delta', delta
+            return None, message
+
+        for player in list(self.players):
+            if not player.socket or player is exclude:
+                continue
+            variant, variant_message = variant_of(player)
+            frame = frames.get((player.codec, variant))
+            if frame is None:
+                frame = frames[player.codec, variant] = player.codec.encode(variant_message)
+            # the kind of the variant, a "round result" delta is never superseded like a full "correct answer"
+            if player.send(frame, variant_message['type']):
+                game_log.debug("frame queued", game_id=self.id, player_id=player.id, type=kind)
+            else:
+                # the player is disconnected or does not read fast enough to keep up with the game
+                game_log.info("player dropped during broadcast", game_id=self.id, player_id=player.id)
                 self.handle_disconnect(player)
+
+        # spectators get the frames that were encoded for the players
+        for spectator in list(self.spectators.values()):
+            variant, variant_message = variant_of(spectator)
+            frame = frames.get((spectator.codec, variant))
+            if frame is None:
+                frame = frames[spectator.codec, variant] = spectator.codec.encode(variant_message)
+            if not spectator.send(frame, variant_message['type']):
+                self.remove_spectator(spectator)
+        BROADCAST_SECONDS.observe(time.perf_counter() - started)
     
     def handle_disconnect(self, player: Player):
         """ Function correctly handles player disconnection """
         with self.lock:
             if not player.socket: 
                 return
+            if player.spectator:
+                self.remove_spectator(player)
+                return
             
             if player in self.players:
-                print(f"Close connection: {player.address[0]}:{player.address[1]}")
-                self.deleted_players[player.id] = self.scores[player]
+                # a player with a session keeps the seat for the grace window and may resume on a new connection
+                if player.resume_token and self.server.resume_grace > 0 and self._running:
+                    self.suspend(player)
+                else:
+                    self.remove_player(player)
+
+    def suspend(self, player: Player):
+        ''' The function closes the connection of the player and keeps the seat until the grace window ends '''
+        game_log.info("player suspended", game_id=self.id, player_id=player.id)
+        self.transition('suspend', player.id)
+        try:
+            player.close(flush=False)
+        except Exception as e:
+            game_log.warning("closing connection failed", game_id=self.id, player_id=player.id, error=str(e))
+        self.suspended[player.id] = player
+        player.resume_timer = self.server.call_later(self.server.resume_grace, lambda: self.expire(player))
+        # the round does not wait for a player without a connection
+        if self.round_open and self.round_complete():
+            self.handle_all_answered()
+
+    def expire(self, player: Player):
+        ''' The grace window of a suspended player ended without a resume '''
+        with self.lock:
+            if self.suspended.get(player.id) is not player or not self._running:
+                return
+            del self.suspended[player.id]
+            self.recovering.discard(player.id)
+            self.remove_player(player)
+
+    def resume(self, player: Player, connection: Player, last_seq: int, snapshot=False):
+        ''' The function moves the seat of a player to a new connection and returns the seq the status covers,
+        the (message, delta) of the broadcasts to replay after it and whether the status needs a snapshot.
+        It returns None if the seat is gone, or if the missed broadcasts are no longer in the history and
+        the client can not rebuild its state from a snapshot '''
+        with self.lock:
+            if player not in self.players or not self._running:
+                return None
+            first_kept = self.history[0][0] if self.history else self.seq + 1
+            replayable = first_kept - 1 <= last_seq <= self.seq
+            if not replayable and not snapshot:
+                return None
+            if player.socket:
+                # the old connection is half-open and was not noticed yet
+                player.close(flush=False)
+            if self.suspended.pop(player.id, None) and player.resume_timer:
+                player.resume_timer.cancel()
+            self.recovering.discard(player.id)
+            connection.id, connection.seat, connection.game_id = player.id, player.seat, self.id
+            connection.resume_token = player.resume_token
+            connection.name = player.name
+            self.players[self.players.index(player)] = connection
+            self.seats[player.seat] = connection
+            self.transition('resume', player.id)
+            game_log.info("player resumed", game_id=self.id, player_id=player.id, missed=self.seq - last_seq, replayed=replayable)
+            if replayable:
+                return last_seq, [(message, delta) for seq, message, delta in self.history if seq > last_seq], False
+            # the snapshot covers the scores, only the question of the open round is sent again
+            if self.round_open and self.history:
+                return self.seq - 1, [self.history[-1][1:]], True
+            return self.seq, [], True
+
+    def snapshot(self) -> dict:
+        ''' The function returns the full scores of the game, the base that later score deltas are applied to '''
+        return {
+            'round': self.current_round - 1,
+            'players': [[p.id, score] for p, score in zip(self.players, self.board.scores_of([p.seat for p in self.players]))],
+            'left': [[player_id, score] for player_id, score in self.deleted_players.items()]
+        }
+
+    def checkpoint(self) -> dict:
+        ''' The function copies the state of the game for a snapshot, called under the lock of the game.
+        Besides the score columns only small values are copied, the snapshot is serialized after the lock is released '''
+        return {
+            'game_id': self.id,
+            'uid': self.uid,
+            'version': self.version,
+            'state': self.game_state,
+            'started_at': self.started_at,
+            'questions': [q.id for q in self.questions],
+            'question_index': self.current_question_index,
+            'round': self.current_round,
+            'rounds': self.number_of_rounds,
+            'round_time_limit': self.round_time_limit,
+            'delay_between_questions': self.delay_between_questions,
+            'round_open': self.round_open,
+            'question_start_time': self.question_start_time,
+            'deadline': self.deadline,
+            'answers_received': self.answers_received,
+            'seq': self.seq,
+            'ready': list(self.ready_ids),
+            'seats': [(p.id, p.address, p.resume_token, p.name) for p in self.seats],
+            'players': [p.seat for p in self.players],
+            'left': list(self.deleted_players.items()),
+            'left_since_round': list(self.left_since_round),
+            'columns': self.board.columns()
+        }
+
+    @classmethod
+    def restore(cls, server, state: dict):
+        ''' The function rebuilds a game from its snapshot after a restart. Every player that was still in the game
+        is suspended until the recovery window ends, so the clients can resume their sessions '''
+        seats = [Player(None, tuple(address), player_id) for player_id, address, _, _ in state['seats']]
+        game = cls(state['game_id'], seats[0], server)
+        game.uid = state['uid']
+        game.version = state['version']
+        game.game_state = state['state']
+        game.started_at = state['started_at']
+        game.questions = [server.question_bank.get(question_id) for question_id in state['questions']]
+        game.current_question_index = state['question_index']
+        game.current_question = game.questions[game.current_question_index - 1] if game.current_question_index else None
+        game.current_round = state['round']
+        game.number_of_rounds = state['rounds']
+        game.round_time_limit = state['round_time_limit']
+        game.delay_between_questions = state['delay_between_questions']
+        game.question_start_time = state['question_start_time']
+        game.deadline = state['deadline']
+        game.answers_received = state['answers_received']
+        game.seq = state['seq']
+        game.ready_ids = set(state['ready'])
+        game.ready_players = len(game.ready_ids)
+        game.deleted_players = dict(state['left'])
+        game.left_since_round = [list(entry) for entry in state['left_since_round']]
+        game.board = Scoreboard()
+        game.board.load(state['columns'])
+        game.seats = seats
+        game.players = [seats[seat] for seat in state['players']]
+        for seat, (player, (_, _, token, name)) in enumerate(zip(seats, state['seats'])):
+            player.seat, player.game_id, player.resume_token, player.name = seat, game.id, token, name
+        if game.game_state == 'playing':
+            game.board.vectorize()
+        with game.lock:
+            grace = server.snapshots.recovery_window
+            for player in game.players:
+                game.suspended[player.id] = player
+                # the open round waits for the players that reconnect within the window, not only for the first one
+                game.recovering.add(player.id)
+                player.resume_timer = server.call_later(grace, lambda player=player: game.expire(player))
+            if state['round_open']:
+                # clients that resume in the middle of the round get its question again
+                game.round_open = True
+                game.history.append((game.seq, {'type': 'question', 'round': game.current_round - 1,
+                                                'question': game.current_question.question,
+                                                'options': game.current_question.options,
+                                                'sent_at': game.question_start_time}, None))
+            # the rounds keep their deadlines, a round whose time ran out while the server was down closes right away
+            if game.game_state == 'playing' and game.deadline is not None:
+                delay = max(0.0, game.deadline - server.clock.time())
+                game.round_timer = server.call_later(delay, game.check_time_up if game.round_open else game.next_round)
+        return game
+
+    def remove_player(self, player: Player):
+        ''' The function removes a player from the game for good '''
+        with self.lock:
+            if player in self.players:
+                game_log.info("player disconnected", game_id=self.id, player_id=player.id)
+                self.transition('leave', player.id)
+                self.server.sessions.pop(player.resume_token, None)
+                self.deleted_players[player.id] = self.board.score_of(player.seat)
+                # clients with score deltas learn about leaves of the waiting room with the first round result
+                self.left_since_round.append([player.id, self.deleted_players[player.id]])
                 self.players.remove(player)
+                # an answer of the open round no longer counts, neither for the tally nor for closing the round
+                if self.round_open and self.board.has_answered(player.seat):
+                    self.board.withdraw(player.seat)
+                    self.answers_received -= 1
                 try:
                     # Close connections to the player
-                    player.socket.close()
-                    player.socket = None 
+                    player.close(flush=False)
                 except Exception as e:
-                    print(f"Error closing socket for player {player.id}: {e}")
+                    game_log.warning("closing connection failed", game_id=self.id, player_id=player.id, error=str(e))
                 
                 # Check if there are still players in the room, 
                 # If not, finish the game
                 if self.game_state == 'waiting' and len(self.players) == 0:
-                    print(f"Game {self.id} has no players left. Ending game.")
+                    game_log.info("no players left", game_id=self.id)
                     self.server.remove_game(self.id)
                     return
                 
                 if self.game_state == 'playing' and len(self.players) == 0:
                     self.end_game()
+                elif self.game_state == 'waiting':
+                    # the players that are left may all be ready
+                    if player.id in self.ready_ids:
+                        self.ready_ids.discard(player.id)
+                        self.ready_players -= 1
+                    if self.ready_players and self.ready_players >= len(self.players) and self.event is None:
+                        self.start_game()
                 else:
                     # If a player is disconnected during a round, check if the round should be ended
-                    active_players = [p for p in self.players if p.socket]
-                    if self.answers_received >= len(active_players):
+                    if self.round_open and self.round_complete():
                         self.handle_all_answered()
     
+def player_name(message: dict):
+    ''' The function returns the name sent with a request to join a game, or None for an anonymous player.
+    Results are totalled by name on the leaderboards, anonymous players are not ranked there '''
+    name = message.get('name')
+    if not isinstance(name, str) or not name.strip():
+        return None
+    return name.strip()[:MAX_NAME_LENGTH]
+
 ''' The main class that creates and manages games and manages player connectivity to games ''' 
 class Server:
     def __init__(self):
         self.games: Dict[int, Game] = {} # List of all the games that have been created
+        self.waiting_games: Dict[int, Game] = {} # games in the waiting state that players can still join
         self.next_game_id = 0 # id for a new game instance 
         self.next_player_id = 0 # id for a new player instance 
         self.buffer_size = 10000 # buffer size for work with sockets
+        self.max_frame_size = DEFAULT_MAX_FRAME_SIZE # largest message accepted from a client
         self.lock = threading.Lock() # mutex for thread-safe access to shared data
+        self.clock = WallClock() # time of the game logic, a VirtualClock plays simulated games
+        self.scheduler = TimerWheel() # one thread that owns the round deadlines of all games, or the VirtualClock
+        self.rng = random.Random() # randomness of the question draws, seeded for repeatable simulations
+        self.question_bank = QuestionBank.load() # questions are read from disk once per process
+        self.writer = SocketWriter() # one thread that writes queued frames to slow sockets
+        self.outbox_max_frames = 256 # frames that may wait for one player before the slow consumer policy applies
+        self.outbox_max_bytes = 1 << 20 # bytes that may wait for one player
+        self.slow_consumer_policy = 'drop' # 'drop' disconnects a slow player, 'coalesce' drops superseded frames first
+        self.shard = 0 # index of this worker process, game and player ids end with it
+        self.shards = 1 # number of worker processes
+        self.handoff_paths = [] # Unix socket path of every worker, used to pass connections to the owner of a game
+        self.listen_socket = None # listening socket inherited from the supervisor
+        self.reuse_port = False # whether the workers share the port with SO_REUSEPORT
+        self.metrics_host = '127.0.0.1' # address of the metrics endpoint
+        self.metrics_port = 0 # port of the metrics endpoint of the first worker, 0 disables it
+        self.matchmaker = Matchmaker(self) # queue of the players that asked for quick play
+        self.results: ResultsStore = None # write-behind store of finished games, None disables it
+        self.journal: Journal = None # append-only journal of the state transitions of all games, None disables it
+        self.snapshots: SnapshotStore = None # periodic snapshots of the games in progress, None disables crash recovery
+        self.heartbeat = Heartbeat(self) # pings the connections and reaps the idle ones
+        self.admission = AdmissionControl() # connection limit and per-IP rate limits
+        self.conductor = Conductor(self) # scheduled events played in many rooms at once
+        self.sessions: Dict[str, Player] = {} # resume token -> player that holds the seat of the session
+        self.resume_grace = 30.0 # seconds a disconnected player keeps the seat, 0 disables resuming
+        self.resume_buffer = 64 # broadcasts kept per game for the players that resume
+        self.prefetch = True # whether clients that ask for it get the next question sealed before its round
+        self.delay_between_questions = 6 # seconds between the rounds of a game
+        self.round_time_limit = 40 # seconds players have to answer a question
+        REGISTRY.gauge('quiz_games', 'Games by state', ('state',), callback=self.games_by_state)
+        REGISTRY.gauge('quiz_outbox_queued_frames', 'Frames waiting in the outboxes of all players',
+                       callback=lambda: self.outbound_stats()['queued_frames'])
+        REGISTRY.gauge('quiz_outbox_max_depth', 'Deepest outbox of a connected player',
+                       callback=lambda: self.outbound_stats()['max_depth'])
+        REGISTRY.gauge('quiz_quick_play_queued', 'Players waiting for a quick play room',
+                       callback=lambda: len(self.matchmaker.queue))
+        REGISTRY.gauge('quiz_spectators', 'Connections that watch a game',
+                       callback=lambda: sum(len(game.spectators) for game in list(self.games.values())))
+        REGISTRY.gauge('quiz_scheduled_timers', 'Round timers waiting in the timer wheel',
+                       callback=lambda: self.scheduler.pending)
 
-    def createGame(self, player: Player) -> tuple[int, int]:
+    def createGame(self, player: Player, event=None) -> tuple[int, int]:
         ''' The function is responsible for the creation of the game instance. '''
-        game_id = self.next_game_id 
-        self.next_game_id += 1
-        game = Game(game_id, player, self)
+        with self.lock:
+            game_id = self.next_game_id * self.shards + self.shard
+            self.next_game_id += 1
+        game = Game(game_id, player, self, event)
+        game.transition('create', game.uid, player.id, format_address(player.address), [q.id for q in game.questions],
+                        game.number_of_rounds, game.round_time_limit, game.delay_between_questions, event.name if event else '')
         with self.lock:
             self.games[game_id] = game
+            # the rooms of an event are only filled by its conductor
+            if event is None:
+                self.waiting_games[game_id] = game
         # Return a unique id for the game and a unique in-game id for the player who created the game
         return game_id, player.id 
 
-    def connectGame(self, game_id: int, player: Player) -> tuple[int, int, list]:
+    def connectGame(self, game_id: int, player: Player, event=None) -> tuple[int, int, list]:
         ''' The function is responsible for connecting the player to the game '''
-        game = self.games[game_id]
+        game = self.waiting_games.get(game_id) if event is None else self.games.get(game_id)
         if game is None:                
             return (None, -1, [])      
-        player_id, list_players = game.handlePlayerConnect(player)
+        with game.lock:
+            # the game may have started since it was looked up
+            if game.game_state != 'waiting':
+                return (None, -1, [])
+            player_id, list_players = game.handlePlayerConnect(player)
         return (game_id, player_id, list_players)
 
-    def getMessage(self, client_socket: socket.socket) -> dict:
-        ''' The function receives the full json message of the player '''
-        data = client_socket.recv(self.buffer_size)
-        return json.loads(data.decode())
+    def create_room(self, seated: list) -> Game:
+        ''' The function creates a game for a batch of (player, request) pairs from the matchmaker and sends their status '''
+        game_id, _ = self.createGame(seated[0][0])
+        game = self.games[game_id]
+        with game.lock:
+            # players seated together need no "new player" notices
+            for player, _ in seated[1:]:
+                game.add_player(player)
+            list_players = [p.id for p in game.players]
+            for player, request in seated:
+                answer = {
+                    "type": "status",
+                    "player_id": player.id,
+                    "game_id": game_id,
+                    "list_of_players": list_players
+                }
+                self.send_status(player, game_id, request, answer)
+        return game
+
+    def join_room(self, game: Game, player: Player, request: dict):
+        ''' The function seats a quick play player in an open room and sends the status '''
+        game_id, player_id, list_players = self.connectGame(game.id, player)
+        answer = {
+            "type": "status",
+            "player_id": player_id,
+            "game_id": game_id,
+            "list_of_players": list_players
+        }
+        self.send_status(player, game_id, request, answer)
+
+    def game_started(self, game_id: int):
+        ''' The game left the waiting state, nobody can join it anymore '''
+        with self.lock:
+            self.waiting_games.pop(game_id, None)
+        self.matchmaker.discard_room(game_id)
+
+    def restore_games(self):
+        ''' The function restores the games of the snapshots taken before a restart and starts taking snapshots '''
+        if not self.snapshots:
+            return
+        for state in self.snapshots.load(self.clock.time()):
+            if self.resume_grace <= 0:
+                break # nobody could take the seats back
+            try:
+                game = Game.restore(self, state)
+            except Exception as e:
+                log.error("restoring game failed", game_id=state.get('game_id'), error=str(e))
+                continue
+            with self.lock:
+                self.games[game.id] = game
+                if game.game_state == 'waiting':
+                    self.waiting_games[game.id] = game
+                for player in game.players:
+                    self.sessions[player.resume_token] = player
+                # new games and players get ids after the restored ones
+                self.next_game_id = max(self.next_game_id, game.id // self.shards + 1)
+                self.next_player_id = max(self.next_player_id, max(p.id for p in game.seats) // self.shards + 1)
+            GAMES_RESTORED.inc()
+            log.info("game restored", game_id=game.id, state=game.game_state, round=game.current_round,
+                     players=len(game.players))
+        self.snapshots.start(self)
+
+    def call_later(self, delay, callback):
+        ''' The function runs the callback after the delay and returns a handle with a cancel() method '''
+        self.scheduler.start()
+        return self.scheduler.call_later(delay, callback)
+
+    def make_outbox(self, client_socket):
+        ''' The function creates the queue of outgoing frames of a new connection '''
+        # sockets are non-blocking so that a slow client never blocks the thread that sends to it
+        client_socket.setblocking(False)
+        self.writer.start()
+        return SocketOutbox(client_socket, self.writer, max_frames=self.outbox_max_frames,
+                            max_bytes=self.outbox_max_bytes, policy=self.slow_consumer_policy)
+
+    def outbound_stats(self) -> dict:
+        ''' The function returns the queue depth metrics of all connected players '''
+        stats = {'players': 0, 'queued_frames': 0, 'queued_bytes': 0, 'max_depth': 0, 'overflows': 0, 'coalesced_frames': 0}
+        with self.lock:
+            games = list(self.games.values())
+        for game in games:
+            for player in list(game.players) + list(game.spectators.values()):
+                if not player.outbox:
+                    continue
+                stats['players'] += 1
+                stats['queued_frames'] += player.outbox.depth
+                stats['queued_bytes'] += player.outbox.queued_bytes
+                stats['max_depth'] = max(stats['max_depth'], player.outbox.max_depth)
+                stats['overflows'] += player.outbox.overflows
+                stats['coalesced_frames'] += player.outbox.coalesced_frames
+        return stats
+
+    def games_by_state(self) -> dict:
+        states = {'waiting': 0, 'playing': 0, 'finished': 0}
+        with self.lock:
+            games = list(self.games.values())
+        for game in games:
+            states[game.game_state] = states.get(game.game_state, 0) + 1
+        return states
+
+    def start_metrics(self):
+        if self.metrics_port:
+            serve_metrics(self.metrics_host, self.metrics_port + self.shard)
+
+    def getMessage(self, player: Player) -> dict:
+        ''' The function returns the next full json message of the player, reading the socket only when no complete frame is buffered '''
+        message = player.decoder.next_message()
+        while message is None:
+            sock = player.socket
+            try:
+                data = sock.recv(self.buffer_size)
+            except BlockingIOError:
+                # wait until the non-blocking socket has data, select.select fails for descriptors above 1023
+                with selectors.DefaultSelector() as selector:
+                    selector.register(sock, selectors.EVENT_READ)
+                    selector.select()
+                continue
+            if not data:
+                raise ConnectionResetError("Connection closed by peer")
+            player.last_seen = self.clock.monotonic()
+            player.decoder.feed(data)
+            message = player.decoder.next_message()
+        return message
+
+    def new_player(self, client_socket, client_addr) -> Player:
+        ''' The function creates a player with a unique id for a new connection '''
+        with self.lock:
+            player_id = self.next_player_id * self.shards + self.shard
+            self.next_player_id += 1
+        log.debug("new connection", player_id=player_id, address=client_addr[0])
+        player = Player(client_socket, client_addr, player_id)
+        player.decoder = FrameDecoder(self.max_frame_size)
+        player.outbox = self.make_outbox(client_socket)
+        player.on_close = self.admission.release
+        player.message_bucket = self.admission.message_bucket(client_addr[0])
+        ACTIVE_CONNECTIONS.inc()
+        self.heartbeat.track(player)
+        return player
+
+    def refuse(self, client_socket: socket.socket, client_addr, reason: str):
+        ''' The function answers a connection that was not admitted with a "busy" frame and closes it '''
+        log.debug("connection refused", address=client_addr[0], reason=reason)
+        try:
+            # the frame fits the empty send buffer of a new socket, so the accept loop never waits here
+            client_socket.setblocking(False)
+            client_socket.send(self.admission.busy_frame(reason, client_addr[0]))
+        except OSError:
+            pass
+        client_socket.close()
+
+    def throttled(self, player: Player) -> bool:
+        ''' The function returns True if the message of the player is over the rate limit of its IP and must be dropped '''
+        if player.message_bucket is None or player.message_bucket.take():
+            player.throttled = False
+            return False
+        MESSAGES_THROTTLED.inc()
+        if not player.throttled:
+            # one notice per burst of dropped messages
+            player.throttled = True
+            player.send_message({'type': 'busy', 'reason': 'rate', 'retry_after': round(player.message_bucket.wait_time(), 2)})
+        return True
+
+    def send_status(self, player: Player, game_id: int, request: dict, answer: dict, snapshot=True):
+        ''' The function sends the json status of a successful handshake and switches the player to the requested encoding
+        and score updates, clients that asked for score deltas get a snapshot of the scores unless broadcasts are replayed '''
+        codec = CODECS.get(request.get('encoding'), JSON) # unknown encodings fall back to json
+        if 'encoding' in request:
+            answer['encoding'] = codec.name # old clients never ask and get the old status
+        CONNECTIONS_BY_ENCODING.inc(codec.name)
+        # holding the game lock keeps broadcasts from queueing a frame between the status and the switch,
+        # the decoder is switched first because the client may answer in the new encoding right away
+        game = self.games.get(game_id)
+        if self.resume_grace > 0 and not player.spectator:
+            if player.resume_token is None:
+                player.resume_token = secrets.token_urlsafe(16)
+                with self.lock:
+                    self.sessions[player.resume_token] = player
+            answer['resume_token'] = player.resume_token
+        with game.lock if game else self.lock, player.send_lock:
+            if game:
+                answer.setdefault('seq', game.seq) # the broadcasts up to this one are covered by the status
+                game.version += 1 # the snapshot of the game keeps the resume token
+            if request.get('scores') == 'delta':
+                player.score_deltas = True
+                answer['scores'] = 'delta' # old servers do not echo it and keep sending full score lists
+                if game and snapshot:
+                    answer['snapshot'] = game.snapshot()
+            if request.get('prefetch') and self.prefetch:
+                player.prefetch = True
+                answer['prefetch'] = True
+            if request.get('heartbeat'):
+                player.heartbeat = True
+                answer['heartbeat'] = True # old clients have no ping handler and are never pinged
+            player.use_codec(codec, self.max_frame_size)
+            # set before the status goes out, the client may resume the session as soon as it has the token
+            player.game_id = game_id
+            player.send(JSON.encode(answer), answer['type'])
+            if game and player.prefetch:
+                # the question of the next round may already be sealed for the others
+                game.send_prefetch([player])
+
+    def handle_lobby_message(self, player: Player, message: dict):
+        ''' The function handles a request to create or connect to a game and returns the id of the joined game or None '''
+        MESSAGES_RECEIVED.inc(message['type'] if message.get('type') in CLIENT_MESSAGE_TYPES else 'unknown')
+        if self.throttled(player):
+            return None
+        if message['type'] == 'pong':
+            self.heartbeat.pong(player, message)
+            return None
+        player.last_request = self.clock.monotonic()
+        if message['type'] in ('create', 'connect', 'quick play', 'join event'):
+            player.name = player_name(message)
+        # If there was a request to create a new game, 
+        # create the game and send the response to the client 
+        if message['type'] == 'create':
+            self.matchmaker.cancel(player)
+            game_id, player_id = self.createGame(player)
+            answer = {
+                "type": "status",
+                "player_id": player_id,
+                "game_id": game_id,
+                "list_of_players": [player_id]
+            }
+            self.send_status(player, game_id, message, answer)
+            return game_id
+        # If there was a request to connect to the game, 
+        # try to connect the player to the game and send the corresponding response 
+        elif message['type'] in ('connect', 'resume', 'spectate'):
+            self.matchmaker.cancel(player)
+            try:
+                game_id = int(message['game_id'])
+            except (TypeError, ValueError):
+                game_id = -1 # an id that is not a number does not exist
+            # the game of another worker process is served by that process, negative ids exist nowhere
+            if self.shards > 1 and game_id >= 0 and shard_of(game_id, self.shards) != self.shard:
+                if self.handoff(player, message, shard_of(game_id, self.shards)):
+                    return HANDED_OFF
+            if message['type'] == 'resume':
+                return self.resume_session(player, game_id, message)
+            if message['type'] == 'spectate':
+                return self.spectate(player, game_id, message)
+            # if the game exists and waits for players, connect the player to the game
+            game_id, player_id, list_players = self.connectGame(game_id, player)
+            # if room does not exist or is not in waiting state, send an error message
+            if game_id is None:
+                self.game_not_found(player, message)
+                return None # if connection to the game fails, the client can try again
+
+            answer = {
+                "type": "status",
+                "player_id": player_id,
+                "game_id": game_id,
+                "list_of_players": list_players
+            }
+            self.send_status(player, game_id, message, answer)
+            return game_id
+        # If there was a request for quick play, the matchmaker seats the player now or later
+        elif message['type'] == 'quick play':
+            return self.matchmaker.request(player, message)
+        # If there was a request to join a scheduled event, the conductor seats the player in one of its rooms
+        elif message['type'] == 'join event':
+            self.matchmaker.cancel(player)
+            # the events are conducted by one worker process, the ids of their rooms route later requests there
+            if self.shards > 1 and self.shard != EVENT_SHARD:
+                if self.handoff(player, message, EVENT_SHARD):
+                    return HANDED_OFF
+            game_id = self.conductor.join(player, message)
+            if game_id is None:
+                self.game_not_found(player, message)
+            return game_id
+        # If the message is of unknown type
+        else:
+            log.warning("unknown lobby message", player_id=player.id, type=message.get('type'))
+        return None
+
+    def game_not_found(self, player: Player, request: dict):
+        ''' The function answers a request for a game that does not exist or can not be joined '''
+        error_message = {
+            "type": "status",
+            "player_id": player.id,
+            "game_id": None, 
+            "list_of_players": []
+        }
+        player.send_message(error_message)
+        log.info("game not found", game_id=request.get('game_id'), player_id=player.id)
+
+    def spectate(self, player: Player, game_id: int, request: dict):
+        ''' The function lets the connection watch a game in any state and sends the status '''
+        game = self.games.get(game_id)
+        if game is None:
+            self.game_not_found(player, request)
+            return None
+        # the lock keeps broadcasts from slipping in between the status and the first frame
+        with game.lock:
+            if not game.add_spectator(player):
+                self.game_not_found(player, request)
+                return None
+            answer = {
+                "type": "status",
+                "player_id": player.id,
+                "game_id": game_id,
+                "list_of_players": [p.id for p in game.players],
+                "round": game.current_round - 1, # round of the last question, -1 before the game starts
+                "spectator": True
+            }
+            self.send_status(player, game_id, request, answer)
+        return game_id
+
+    def resume_session(self, player: Player, game_id: int, request: dict):
+        ''' The function gives a new connection the seat of a dropped session and replays the broadcasts it missed '''
+        with self.lock:
+            session = self.sessions.get(request.get('token'))
+        game = self.games.get(game_id)
+        last_seq = request.get('last_seq')
+        resumed = None
+        if session is not None and game is not None and session.game_id == game_id and isinstance(last_seq, int):
+            with game.lock:
+                self.heartbeat.forget(player) # the connection takes over the id of the session
+                # clients that keep the scores themselves can resume from a snapshot when the history is too short
+                resumed = game.resume(session, player, last_seq, snapshot=request.get('scores') == 'delta')
+                self.heartbeat.track(player)
+                if resumed is not None:
+                    seq, missed, snapshot = resumed
+                    with self.lock:
+                        self.sessions[player.resume_token] = player
+                    answer = {
+                        "type": "status",
+                        "player_id": player.id,
+                        "game_id": game_id,
+                        "list_of_players": [p.id for p in game.players],
+                        "seq": seq, # the replayed broadcasts follow
+                        "resumed": True
+                    }
+                    self.send_status(player, game_id, request, answer, snapshot=snapshot)
+                    for message, delta in missed:
+                        player.send_message(delta if delta is not None and player.score_deltas else message)
+                    # the player may have answered before a restart, the round of a restored game waited for it
+                    if game.round_open and game.round_complete():
+                        game.handle_all_answered()
+                    return game_id
+        log.info("resume failed", game_id=request.get('game_id'), player_id=player.id)
+        player.send_message({
+            "type": "status",
+            "player_id": player.id,
+            "game_id": None,
+            "list_of_players": [],
+            "resumed": False
+        })
+        return None
+
+    def seated_while_waiting(self, player: Player, message: dict) -> bool:
+        ''' The matchmaker seats queued players from another thread or callback, the first message
+        after that belongs to the game and is put back for the game loop '''
+        if player.game_id is None:
+            return False
+        player.decoder.unread(message)
+        return True
+
+    def leave_lobby(self, player: Player):
+        ''' The function cleans up after a connection that ended before the game loop took over '''
+        self.matchmaker.cancel(player)
+        game = self.games.get(player.game_id) if player.game_id is not None else None
+        if game:
+            game.handle_disconnect(player)
+        else:
+            player.close(flush=False)
+
+    def drop_connection(self, player: Player):
+        ''' The function disconnects a player that stopped responding, the reader of the connection then sees it closed '''
+        self.leave_lobby(player)
+        if player.socket:
+            # the game already ended or the player was never seated in it
+            player.close(flush=False)
+
+    def raw_socket(self, player: Player):
+        return player.socket
+
+    def handoff(self, player: Player, message: dict, shard: int) -> bool:
+        ''' The function passes the connection of the player to another worker process '''
+        messages, data = player.decoder.take_pending()
+        data += self.buffered_input(player)
+        try:
+            send_connection(self.handoff_paths[shard], self.raw_socket(player), player.address, [message] + messages, data)
+        except OSError as e:
+            log.error("handoff failed", player_id=player.id, shard=shard, error=str(e))
+            player.decoder.restore(messages, data)
+            return False
+        log.debug("player handed off", player_id=player.id, shard=shard)
+        player.detach()
+        return True
+
+    def buffered_input(self, player: Player) -> bytes:
+        ''' The function takes the bytes received for the player that its decoder has not seen, the reader threads
+        leave them in the socket, which is passed on '''
+        return b''
+
+    def adopt_connection(self, client_socket: socket.socket, client_addr, messages: list, data: bytes):
+        ''' The function serves a connection handed off by another worker process '''
+        # the connection rate of the IP was already checked by the worker that accepted it
+        reason = self.admission.admit(client_addr[0], rate_limited=False)
+        if reason:
+            self.refuse(client_socket, client_addr, reason)
+            return
+        self.start_client_thread(client_socket, client_addr, (messages, data))
+
+    def start_handoff_listener(self):
+        if self.shards > 1:
+            HandoffListener(self.handoff_paths[self.shard], self.adopt_connection).start()
+
+    def handle_game_message(self, player: Player, game: Game, message: dict):
+        ''' The function dispatches a message from a player who is already in the game '''
+        MESSAGES_RECEIVED.inc(message['type'] if message.get('type') in CLIENT_MESSAGE_TYPES else 'unknown')
+        if self.throttled(player):
+            return
+        if player.spectator and message['type'] != 'pong':
+            log.debug("message of a spectator ignored", game_id=game.id, player_id=player.id, type=message.get('type'))
+        elif message['type'] == 'ready to start':
+            game.handle_ready(player)
+            
+        elif message['type'] == 'answer':
+            game.process_answer(player, message['round'], message['answer'])
+        elif message['type'] == 'pong':
+            self.heartbeat.pong(player, message)
+        else:
+            log.warning("unknown game message", game_id=game.id, player_id=player.id, type=message.get('type'))
 
     def manage_new_connection(self):
         ''' Starts a main loop in which it handles the connection of new players '''
         while True:
             # Pending connection of a new player  
-            client_socket, client_addr = self.server_socket.accept()
+            try:
+                client_socket, client_addr = self.server_socket.accept()
+            except OSError as e:
+                # out of file descriptors or memory, back off instead of ending the accept loop
+                log.error("accept failed", error=str(e))
+                time.sleep(0.1)
+                continue
+            # Refuse the connection before a thread is started for it if the server is full
+            reason = self.admission.admit(client_addr[0])
+            if reason:
+                self.refuse(client_socket, client_addr, reason)
+                continue
             # Start a thread to process a new connection 
-            client_thread = threading.Thread(
+            self.start_client_thread(client_socket, client_addr)
+
+    def start_client_thread(self, client_socket: socket.socket, client_addr, pending=None):
+        ''' The function starts the thread of an admitted connection '''
+        try:
+            threading.Thread(
                 target=self.handle_client,
-                args=(client_socket, client_addr),
+                args=(client_socket, client_addr, pending),
                 daemon=True
-            )
-            client_thread.start()
-            print(f"Started thread for {client_addr}")
+            ).start()
+        except RuntimeError as e:
+            # the process can not start more threads
+            log.error("connection thread not started", address=client_addr[0], error=str(e))
+            self.admission.release()
+            self.refuse(client_socket, client_addr, 'capacity')
+            return
+        log.debug("connection thread started", address=client_addr[0])
         
-    def handle_client(self, client_socket: socket.socket, client_addr):
+    def handle_client(self, client_socket: socket.socket, client_addr, pending=None):
         ''' The function handles requests from the client to create a game or connect to a game '''
-        with self.lock:
-            player_id = self.next_player_id
-            self.next_player_id += 1
-        player = Player(client_socket, client_addr, player_id)
-        print(f"New connection from {client_addr[0]}: {client_addr[1]}. ")
+        player = self.new_player(client_socket, client_addr)
+        if pending:
+            player.decoder.restore(*pending)
 
         # Loop to handle multiple requests from a client
-        while True:
+        game_id = None
+        while game_id is None:
             try:
                 # Waiting for a message from the client 
-                message = self.getMessage(client_socket)
-                print(f"Got message from {client_addr[0]}: {client_addr[1]}: {message}")
-
-                # If there was a request to create a new game, 
-                # create the game and send the response to the client 
-                if message['type'] == 'create':
-                    game_id, player_id = self.createGame(player)
-                    answer = {
-                        "type": "status",
-                        "player_id": player_id,
-                        "game_id": game_id,
-                        "list_of_players": [player_id]
-                    }
-                    client_socket.send((json.dumps(answer) + '\n').encode())
+                message = self.getMessage(player)
+                log.debug("message received", player_id=player.id, type=message.get('type'))
+                if self.seated_while_waiting(player, message):
+                    game_id = player.game_id
                     break
-                # If there was a request to connect to the game, 
-                # try to connect the player to the game and send the corresponding response 
-                elif message['type'] == 'connect':
-                    game_id = int(message['game_id'])
-                    # if room does not exist or is not in waiting state, send an error message
-                    if (game_id not in self.games) or (self.games[game_id].game_state != "waiting"):
-                        error_message = {
-                            "type": "status",
-                            "player_id": player_id,
-                            "game_id": None, 
-                            "list_of_players": []
-                        }
-                        client_socket.send((json.dumps(error_message) + '\n').encode())
-                        print(f"Player {client_addr[0]}:{client_addr[1]} tried to connect to a non-existent game {game_id}.")
-                        continue # if connection to the game fails, continue the cycle so that the client can try again
-
-                    # if the game exists, connect the player to the game
-                    game_id, player_id, list_players = self.connectGame(game_id, player)
-                    answer = {
-                        "type": "status",
-                        "player_id": player_id,
-                        "game_id": game_id,
-                        "list_of_players": list_players
-                    }
-                    client_socket.send((json.dumps(answer) + '\n').encode())
-                    break  
-                # If the message is of unknown type
-                else:
-                    print("Error") 
+                game_id = self.handle_lobby_message(player, message)
 
             except json.JSONDecodeError:
-                print(f"Invalid JSON message from {client_addr[0]}:{client_addr[1]}. Closing connection.")
-                break
+                log.warning("invalid message, closing connection", player_id=player.id)
+                self.leave_lobby(player)
+                return
             except Exception as e:
-                print(f"Error handling client {client_addr[0]}:{client_addr[1]}: {e}")
-                break
+                log.info("lobby connection closed", player_id=player.id, error=str(e))
+                self.leave_lobby(player)
+                return
+        if game_id is HANDED_OFF:
+            return
 
         # Create a separate thread to listen to messages from the player 
         player_thread = threading.Thread(
@@ -441,9 +1358,9 @@ class Server:
         
     # function for listening to messages from the player and processing them
     def listen_to_player(self, player: Player, game_id):
-        game = self.games[game_id]
+        game = self.games.get(game_id)
         if not game:
-            print(f"Game {game_id} not found for player {player.id}")
+            log.warning("game not found", game_id=game_id, player_id=player.id)
             return
         while True:
             try:
@@ -451,43 +1368,302 @@ class Server:
                 if not player.socket or not game._running: 
                     break
                 # Wait for a message from the player
-                message = self.getMessage(player.socket)
-                print(f"Got message from {player.address[0]}:{player.address[1]}: {message}")
+                message = self.getMessage(player)
+                log.debug("message received", game_id=game.id, player_id=player.id, type=message.get('type'))
 
                 # handle different message types
-                if message['type'] == 'ready to start':
-                    game.handle_ready(player)
-                    
-                elif message['type'] == 'answer':
-                    print("Get answer")
-                    game.process_answer(player, message['round'], message['answer'])
-                else:
-                    print(f"Unknown message type: {message['type']}")
+                self.handle_game_message(player, game, message)
                     
             except (ConnectionResetError, BrokenPipeError, OSError):
-                print(f"Player {player.address[0]}:{player.address[1]} disconnected.")
+                log.info("connection lost", game_id=game.id, player_id=player.id)
                 game.handle_disconnect(player)
                 break
             except Exception as e:
-                print(f"Seems that player disconnected {player.address[0]}:{player.address[1]}: {e}")
+                log.info("connection lost", game_id=game.id, player_id=player.id, error=str(e))
                 game.handle_disconnect(player)
                 break
     
     # function for removing the game from the list of active games     
     def remove_game(self, game_id: int):
         with self.lock:
-            if game_id in self.games:
-                print(f"Removing game {game_id}")
-                del self.games[game_id]
+            self.waiting_games.pop(game_id, None)
+            game = self.games.pop(game_id, None)
+            if game:
+                log.info("game removed", game_id=game_id)
+                # sessions end with the game
+                for player in game.seats:
+                    self.sessions.pop(player.resume_token, None)
+        if game:
+            if self.snapshots:
+                self.snapshots.discard(game_id)
+            # after the end game frame, or when the last player left a waiting room
+            game.close_connection_players(list(game.spectators.values()))
+        self.matchmaker.discard_room(game_id)
                 
     # function creates a socket, configures it, and starts listening for connections
     def serve(self, host, port, max_num_player):
-        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.server_socket.bind((host, port))
-        self.server_socket.listen(max_num_player)
-        print(f"Server is listening on {host}:{port} ")
+        if self.listen_socket:
+            self.server_socket = self.listen_socket
+        else:
+            self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            # a restarted server binds the port again while connections of the old process linger in TIME_WAIT
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if self.reuse_port:
+                self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            self.server_socket.bind((host, port))
+            self.server_socket.listen(max_num_player)
+        self.start_handoff_listener()
+        self.start_metrics()
+        self.restore_games()
+        self.heartbeat.start()
+        self.conductor.start()
+        log.info("server listening", host=host, port=port, mode="threads", shard=self.shard)
         self.manage_new_connection()
 
+
+class AsyncConnection:
+    ''' Socket-like wrapper around an asyncio stream writer, so Game can send to it like to a plain socket '''
+    def __init__(self, writer: asyncio.StreamWriter, reader: asyncio.StreamReader = None):
+        self.writer = writer
+        self.reader = reader # stream the connection is read from, its buffer goes along when the connection is handed off
+
+    def send(self, data: bytes) -> int:
+        # the transport buffers the data, so the write never blocks the event loop
+        if self.writer.is_closing():
+            raise ConnectionResetError("Connection is closed")
+        self.writer.write(data)
+        return len(data)
+
+    def sendall(self, data: bytes):
+        self.send(data)
+
+    def close(self):
+        self.writer.close()
+
+
+''' Server mode that runs accept, lobby handling, player reads and round timers on one asyncio event loop '''
+class AsyncServer(Server):
+    def __init__(self):
+        super().__init__()
+        self.loop: asyncio.AbstractEventLoop = None # event loop that runs the whole server
+
+    def call_later(self, delay, callback):
+        ''' Round timers are scheduled on the event loop instead of separate threads '''
+        return self.loop.call_later(delay, callback)
+
+    def raw_socket(self, player: Player):
+        return player.socket.writer.get_extra_info('socket')
+
+    def buffered_input(self, player: Player) -> bytes:
+        # the stream reader has already taken the bytes out of the socket, there is no way to take them without awaiting
+        reader = player.socket.reader
+        if reader is None:
+            return b''
+        data = bytes(reader._buffer)
+        reader._buffer.clear()
+        return data
+
+    def adopt_connection(self, client_socket: socket.socket, client_addr, messages: list, data: bytes):
+        ''' Connections handed off by other workers are moved to the event loop '''
+        asyncio.run_coroutine_threadsafe(self.adopt(client_socket, (messages, data)), self.loop)
+
+    async def adopt(self, client_socket: socket.socket, pending):
+        reader, writer = await asyncio.open_connection(sock=client_socket, limit=self.buffer_size)
+        await self.handle_connection(reader, writer, pending)
+
+    def make_outbox(self, connection: AsyncConnection):
+        ''' Every connection gets a task that drains its queue of outgoing frames '''
+        return StreamOutbox(connection.writer, max_frames=self.outbox_max_frames,
+                            max_bytes=self.outbox_max_bytes, policy=self.slow_consumer_policy)
+
+    async def read_message(self, reader: asyncio.StreamReader, player: Player) -> dict:
+        ''' The function returns the next full json message of the player, reading the stream only when no complete frame is buffered '''
+        message = player.decoder.next_message()
+        while message is None:
+            data = await reader.read(self.buffer_size)
+            if not data:
+                raise ConnectionResetError("Connection closed by peer")
+            player.last_seen = self.clock.monotonic()
+            player.decoder.feed(data)
+            message = player.decoder.next_message()
+        return message
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, pending=None):
+        ''' Coroutine that serves one client from the lobby until the end of the game '''
+        client_addr = writer.get_extra_info('peername')
+        # the connection rate of a handed off connection was already checked by the worker that accepted it
+        reason = self.admission.admit(client_addr[0], rate_limited=pending is None)
+        if reason:
+            log.debug("connection refused", address=client_addr[0], reason=reason)
+            writer.write(self.admission.busy_frame(reason, client_addr[0]))
+            writer.close()
+            return
+        player = self.new_player(AsyncConnection(writer, reader), client_addr)
+        if pending:
+            player.decoder.restore(*pending)
+
+        # Handle requests to create a game or connect to a game
+        game_id = None
+        while game_id is None:
+            try:
+                message = await self.read_message(reader, player)
+                log.debug("message received", player_id=player.id, type=message.get('type'))
+                if self.seated_while_waiting(player, message):
+                    game_id = player.game_id
+                    break
+                game_id = self.handle_lobby_message(player, message)
+            except json.JSONDecodeError:
+                log.warning("invalid message, closing connection", player_id=player.id)
+                self.leave_lobby(player)
+                return
+            except Exception as e:
+                log.info("lobby connection closed", player_id=player.id, error=str(e))
+                self.leave_lobby(player)
+                return
+        if game_id is HANDED_OFF:
+            return
+
+        game = self.games.get(game_id)
+        if not game:
+            log.warning("game not found", game_id=game_id, player_id=player.id)
+            player.close()
+            return
+
+        # Listen to messages from the player while the game is running
+        while player.socket and game._running:
+            try:
+                message = await self.read_message(reader, player)
+                log.debug("message received", game_id=game.id, player_id=player.id, type=message.get('type'))
+                self.handle_game_message(player, game, message)
+            except (ConnectionResetError, BrokenPipeError, OSError):
+                log.info("connection lost", game_id=game.id, player_id=player.id)
+                game.handle_disconnect(player)
+                break
+            except Exception as e:
+                log.info("connection lost", game_id=game.id, player_id=player.id, error=str(e))
+                game.handle_disconnect(player)
+                break
+
+    async def serve_forever(self, host, port, max_num_player):
+        self.loop = asyncio.get_running_loop()
+        if self.listen_socket:
+            server = await asyncio.start_server(self.handle_connection, sock=self.listen_socket, backlog=max_num_player)
+        else:
+            server = await asyncio.start_server(self.handle_connection, host, port, backlog=max_num_player,
+                                                reuse_port=self.reuse_port or None)
+        self.start_handoff_listener()
+        self.start_metrics()
+        self.restore_games()
+        self.heartbeat.start()
+        self.conductor.start()
+        log.info("server listening", host=host, port=port, mode="asyncio", shard=self.shard)
+        async with server:
+            await server.serve_forever()
+
+    # function starts the event loop and serves connections until interrupted
+    def serve(self, host, port, max_num_player):
+        asyncio.run(self.serve_forever(host, port, max_num_player))
+
+
+def create_server(options: dict) -> Server:
+    ''' The function creates a server configured with the command line options '''
+    server = AsyncServer() if options['mode'] == 'asyncio' else Server()
+    server.max_frame_size = options['max_frame_size']
+    server.slow_consumer_policy = options['slow_consumer']
+    server.outbox_max_frames = options['outbox_frames']
+    server.metrics_port = options['metrics_port']
+    server.matchmaker.room_size = options['room_size']
+    server.matchmaker.max_wait = options['quick_play_wait']
+    server.admission.max_connections = options['max_connections']
+    server.admission.connect_rate = options['ip_connect_rate']
+    server.admission.connect_burst = options['ip_connect_burst']
+    server.admission.message_rate = options['ip_message_rate']
+    server.admission.message_burst = options['ip_message_burst']
+    server.resume_grace = options['resume_grace']
+    server.resume_buffer = options['resume_buffer']
+    server.prefetch = not options['no_prefetch']
+    server.heartbeat.interval = options['heartbeat_interval']
+    server.heartbeat.idle_timeout = options['idle_timeout']
+    server.heartbeat.lobby_timeout = options['lobby_timeout']
+    if options['results_db']:
+        server.results = ResultsStore(options['results_db'])
+    if options['journal']:
+        server.journal = Journal(options['journal'], flush_interval=options['journal_sync_interval'])
+    if options['snapshots']:
+        server.snapshots = SnapshotStore(options['snapshots'], interval=options['snapshot_interval'],
+                                         recovery_window=options['recovery_window'])
+    server.conductor.room_size = options['event_room_size']
+    for name, start_in in options['event'] or []:
+        server.conductor.schedule(name, start_in)
+    return server
+
+
 if (__name__ == '__main__'):
-    server = Server() 
-    server.serve(HOST, PORT, 25) 
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='TCP quiz game server')
+    parser.add_argument('--mode', choices=['threads', 'asyncio'], default='threads',
+                        help='threads: a thread per connection, asyncio: all connections on one event loop')
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--backlog', type=int, default=25, help='size of the accept queue')
+    parser.add_argument('--max-frame-size', type=int, default=DEFAULT_MAX_FRAME_SIZE,
+                        help='largest message in bytes accepted from a client')
+    parser.add_argument('--slow-consumer', choices=SLOW_CONSUMER_POLICIES, default='drop',
+                        help='drop: disconnect a player whose queue is full, coalesce: drop superseded frames first')
+    parser.add_argument('--outbox-frames', type=int, default=256, help='frames that may be queued for one player')
+    parser.add_argument('--room-size', type=int, default=4, help='players in a full quick play room')
+    parser.add_argument('--quick-play-wait', type=float, default=10.0,
+                        help='seconds a quick play player waits before a room with fewer players is created')
+    parser.add_argument('--max-connections', type=int, default=10000,
+                        help='open connections per process, more are refused with a "busy" frame, 0 means no limit')
+    parser.add_argument('--ip-connect-rate', type=float, default=0.0,
+                        help='new connections per second from one IP, 0 disables the limit')
+    parser.add_argument('--ip-connect-burst', type=int, default=20, help='new connections one IP may open at once')
+    parser.add_argument('--ip-message-rate', type=float, default=0.0,
+                        help='messages per second from one IP, more are dropped, 0 disables the limit')
+    parser.add_argument('--ip-message-burst', type=int, default=50, help='messages one IP may send at once')
+    parser.add_argument('--resume-grace', type=float, default=30.0,
+                        help='seconds a disconnected player keeps the seat and may resume the session, 0 disables it')
+    parser.add_argument('--resume-buffer', type=int, default=64,
+                        help='broadcast messages kept per game to replay to players that resume')
+    parser.add_argument('--no-prefetch', action='store_true',
+                        help='always broadcast the full question at the start of a round, never a sealed one before it')
+    parser.add_argument('--heartbeat-interval', type=float, default=5.0,
+                        help='seconds between pings of every connection, 0 disables heartbeats and the idle reaper')
+    parser.add_argument('--idle-timeout', type=float, default=30.0,
+                        help='seconds without any data, pongs included, after which a connection is closed')
+    parser.add_argument('--lobby-timeout', type=float, default=120.0,
+                        help='seconds a connection may stay in the lobby without joining a game')
+    parser.add_argument('--event', type=parse_event, action='append',
+                        help='schedule an event NAME@SECONDS that starts after SECONDS, players join it with "join event"; '
+                             'with several workers all rooms of the events are served by worker 0, which ranks them in one standings')
+    parser.add_argument('--event-room-size', type=int, default=100, help='players per room of an event')
+    parser.add_argument('--results-db', default='results.db',
+                        help='SQLite file that stores finished games and leaderboards, an empty value disables it')
+    parser.add_argument('--journal',
+                        help='append every game transition to this binary journal (worker i appends to FILE.i), '
+                             'off by default because the file is not rotated; read it with journal.py')
+    parser.add_argument('--journal-sync-interval', type=float, default=0.2,
+                        help='seconds between two batched writes and fsyncs of the journal')
+    parser.add_argument('--snapshots',
+                        help='directory of the periodic snapshots of the games in progress, which are restored after a restart '
+                             '(worker i uses DIR.i), off by default')
+    parser.add_argument('--snapshot-interval', type=float, default=1.0, help='seconds between two snapshots of the changed games')
+    parser.add_argument('--recovery-window', type=float, default=30.0,
+                        help='seconds after a restart in which the players of restored games may resume their sessions, '
+                             'older snapshots are not restored')
+    parser.add_argument('--metrics-port', type=int, default=0,
+                        help='serve metrics on http://127.0.0.1:PORT/metrics (worker i uses PORT+i), 0 disables it')
+    parser.add_argument('--log-level', choices=list(LEVELS), default='info')
+    parser.add_argument('--log-sample', type=parse_sample_rates, default={},
+                        help='fraction of debug and info records kept per module, e.g. game=0.1,server=0.5')
+    parser.add_argument('--log-file', help='write json log lines to this file instead of stdout')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of worker processes that share the port, games are sharded between them')
+    args = parser.parse_args()
+    configure_logging(args.log_level, args.log_sample, args.log_file)
+
+    if args.workers > 1:
+        run_supervisor(vars(args), args.workers)
+    else:
+        server = create_server(vars(args))
+        server.serve(args.host, args.port, args.backlog)
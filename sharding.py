@@ -0,0 +1,146 @@
+import base64
+import json
+import multiprocessing
+import os
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import threading
+
+from structured_log import get_logger, flush as flush_log
+
+log = get_logger('sharding')
+
+HANDOFF_BUFFER_SIZE = 1 << 16 # size of the first read of a handed off connection
+EVENT_SHARD = 0 # worker process that conducts the scheduled events and serves all of their rooms
+
+
+def sharding_supported() -> bool:
+    ''' Connections are passed between worker processes as file descriptors over Unix sockets '''
+    return hasattr(socket, 'send_fds') and hasattr(socket, 'AF_UNIX')
+
+
+def shard_of(entity_id: int, shards: int) -> int:
+    ''' Game and player ids encode the worker process that owns them '''
+    return entity_id % shards
+
+
+def send_connection(path: str, sock, address, messages: list, data: bytes):
+    ''' The function passes an accepted client socket and its unprocessed input to the worker listening on path '''
+    payload = json.dumps({
+        'address': list(address),
+        'messages': messages,
+        'data': base64.b64encode(data).decode()
+    }).encode()
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as channel:
+        channel.connect(path)
+        sent = socket.send_fds(channel, [payload], [sock.fileno()])
+        channel.sendall(payload[sent:])
+
+
+class HandoffListener:
+    ''' Thread that receives client sockets handed off by the other workers '''
+
+    def __init__(self, path: str, on_connection):
+        self.path = path # Unix socket path of this worker
+        self.on_connection = on_connection # called with (socket, address, messages, data)
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if os.path.exists(path):
+            os.unlink(path)
+        self.listener.bind(path)
+        self.listener.listen(128)
+        self._thread = threading.Thread(target=self._run, name='handoff-listener', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            channel, _ = self.listener.accept()
+            try:
+                with channel:
+                    payload, fds, _, _ = socket.recv_fds(channel, HANDOFF_BUFFER_SIZE, 1)
+                    while True:
+                        chunk = channel.recv(HANDOFF_BUFFER_SIZE)
+                        if not chunk:
+                            break
+                        payload += chunk
+                if not fds:
+                    continue
+                handoff = json.loads(payload)
+                sock = socket.socket(fileno=fds[0])
+                self.on_connection(sock, tuple(handoff['address']), handoff['messages'],
+                                   base64.b64decode(handoff['data']))
+            except Exception as e:
+                log.error("receiving handed off connection failed", error=str(e))
+
+
+def run_worker(shard: int, handoff_paths: list, options: dict, listen_socket=None):
+    ''' Entry point of a worker process that serves its own share of the games '''
+    import server
+    # exit normally on terminate so that buffered log records are written
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    worker = server.create_server(options)
+    worker.shard = shard
+    worker.shards = len(handoff_paths)
+    worker.handoff_paths = handoff_paths
+    worker.listen_socket = listen_socket
+    worker.reuse_port = listen_socket is None
+    if worker.journal:
+        # the journal is append-only, so every worker writes its own file
+        worker.journal.path = f"{worker.journal.path}.{shard}"
+    if worker.snapshots:
+        worker.snapshots.path = f"{worker.snapshots.path}.{shard}"
+    if shard != EVENT_SHARD:
+        # one conductor per event, so its standings rank all of its rooms, the other workers hand its players off
+        worker.conductor.events.clear()
+    log.info("worker started", shard=shard, pid=os.getpid())
+    try:
+        worker.serve(options['host'], options['port'], options['backlog'])
+    finally:
+        # worker processes end with os._exit, which skips atexit handlers
+        if worker.results:
+            worker.results.flush()
+        if worker.journal:
+            worker.journal.flush()
+        flush_log()
+
+
+def run_supervisor(options: dict, workers: int):
+    ''' The function starts the worker processes and waits for them.
+
+    With SO_REUSEPORT every worker binds the port itself and the kernel spreads new
+    connections between them, otherwise the workers inherit one listening socket. '''
+    if not sharding_supported():
+        raise SystemExit("Multi-process mode needs Unix sockets with file descriptor passing")
+
+    run_dir = tempfile.mkdtemp(prefix='quiz-shards-')
+    handoff_paths = [os.path.join(run_dir, f'shard-{i}.sock') for i in range(workers)]
+    context = multiprocessing.get_context('fork')
+    listen_socket = None
+    if not hasattr(socket, 'SO_REUSEPORT'):
+        listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listen_socket.bind((options['host'], options['port']))
+        listen_socket.listen(options['backlog'])
+
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    processes = [
+        context.Process(target=run_worker, args=(shard, handoff_paths, options, listen_socket), daemon=True)
+        for shard in range(workers)
+    ]
+    log.info("supervisor starting workers", pid=os.getpid(), workers=workers, host=options['host'], port=options['port'])
+    try:
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        log.info("stopping workers")
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        shutil.rmtree(run_dir, ignore_errors=True)
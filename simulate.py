@@ -0,0 +1,261 @@
+''' Simulation of many full games on the server engine with a virtual clock, no sockets and seeded randomness '''
+import argparse
+import hashlib
+import json
+import random
+import sys
+import time
+from collections import Counter
+
+from loadgen import parse_distribution, parse_range
+from journal import Journal
+from scheduler import VirtualClock
+from server import Server
+from structured_log import configure as configure_logging, LEVELS
+
+# messages that the server broadcasts to a game, simulated players count them for resuming like real clients
+BROADCAST_TYPES = ('new player', 'question', 'correct answer', 'end game')
+
+
+class SimulatedServer(Server):
+    ''' The server engine on virtual time. Its players are SimulatedConnection objects instead of sockets '''
+
+    def __init__(self, seed):
+        super().__init__()
+        self.clock = self.scheduler = VirtualClock()
+        self.rng = random.Random(seed)
+
+    def make_outbox(self, client_socket):
+        # the connection of a simulated player takes the frames itself
+        return client_socket
+
+
+class SimulatedConnection:
+    ''' Socket and outbox of a simulated player, queued frames are handed to the player at once '''
+
+    depth = queued_bytes = max_depth = overflows = coalesced_frames = 0 # nothing ever waits
+
+    def __init__(self, player):
+        self.player = player # SimulatedPlayer that reads the frames
+        self.open = True
+
+    def setblocking(self, flag):
+        pass
+
+    def push(self, frame: bytes, kind=None) -> bool:
+        if self.open:
+            self.player.receive(self, json.loads(frame))
+        return self.open
+
+    def close(self, flush=True):
+        self.open = False
+
+    def detach(self):
+        self.open = False
+
+
+class Room:
+    ''' The simulated players that play one game together '''
+
+    def __init__(self, size):
+        self.size = size
+        self.game_id = None
+        self.players = [] # SimulatedPlayer that got the status
+        self.rounds = 0 # rounds whose question reached a player of the room
+        self.result = None # "end game" message seen first by a player of the room
+        self.ended_at = None # virtual time of the end of the game
+
+
+class SimulatedPlayer:
+    def __init__(self, sim, index, room: Room):
+        self.sim = sim
+        self.index = index
+        self.room = room
+        self.rng = random.Random(sim.options.seed * 1000003 + index)
+        self.address = (f"10.{index >> 16 & 255}.{index >> 8 & 255}.{index & 255}", 40000 + index % 20000)
+        self.connection = None # connection in use
+        self.player = None # Player of the server for the connection
+        self.token = None # resume token from the status
+        self.seq = 0 # broadcasts received
+        self.stalled = False # whether the player stopped reading and sending, the heartbeats reap it
+
+    def connect(self):
+        self.connection = SimulatedConnection(self)
+        self.player = self.sim.server.new_player(self.connection, self.address)
+        self.sim.stats['connections'] += 1
+
+    def send(self, message: dict):
+        ''' The function delivers a message to the server like the reader of a real connection '''
+        player = self.player
+        if not player.socket:
+            return
+        player.last_seen = self.sim.clock.monotonic()
+        server = self.sim.server
+        if player.game_id is None:
+            server.handle_lobby_message(player, message)
+            return
+        game = server.games.get(player.game_id)
+        if game:
+            server.handle_game_message(player, game, message)
+
+    def later(self, delay, message: dict):
+        connection = self.connection
+        # a message of a connection that was dropped meanwhile is lost
+        self.sim.clock.call_later(delay, lambda: connection is self.connection and self.send(message))
+
+    def receive(self, connection, message: dict):
+        ''' The function reacts to a frame of the server, answers are sent later on the virtual clock '''
+        kind = message['type']
+        if self.stalled:
+            return
+        if kind in BROADCAST_TYPES:
+            self.seq += 1
+        if kind == 'status':
+            self.on_status(message)
+        elif kind == 'ping':
+            self.later(0.02, {'type': 'pong', 'seq': message['seq']})
+        elif kind == 'question':
+            self.on_question(message)
+        elif kind == 'end game':
+            if self.room.result is None:
+                self.room.result = message
+                self.room.ended_at = self.sim.clock.now
+
+    def on_status(self, message: dict):
+        if message['game_id'] is None:
+            self.sim.stats['resume_failed' if 'resumed' in message else 'join_failed'] += 1
+            return
+        self.token = message.get('resume_token', self.token)
+        if message.get('resumed'):
+            self.sim.stats['resumes'] += 1
+            return
+        self.seq = message.get('seq', 0)
+        room = self.room
+        room.game_id = message['game_id']
+        room.players.append(self)
+        if len(room.players) == room.size:
+            # everyone gets ready once the room is full, like the players of the load generator
+            for player in room.players:
+                player.later(self.rng.uniform(0.1, 1.0), {'type': 'ready to start'})
+
+    def on_question(self, message: dict):
+        options = self.sim.options
+        self.room.rounds = max(self.room.rounds, message['round'] + 1)
+        if self.rng.random() < options.disconnect_rate:
+            self.sim.clock.call_later(self.rng.uniform(0, 5), self.disconnect)
+        elif self.rng.random() < options.stall_rate:
+            self.sim.stats['stalls'] += 1
+            self.stalled = True
+        elif self.rng.random() < options.silent_rate:
+            self.sim.stats['silent'] += 1 # the round times out for this player
+        else:
+            self.sim.stats['answers'] += 1
+            self.later(options.answer_time(self.rng), {'type': 'answer', 'round': message['round'], 'answer': self.rng.randrange(4)})
+
+    def disconnect(self):
+        self.sim.stats['disconnects'] += 1
+        self.connection.open = False
+        self.sim.server.drop_connection(self.player)
+        if self.token and self.rng.random() < self.sim.options.resume_rate:
+            self.sim.clock.call_later(self.rng.uniform(1, 10), self.resume)
+
+    def resume(self):
+        self.connect()
+        self.send({'type': 'resume', 'game_id': self.room.game_id, 'token': self.token, 'last_seq': self.seq, 'heartbeat': True})
+
+
+class Simulation:
+    ''' Games of simulated players on a SimulatedServer, created every arrival seconds of virtual time '''
+
+    def __init__(self, options):
+        self.options = options
+        self.server = SimulatedServer(options.seed)
+        if options.journal:
+            self.server.journal = Journal(options.journal)
+        self.clock = self.server.clock
+        self.rng = random.Random(options.seed)
+        self.stats = Counter()
+        self.rooms = []
+
+    def start_room(self, first_index, size):
+        room = Room(size)
+        self.rooms.append(room)
+        creator = SimulatedPlayer(self, first_index, room)
+        creator.connect()
+        creator.send({'type': 'create', 'heartbeat': True})
+        for seat in range(1, size):
+            player = SimulatedPlayer(self, first_index + seat, room)
+            self.clock.call_later(0.05 * seat, lambda player=player: self.join(player))
+
+    def join(self, player: SimulatedPlayer):
+        player.connect()
+        player.send({'type': 'connect', 'game_id': player.room.game_id, 'heartbeat': True})
+
+    def run(self) -> dict:
+        started = time.perf_counter()
+        start_time = self.clock.now
+        index = 0
+        low, high = self.options.room_size
+        for number in range(self.options.games):
+            size = self.rng.randint(low, high)
+            self.clock.call_later(number * self.options.arrival, lambda index=index, size=size: self.start_room(index, size))
+            index += size
+        self.server.heartbeat.start()
+        callbacks = 0
+        # the heartbeats never stop, so time runs in steps until the last game ended or nothing else is scheduled
+        while self.clock.pending > 1 or len(self.rooms) < self.options.games:
+            callbacks += self.clock.run(until=self.clock.now + 60)
+            if len(self.rooms) == self.options.games and not self.server.games:
+                break
+        self.clock.stop()
+        if self.server.journal:
+            self.server.journal.close()
+        wall = time.perf_counter() - started
+        # the final scores of all games in the order of their ids, equal for equal seeds
+        finished = [room for room in self.rooms if room.result]
+        results = [(room.game_id, room.result['winner'], room.result['curr_score']) for room in finished]
+        return {
+            'games': self.options.games,
+            'players': index,
+            'games_finished': len(finished),
+            'rounds': sum(room.rounds for room in self.rooms),
+            **{key: self.stats[key] for key in ('answers', 'silent', 'disconnects', 'stalls',
+                                                 'resumes', 'resume_failed', 'join_failed', 'connections')},
+            'games_left': len(self.server.games),
+            'virtual_s': round(max([room.ended_at for room in finished], default=start_time) - start_time, 1),
+            'wall_s': round(wall, 2),
+            'games_per_s': round(self.options.games / wall, 1) if wall else None,
+            'callbacks': callbacks,
+            'digest': hashlib.sha256(json.dumps(sorted(results)).encode()).hexdigest()[:16]
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Plays many games on the server engine in virtual time')
+    parser.add_argument('--games', type=int, default=1000)
+    parser.add_argument('--room-size', type=parse_range, default=(4, 4), help='players per room, e.g. 4 or 2-8')
+    parser.add_argument('--arrival', type=float, default=0.5, help='seconds of virtual time between two new games')
+    parser.add_argument('--answer-time', type=parse_distribution, default=parse_distribution('uniform:0.5-10'),
+                        help='answer time distribution: fixed:S, uniform:A-B or exp:MEAN')
+    parser.add_argument('--silent-rate', type=float, default=0.05, help='probability that a player lets a round time out')
+    parser.add_argument('--disconnect-rate', type=float, default=0.01, help='probability per round that a player drops')
+    parser.add_argument('--stall-rate', type=float, default=0.005,
+                        help='probability per round that a player stops responding and is reaped by the heartbeats')
+    parser.add_argument('--resume-rate', type=float, default=0.5, help='probability that a dropped player resumes the session')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--journal', help='append the transitions of the simulated games to this journal file')
+    parser.add_argument('--log-level', choices=list(LEVELS), default='warning')
+    parser.add_argument('--json', action='store_true', help='print the report as json')
+    options = parser.parse_args()
+    configure_logging(options.log_level)
+
+    report = Simulation(options).run()
+    if options.json:
+        print(json.dumps(report, indent=2))
+        return
+    for key, value in report.items():
+        print(f"{key:>16}: {value}")
+
+
+if __name__ == '__main__':
+    sys.exit(main())
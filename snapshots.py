@@ -0,0 +1,147 @@
+import glob
+import json
+import os
+import threading
+import time
+from collections import deque
+
+from metrics import REGISTRY
+from structured_log import get_logger
+
+log = get_logger('snapshots')
+
+SNAPSHOTS_WRITTEN = REGISTRY.counter('quiz_snapshots_written_total', 'Snapshots written of games that changed')
+SNAPSHOTS_SKIPPED = REGISTRY.counter('quiz_snapshots_skipped_total', 'Snapshots put off because the game lock was busy')
+SNAPSHOT_LOCK_SECONDS = REGISTRY.histogram('quiz_snapshot_lock_hold_seconds', 'Time Game.lock is held to copy the state of a game')
+SNAPSHOT_PASS_SECONDS = REGISTRY.histogram('quiz_snapshot_pass_seconds', 'Time to snapshot all games that changed')
+GAMES_RESTORED = REGISTRY.counter('quiz_games_restored_total', 'Games restored from snapshots after a restart')
+
+
+class SnapshotStore:
+    ''' Periodic snapshots of the games in progress, one file per game, for crash recovery.
+
+    Every interval a background thread snapshots the games whose version changed
+    since their last snapshot. It holds the lock of a game only while Game.checkpoint
+    copies the fields and the score columns, which is measured, and gives up on a game
+    whose lock is not free within lock_timeout until the next pass. The copy is
+    serialized after the lock is released and written and fsynced to a temporary file
+    that then replaces the snapshot of the game, so a file is always complete. Games
+    that end only queue their id, the thread wakes up and removes their files, so no
+    game waits for the disk under its lock. After a restart the snapshots that are younger than
+    recovery_window are loaded and the server restores their games with every player
+    suspended, so the clients can resume their sessions. Rooms of events are not
+    snapshotted, their conductor does not survive a restart. '''
+
+    def __init__(self, path='snapshots', interval=1.0, recovery_window=30.0, lock_timeout=0.05):
+        self.path = path # directory of the snapshot files
+        self.interval = interval # seconds between two passes
+        self.recovery_window = recovery_window # seconds the players of a restored game have to resume
+        self.lock_timeout = lock_timeout # seconds a pass waits for the lock of a game
+        self.saved = {} # game id -> version of the game in its snapshot file, used by the writer thread only
+        self.ended = deque() # ids of the games that ended, their files are removed by the writer thread
+        self.wake = threading.Event() # set when a game ended
+        self._thread = None
+        self._start_lock = threading.Lock()
+
+    def file_of(self, game_id) -> str:
+        return os.path.join(self.path, f"game-{game_id}.json")
+
+    def start(self, server):
+        with self._start_lock:
+            if self._thread or self.interval <= 0:
+                return
+            os.makedirs(self.path, exist_ok=True)
+            self._thread = threading.Thread(target=self._run, args=(server,), name='snapshot-writer', daemon=True)
+            self._thread.start()
+
+    def _run(self, server):
+        next_pass = time.monotonic() + self.interval
+        while True:
+            self.wake.wait(max(0.0, next_pass - time.monotonic()))
+            self.wake.clear()
+            try:
+                self.remove_ended()
+                if time.monotonic() >= next_pass:
+                    next_pass = time.monotonic() + self.interval
+                    self.snapshot(server)
+            except Exception as e:
+                log.error("snapshot failed", error=str(e))
+
+    def snapshot(self, server) -> int:
+        ''' The function writes the snapshots of the games that changed and removes the ones of finished games,
+        returns the number of snapshots written '''
+        started = time.perf_counter()
+        written = 0
+        live = set()
+        for game in list(server.games.values()):
+            if game.event:
+                continue
+            live.add(game.id)
+            if self.saved.get(game.id) == game.version:
+                continue
+            if not game.lock.acquire(timeout=self.lock_timeout):
+                SNAPSHOTS_SKIPPED.inc()
+                continue
+            held = time.perf_counter()
+            try:
+                state = game.checkpoint()
+            finally:
+                game.lock.release()
+                SNAPSHOT_LOCK_SECONDS.observe(time.perf_counter() - held)
+            if server.games.get(game.id) is not game:
+                continue # the game ended while it was copied, its id is queued in ended
+            self.write(state, server.clock.time())
+            self.saved[game.id] = state['version']
+            SNAPSHOTS_WRITTEN.inc()
+            written += 1
+        for game_id in [game_id for game_id in self.saved if game_id not in live]:
+            self.remove(game_id)
+        SNAPSHOT_PASS_SECONDS.observe(time.perf_counter() - started)
+        return written
+
+    def discard(self, game_id):
+        ''' The function queues the removal of the snapshot of a game that ended, so it is never restored.
+        It is called under the lock of the game and does no I/O '''
+        self.ended.append(game_id)
+        self.wake.set()
+
+    def remove_ended(self):
+        while self.ended:
+            self.remove(self.ended.popleft())
+
+    def remove(self, game_id):
+        if self.saved.pop(game_id, None) is None:
+            return # never written
+        try:
+            os.remove(self.file_of(game_id))
+        except FileNotFoundError:
+            pass
+
+    def write(self, state: dict, now: float):
+        state['columns'] = {name: column.tolist() for name, column in state['columns'].items()}
+        state['saved_at'] = now
+        path = self.file_of(state['game_id'])
+        with open(path + '.tmp', 'w') as f:
+            json.dump(state, f, separators=(',', ':'))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+
+    def load(self, now: float) -> list:
+        ''' The function returns the snapshots that are younger than the recovery window, ordered by game id,
+        and removes the older ones '''
+        states = []
+        for path in glob.glob(os.path.join(self.path, 'game-*.json')):
+            try:
+                with open(path) as f:
+                    state = json.load(f)
+            except (OSError, ValueError) as e:
+                log.warning("reading snapshot failed", path=path, error=str(e))
+                continue
+            if now - state['saved_at'] > self.recovery_window or state['state'] == 'finished':
+                log.info("snapshot too old to restore", game_id=state['game_id'], age=round(now - state['saved_at'], 1))
+                os.remove(path)
+                continue
+            self.saved[state['game_id']] = state['version']
+            states.append(state)
+        return sorted(states, key=lambda state: state['game_id'])
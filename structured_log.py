@@ -0,0 +1,154 @@
+import atexit
+import json
+import os
+import random
+import sys
+import threading
+import time
+from collections import deque
+
+DEBUG, INFO, WARNING, ERROR = 10, 20, 30, 40
+LEVEL_NAMES = {DEBUG: 'debug', INFO: 'info', WARNING: 'warning', ERROR: 'error'}
+LEVELS = {name: level for level, name in LEVEL_NAMES.items()}
+
+
+class LogWriter:
+    ''' Ring buffer of log records that a background thread writes out as json lines.
+
+    Logging only appends a tuple to a bounded deque, which needs no lock of its own,
+    so a burst of records never blocks the thread that plays a round. Formatting and
+    writing happen on the writer thread. When the buffer is full the oldest records
+    are dropped and counted. '''
+
+    def __init__(self, stream=None, capacity=65536, flush_interval=0.1):
+        self.stream = stream or sys.stdout # where json lines are written
+        self.records = deque(maxlen=capacity) # (time, level, module, event, fields) tuples
+        self.flush_interval = flush_interval # seconds between two batches
+        self.dropped = 0 # records overwritten before they were written
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._start_lock = threading.Lock()
+
+    def start(self):
+        with self._start_lock:
+            if self._thread:
+                return
+            self._thread = threading.Thread(target=self._run, name='log-writer', daemon=True)
+            self._thread.start()
+            atexit.register(self.flush)
+
+    def restart_after_fork(self):
+        ''' A forked worker process has no writer thread and must not repeat the records of its parent '''
+        self.records.clear()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self.start()
+
+    def append(self, record):
+        if len(self.records) == self.records.maxlen:
+            self.dropped += 1
+        self.records.append(record)
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        ''' The function writes all buffered records in one batch '''
+        lines = []
+        while True:
+            try:
+                created, level, module, event, fields = self.records.popleft()
+            except IndexError:
+                break
+            entry = {'ts': round(created, 6), 'level': LEVEL_NAMES[level], 'module': module, 'event': event}
+            entry.update(fields)
+            lines.append(json.dumps(entry, default=str))
+        if self.dropped:
+            lines.append(json.dumps({'ts': round(time.time(), 6), 'level': 'warning', 'module': 'log',
+                                     'event': 'records dropped', 'count': self.dropped}))
+            self.dropped = 0
+        if lines:
+            try:
+                self.stream.write('\n'.join(lines) + '\n')
+                self.stream.flush()
+            except (OSError, ValueError):
+                pass # the output is gone, there is nobody to report it to
+
+
+class Logger:
+    ''' Logger of one module with its own sample rate for records below warning level '''
+
+    def __init__(self, module, config):
+        self.module = module
+        self.config = config
+
+    def enabled(self, level) -> bool:
+        if level < self.config.level:
+            return False
+        if level >= WARNING:
+            return True
+        rate = self.config.sample_rates.get(self.module, 1.0)
+        return rate >= 1.0 or random.random() < rate
+
+    def log(self, level, event, **fields):
+        if self.enabled(level):
+            self.config.writer.append((time.time(), level, self.module, event, fields))
+
+    def debug(self, event, **fields):
+        self.log(DEBUG, event, **fields)
+
+    def info(self, event, **fields):
+        self.log(INFO, event, **fields)
+
+    def warning(self, event, **fields):
+        self.log(WARNING, event, **fields)
+
+    def error(self, event, **fields):
+        self.log(ERROR, event, **fields)
+
+
+class LogConfig:
+    def __init__(self):
+        self.level = INFO # records below this level are skipped
+        self.sample_rates = {} # module -> fraction of its debug and info records that are kept
+        self.writer = LogWriter()
+        self.loggers = {}
+
+
+CONFIG = LogConfig() # logging configuration of the process
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=lambda: CONFIG.writer.restart_after_fork())
+
+
+def get_logger(module) -> Logger:
+    logger = CONFIG.loggers.get(module)
+    if logger is None:
+        logger = CONFIG.loggers[module] = Logger(module, CONFIG)
+    CONFIG.writer.start()
+    return logger
+
+
+def flush():
+    ''' The function writes the buffered records right away, e.g. before a worker process exits '''
+    CONFIG.writer.flush()
+
+
+def parse_sample_rates(text) -> dict:
+    ''' "game=0.1,server=0.5" -> {'game': 0.1, 'server': 0.5} '''
+    rates = {}
+    for item in filter(None, text.split(',')):
+        module, _, rate = item.partition('=')
+        rates[module.strip()] = float(rate)
+    return rates
+
+
+def configure(level='info', sample_rates=None, path=None):
+    ''' The function sets the level, the per-module sample rates and the output file of all loggers '''
+    CONFIG.level = LEVELS[level]
+    CONFIG.sample_rates = dict(sample_rates or {})
+    if path:
+        CONFIG.writer.stream = open(path, 'a', encoding='utf-8', buffering=1 << 16)
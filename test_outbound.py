@@ -0,0 +1,51 @@
+import unittest
+
+from outbound import Outbox
+
+
+class CoalesceTest(unittest.TestCase):
+    ''' A full outbox under the "coalesce" policy may only drop frames that a newer frame supersedes '''
+
+    def full_outbox(self, kind, count=4):
+        outbox = Outbox(max_frames=count, policy='coalesce')
+        for index in range(count):
+            self.assertTrue(outbox.push(f"{kind} {index}".encode(), kind))
+        return outbox
+
+    def test_new_player_frames_are_never_coalesced(self):
+        outbox = self.full_outbox('new player')
+        self.assertFalse(outbox.push(b'new player 4', 'new player'))
+        self.assertEqual(outbox.depth, 4)
+        self.assertEqual(outbox.coalesced_frames, 0)
+        self.assertEqual(outbox.overflows, 1)
+
+    def test_round_result_deltas_are_never_coalesced(self):
+        outbox = self.full_outbox('round result')
+        self.assertFalse(outbox.push(b'round result 4', 'round result'))
+        self.assertEqual([frame for _, frame in outbox.frames], [f"round result {index}".encode() for index in range(4)])
+        self.assertEqual(outbox.coalesced_frames, 0)
+
+    def test_flood_of_mixed_frames_overflows(self):
+        outbox = Outbox(max_frames=8, policy='coalesce')
+        accepted = 0
+        for index in range(100):
+            kind = 'new player' if index % 2 else 'round result'
+            if not outbox.push(f"{kind} {index}".encode(), kind):
+                break
+            accepted += 1
+        self.assertEqual(accepted, 8)
+        self.assertEqual(outbox.coalesced_frames, 0)
+        self.assertEqual(outbox.overflows, 1)
+
+    def test_full_scores_and_pings_are_coalesced(self):
+        outbox = self.full_outbox('correct answer')
+        self.assertTrue(outbox.push(b'correct answer 4', 'correct answer'))
+        # the head frame may be partially written and is kept
+        self.assertEqual([frame for _, frame in outbox.frames], [b'correct answer 0', b'correct answer 4'])
+        outbox = self.full_outbox('ping')
+        self.assertTrue(outbox.push(b'ping 4', 'ping'))
+        self.assertEqual(outbox.coalesced_frames, 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
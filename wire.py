@@ -0,0 +1,312 @@
+''' Wire encodings of the game messages.
+
+Every connection starts with newline-delimited json. A client may ask for the compact
+binary encoding by adding "encoding": "binary" to its "create" or "connect" message;
+the json "status" response then echoes the encoding and both sides switch right after it.
+
+A binary frame is varint(body length) + body, and the body starts with a type code.
+Messages with a compact layout are struct-packed with varints; any other message, or one
+with fields the layout does not know, is sent as code 0 followed by its json text. '''
+import base64
+import json
+import struct
+
+from framing import FrameDecoder, FrameTooLarge
+
+JSON_FALLBACK = 0
+LENGTH_BYTES = 5 # longest varint of a frame length, enough for 32-bit lengths
+_DOUBLE = struct.Struct('<d')
+
+
+def write_varint(out: bytearray, value: int):
+    ''' Unsigned LEB128 '''
+    if value < 0:
+        raise ValueError("varint must not be negative")
+    while value >= 0x80:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def read_varint(buf, pos: int, max_bytes=10):
+    ''' The function returns the decoded value and the position after it, or (None, pos) if the buffer ends first,
+    a varint longer than max_bytes raises ValueError '''
+    result = shift = 0
+    end = min(len(buf), pos + max_bytes)
+    while pos < end:
+        byte = buf[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+    if end < len(buf):
+        raise ValueError(f"Varint longer than {max_bytes} bytes")
+    return None, pos
+
+
+def write_str(out: bytearray, text: str):
+    data = text.encode()
+    write_varint(out, len(data))
+    out += data
+
+
+def read_str(buf, pos: int):
+    length, pos = read_varint(buf, pos)
+    return bytes(buf[pos:pos + length]).decode(), pos + length
+
+
+def write_b64(out: bytearray, text: str):
+    ''' Base64 text of the json message is sent as the raw bytes '''
+    data = base64.b64decode(text, validate=True)
+    write_varint(out, len(data))
+    out += data
+
+
+def read_b64(buf, pos: int):
+    length, pos = read_varint(buf, pos)
+    return base64.b64encode(bytes(buf[pos:pos + length])).decode(), pos + length
+
+
+def write_ints(out: bytearray, values):
+    write_varint(out, len(values))
+    for value in values:
+        write_varint(out, value)
+
+
+def read_ints(buf, pos: int):
+    count, pos = read_varint(buf, pos)
+    values = []
+    for _ in range(count):
+        value, pos = read_varint(buf, pos)
+        values.append(value)
+    return values, pos
+
+
+# message type -> (type code, fields of the compact layout)
+LAYOUTS = {
+    'ready to start': (1, {'type', 'game_id'}),
+    'answer': (2, {'type', 'round', 'answer'}),
+    'pong': (3, {'type', 'seq'}),
+    'new player': (16, {'type', 'player_id'}),
+    'question': (17, {'type', 'round', 'question', 'options', 'sent_at'}),
+    'correct answer': (18, {'type', 'correct_answ', 'curr_score', 'deleted_players'}),
+    'end game': (19, {'type', 'winner', 'curr_score'}),
+    'ping': (20, {'type', 'seq'}),
+    'round result': (21, {'type', 'round', 'correct_answ', 'scored', 'left'}),
+    'prefetch': (22, {'type', 'round', 'payload'}),
+    'reveal': (23, {'type', 'round', 'key', 'sent_at'}),
+    'standings': (24, {'type', 'round', 'players', 'top', 'final'}),
+}
+TYPES = {code: name for name, (code, _) in LAYOUTS.items()}
+
+
+def _encode_body(message: dict, out: bytearray):
+    kind = message['type']
+    if kind == 'ready to start':
+        pass # the game of the connection is known to the server
+    elif kind == 'answer':
+        write_varint(out, message['round'])
+        answer = message['answer']
+        # 0 is "no answer", other answers are zigzag encoded and shifted by one
+        if answer is None:
+            write_varint(out, 0)
+        else:
+            write_varint(out, (answer << 1 if answer >= 0 else (~answer << 1) | 1) + 1)
+    elif kind in ('ping', 'pong'):
+        write_varint(out, message['seq'])
+    elif kind == 'new player':
+        write_varint(out, message['player_id'])
+    elif kind == 'question':
+        write_varint(out, message['round'])
+        write_str(out, message['question'])
+        write_varint(out, len(message['options']))
+        for option in message['options']:
+            write_str(out, option)
+        out += _DOUBLE.pack(message.get('sent_at', 0.0))
+    elif kind == 'correct answer':
+        write_varint(out, message['correct_answ'])
+        write_ints(out, message['curr_score'])
+        deleted = message.get('deleted_players') or []
+        write_varint(out, len(deleted))
+        for item in deleted:
+            write_varint(out, item['id'])
+            write_varint(out, item['score'])
+    elif kind == 'end game':
+        write_str(out, message['winner'])
+        write_ints(out, message['curr_score'])
+    elif kind == 'round result':
+        write_varint(out, message['round'])
+        write_varint(out, message['correct_answ'])
+        write_ints(out, message['scored'])
+        left = message['left']
+        write_varint(out, len(left))
+        for player_id, score in left:
+            write_varint(out, player_id)
+            write_varint(out, score)
+    elif kind == 'prefetch':
+        write_varint(out, message['round'])
+        write_b64(out, message['payload'])
+    elif kind == 'reveal':
+        write_varint(out, message['round'])
+        write_b64(out, message['key'])
+        out += _DOUBLE.pack(message.get('sent_at', 0.0))
+    elif kind == 'standings':
+        write_varint(out, message['round'])
+        write_varint(out, message['players'])
+        top = message['top']
+        write_varint(out, len(top))
+        for player_id, score in top:
+            write_varint(out, player_id)
+            write_varint(out, score)
+        out.append(1 if message['final'] else 0)
+
+
+def _decode_body(kind: str, buf, pos: int) -> dict:
+    message = {'type': kind}
+    if kind == 'answer':
+        message['round'], pos = read_varint(buf, pos)
+        answer, pos = read_varint(buf, pos)
+        if answer:
+            answer -= 1
+            message['answer'] = ~(answer >> 1) if answer & 1 else answer >> 1
+        else:
+            message['answer'] = None
+    elif kind in ('ping', 'pong'):
+        message['seq'], pos = read_varint(buf, pos)
+    elif kind == 'new player':
+        message['player_id'], pos = read_varint(buf, pos)
+    elif kind == 'question':
+        message['round'], pos = read_varint(buf, pos)
+        message['question'], pos = read_str(buf, pos)
+        count, pos = read_varint(buf, pos)
+        options = []
+        for _ in range(count):
+            option, pos = read_str(buf, pos)
+            options.append(option)
+        message['options'] = options
+        message['sent_at'] = _DOUBLE.unpack_from(buf, pos)[0]
+    elif kind == 'correct answer':
+        message['correct_answ'], pos = read_varint(buf, pos)
+        message['curr_score'], pos = read_ints(buf, pos)
+        count, pos = read_varint(buf, pos)
+        deleted = []
+        for _ in range(count):
+            player_id, pos = read_varint(buf, pos)
+            score, pos = read_varint(buf, pos)
+            deleted.append({'id': player_id, 'score': score})
+        message['deleted_players'] = deleted
+    elif kind == 'end game':
+        message['winner'], pos = read_str(buf, pos)
+        message['curr_score'], pos = read_ints(buf, pos)
+    elif kind == 'round result':
+        message['round'], pos = read_varint(buf, pos)
+        message['correct_answ'], pos = read_varint(buf, pos)
+        message['scored'], pos = read_ints(buf, pos)
+        count, pos = read_varint(buf, pos)
+        left = []
+        for _ in range(count):
+            player_id, pos = read_varint(buf, pos)
+            score, pos = read_varint(buf, pos)
+            left.append([player_id, score])
+        message['left'] = left
+    elif kind == 'prefetch':
+        message['round'], pos = read_varint(buf, pos)
+        message['payload'], pos = read_b64(buf, pos)
+    elif kind == 'reveal':
+        message['round'], pos = read_varint(buf, pos)
+        message['key'], pos = read_b64(buf, pos)
+        message['sent_at'] = _DOUBLE.unpack_from(buf, pos)[0]
+    elif kind == 'standings':
+        message['round'], pos = read_varint(buf, pos)
+        message['players'], pos = read_varint(buf, pos)
+        count, pos = read_varint(buf, pos)
+        top = []
+        for _ in range(count):
+            player_id, pos = read_varint(buf, pos)
+            score, pos = read_varint(buf, pos)
+            top.append([player_id, score])
+        message['top'] = top
+        message['final'] = bool(buf[pos])
+    return message
+
+
+class JsonCodec:
+    name = 'json'
+
+    def encode(self, message: dict) -> bytes:
+        return (json.dumps(message) + '\n').encode()
+
+    def new_decoder(self, max_frame_size) -> FrameDecoder:
+        return FrameDecoder(max_frame_size)
+
+
+class BinaryCodec:
+    name = 'binary'
+
+    def encode(self, message: dict) -> bytes:
+        body = bytearray()
+        layout = LAYOUTS.get(message.get('type'))
+        if layout and message.keys() <= layout[1]:
+            try:
+                body.append(layout[0])
+                _encode_body(message, body)
+            except (KeyError, TypeError, ValueError, AttributeError, struct.error):
+                body = None # values that do not fit the layout are sent as json
+        else:
+            body = None
+        if body is None:
+            body = bytearray([JSON_FALLBACK])
+            body += json.dumps(message).encode()
+        frame = bytearray()
+        write_varint(frame, len(body))
+        return bytes(frame + body)
+
+    def decode(self, body) -> dict:
+        code = body[0]
+        if code == JSON_FALLBACK:
+            return json.loads(bytes(body[1:]))
+        kind = TYPES.get(code)
+        if kind is None:
+            raise ValueError(f"Unknown binary message type {code}")
+        return _decode_body(kind, body, 1)
+
+    def new_decoder(self, max_frame_size) -> 'BinaryFrameDecoder':
+        return BinaryFrameDecoder(max_frame_size)
+
+
+class BinaryFrameDecoder(FrameDecoder):
+    ''' Incremental decoder of length-prefixed binary frames with the same interface as FrameDecoder '''
+
+    codec = BinaryCodec()
+
+    def feed(self, data: bytes) -> int:
+        self.buffer += data
+        decoded = 0
+        while True:
+            try:
+                length, body_start = read_varint(self.buffer, self.start, LENGTH_BYTES)
+            except ValueError:
+                raise FrameTooLarge(f"Frame length prefix longer than {LENGTH_BYTES} bytes") from None
+            if length is None:
+                break
+            if length > self.max_frame_size:
+                raise FrameTooLarge(f"Frame of {length} bytes exceeds {self.max_frame_size}")
+            if length == 0:
+                raise ValueError("Empty binary frame")
+            if body_start + length > len(self.buffer):
+                break
+            self.messages.append(self.codec.decode(memoryview(self.buffer)[body_start:body_start + length]))
+            self.start = body_start + length
+            decoded += 1
+        # what is left is the start of one frame, the length prefix was checked above
+        pending = len(self.buffer) - self.start
+        if pending > self.max_frame_size + LENGTH_BYTES:
+            raise FrameTooLarge(f"Unterminated frame of {pending} bytes exceeds {self.max_frame_size}")
+        self.compact()
+        return decoded
+
+
+JSON = JsonCodec()
+BINARY = BinaryCodec()
+CODECS = {codec.name: codec for codec in (JSON, BINARY)}